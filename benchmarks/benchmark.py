@@ -0,0 +1,429 @@
+# Benchmarks for tensor_fhe and matrix_fhe.
+#
+#     python benchmarks/benchmark.py run -o results.json
+#     python benchmarks/benchmark.py run --quick --filter tensor/encoded_add
+#     python benchmarks/benchmark.py compare baseline.json results.json
+#     python benchmarks/benchmark.py noise --dimension 5 --precision 96
+#
+# Every case is a setup step (not timed) and an operation, run for a number of
+# parameter sets (key length and precision). Each parameter set gets its own seed,
+# derived from --seed, so inputs are the same from run to run. The operation is
+# run --warmup times first, then --repeat times timed, and once more under
+# tracemalloc (for peak memory) with instrumentation on (for the gate counts).
+# noise prints matrix_fhe.noise_report for every gadget base, to pick the trade-off
+# between ciphertext width and multiplicative depth.
+# compare matches cases by name and parameters and flags the ones whose median
+# time went up by more than --threshold, exiting with status 1 if there are any.
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Both directories carry the same instrumentation module; it's imported once, so
+# one recorder sees the operations of both schemes
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "tensor_fhe"))
+sys.path.insert(0, os.path.join(ROOT, "matrix_fhe"))
+
+import homomorphic_encryption as tensor  # noqa: E402
+import instrumentation  # noqa: E402
+import matrix_fhe as matrix  # noqa: E402
+
+TENSOR_PARAMS = [
+    {"length": length, "precision": precision}
+    for length in (5, 17)
+    for precision in (12, 48, 112)
+]
+MATRIX_PARAMS = [
+    {"dimension": dimension, "precision": precision}
+    for dimension in (3, 5)
+    for precision in (96, 128)
+]
+SHORT_PRECISION = 12
+
+
+# A benchmark case: `setup(params)` builds the inputs, `run(state)` is timed.
+# `params` restricts which parameter sets the case runs for
+class Case:
+    def __init__(self, name, setup, run, params, quick=True):
+        self.name, self.setup, self.run = name, setup, run
+        self.params, self.quick = params, quick
+
+
+def case_seed(seed, name, params):
+    data = json.dumps([seed, name, params], sort_keys=True).encode()
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], "little")
+
+
+def tensor_keys(length, precision):
+    s = tensor.generate_key(length, precision)
+    tk = tensor.mk_transit_key(s, s, precision, packed=True)
+    zero, one = tensor.encrypt(s, 0, precision), tensor.encrypt(s, 1, precision)
+    return s, tk, zero, one
+
+
+def tensor_integers(keys, values, bits):
+    s, tk, zero, one = keys
+    return [tensor.binary_encode(v, bits, zero, one) for v in values]
+
+
+def tensor_cases():
+    def keygen(p):
+        return tensor.generate_key(p["length"], p["precision"]), p["precision"]
+
+    def with_keys(p):
+        return tensor_keys(p["length"], p["precision"])
+
+    def bootstrap_setup(p):
+        s, tk, zero, one = with_keys(p)
+        bk = tensor.mk_bootstrapping_key(
+            s, s, p["precision"], SHORT_PRECISION, packed=True
+        )
+        return one, bk, tk
+
+    def adder_setup(p):
+        keys = with_keys(p)
+        return tensor_integers(keys, [random.randrange(256) for _ in range(2)], 8), keys
+
+    def multi_add_setup(p):
+        keys = with_keys(p)
+        values = [random.randrange(256) for _ in range(4)]
+        return tensor_integers(keys, values, 8), keys
+
+    small = [p for p in TENSOR_PARAMS if p["length"] == 5]
+    return [
+        Case(
+            "tensor/keygen",
+            keygen,
+            lambda st: tensor.mk_transit_key(st[0], st[0], st[1], packed=True),
+            TENSOR_PARAMS,
+        ),
+        Case(
+            "tensor/encrypt",
+            with_keys,
+            lambda st: tensor.encrypt(st[0], 1, st[2].precision),
+            TENSOR_PARAMS,
+        ),
+        Case(
+            "tensor/encrypt_pk_many",
+            lambda p: tensor.mk_public_key(
+                tensor.generate_key(p["length"], p["precision"]),
+                p["precision"],
+                packed=True,
+            ),
+            lambda pk: tensor.encrypt_pk_many(pk, [1] * 256, packed=True),
+            # A public key's samples add up to too much noise at 12 bits
+            [p for p in TENSOR_PARAMS if p["precision"] > SHORT_PRECISION],
+        ),
+        Case(
+            "tensor/decrypt",
+            with_keys,
+            lambda st: tensor.decrypt(st[0], st[3]),
+            TENSOR_PARAMS,
+        ),
+        Case(
+            "tensor/and",
+            with_keys,
+            lambda st: tensor._and(st[2], st[3], st[1]),
+            TENSOR_PARAMS,
+        ),
+        Case(
+            "tensor/encoded_add",
+            adder_setup,
+            lambda st: tensor.encoded_add(st[0][0], st[0][1], st[1][1]),
+            small,
+        ),
+        Case(
+            "tensor/multi_add",
+            multi_add_setup,
+            lambda st: tensor.multi_add(st[0], tensor.PLAIN_ZERO, st[1][1], 10),
+            small,
+            quick=False,
+        ),
+        Case(
+            "tensor/bootstrap",
+            bootstrap_setup,
+            lambda st: tensor.bootstrap(*st),
+            [{"length": 5, "precision": 112}],
+            quick=False,
+        ),
+    ]
+
+
+def matrix_cases():
+    def with_key(p):
+        key = matrix.generate_key(p["dimension"], p["precision"])
+        precision = p["precision"]
+        return key, precision, matrix.encrypt(key, 1, precision)
+
+    def integers(p, count, bits):
+        key = matrix.generate_key(p["dimension"], p["precision"])
+        values = [random.randrange(2**bits) for _ in range(count)]
+        encrypted = [
+            matrix.binary_encrypt(key, v, bits, p["precision"]) for v in values
+        ]
+        return encrypted, p["precision"]
+
+    return [
+        Case(
+            "matrix/keygen",
+            lambda p: p,
+            lambda p: matrix.generate_key(p["dimension"], p["precision"]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/encrypt",
+            with_key,
+            lambda st: matrix.encrypt(st[0], 1, st[1]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/encrypt_many",
+            lambda p: (matrix.generate_key(p["dimension"], p["precision"]), p),
+            lambda st: matrix.binary_encrypt_many(
+                st[0], range(8), 8, st[1]["precision"]
+            ),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/decrypt",
+            with_key,
+            lambda st: matrix.decrypt(st[0], st[2], st[1]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/and",
+            with_key,
+            lambda st: matrix._and(st[2], st[2], st[1]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/xor",
+            with_key,
+            lambda st: matrix._xor(st[2], st[2], st[1]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/encoded_add",
+            lambda p: integers(p, 2, 4),
+            lambda st: matrix.encoded_add(st[0][0], st[0][1], st[1]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/three_to_two",
+            lambda p: integers(p, 3, 4),
+            lambda st: matrix.three_to_two(*st[0], st[1]),
+            MATRIX_PARAMS,
+        ),
+        Case(
+            "matrix/multi_add",
+            lambda p: integers(p, 4, 4),
+            lambda st: matrix.multi_add(st[0], st[1], 6),
+            MATRIX_PARAMS[:1],
+            quick=False,
+        ),
+    ]
+
+
+def measure(case, params, seed, warmup, repeat):
+    random.seed(case_seed(seed, case.name, params))
+    state = case.setup(params)
+    for _ in range(warmup):
+        case.run(state)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run(state)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    with instrumentation.recording(quiet=True) as rec:
+        case.run(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "name": case.name,
+        "params": params,
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "max": max(times),
+        "peak_bytes": peak,
+        "counters": rec.counters,
+    }
+
+
+def run(args):
+    cases = []
+    if args.scheme in ("tensor", "all"):
+        cases += tensor_cases()
+    if args.scheme in ("matrix", "all"):
+        cases += matrix_cases()
+    instrumentation.verbose = False
+    results = []
+    for case in cases:
+        if args.quick and not case.quick:
+            continue
+        if args.filter and args.filter not in case.name:
+            continue
+        for params in case.params[:1] if args.quick else case.params:
+            result = measure(case, params, args.seed, args.warmup, args.repeat)
+            results.append(result)
+            print(
+                "{:<22} {:<40} median {:.6f}s  stdev {:.6f}s  peak {:.1f} MiB".format(
+                    case.name,
+                    json.dumps(params),
+                    result["median"],
+                    result["stdev"],
+                    result["peak_bytes"] / 2**20,
+                )
+            )
+    output = {
+        "meta": {
+            "seed": args.seed,
+            "warmup": args.warmup,
+            "repeat": args.repeat,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+def result_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+# Pairs up results by case and returns (key, old median, new median, ratio,
+# regressed) for every case in both files. Differences under `min_delta` seconds
+# are timer noise for the fastest cases, so they never count as regressions
+def compare_results(baseline, current, threshold, min_delta=0.0):
+    old = {result_key(r): r for r in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        key = result_key(result)
+        if key in old:
+            before, after = old[key]["median"], result["median"]
+            ratio = after / before if before else float("inf")
+            regressed = ratio > 1 + threshold and after - before > min_delta
+            rows.append((key, before, after, ratio, regressed))
+    return rows
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare_results(baseline, current, args.threshold, args.min_delta)
+    for (name, params), before, after, ratio, regressed in rows:
+        print(
+            "{:<22} {:<40} {:.6f}s -> {:.6f}s  x{:.2f}{}".format(
+                name, params, before, after, ratio, "  REGRESSION" if regressed else ""
+            )
+        )
+    regressions = sum(row[-1] for row in rows)
+    print("{} cases compared, {} regressions".format(len(rows), regressions))
+    return 1 if regressions else 0
+
+
+# Every gadget base, unsigned and signed
+def gadget_settings(precision):
+    settings = [matrix.Gadget(precision)]
+    for bits in (2, 4, 8):
+        settings += [
+            matrix.Gadget(precision, bits),
+            matrix.Gadget(precision, bits, True),
+        ]
+    return settings
+
+
+def noise(args):
+    random.seed(args.seed)
+    report = matrix.noise_report(
+        args.dimension, gadget_settings(args.precision), args.trials
+    )
+    for row in report:
+        print(
+            "base 2**{} {:<8} width {:<5} multiply {:.6f}s  margin {} bits  "
+            "depth {:<3} error bits {}".format(
+                row["base_bits"],
+                "signed" if row["signed"] else "unsigned",
+                row["width"],
+                row["multiply_seconds"],
+                row["margin_bits"],
+                row["depth"],
+                row["error_bits"],
+            )
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for tensor_fhe and matrix_fhe"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--scheme", choices=("tensor", "matrix", "all"), default="all"
+    )
+    run_parser.add_argument("--filter", help="only run cases whose name contains this")
+    run_parser.add_argument(
+        "--quick", action="store_true", help="one parameter set, skip slow cases"
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--warmup", type=int, default=1)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("-o", "--output", help="write results to this JSON file")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="flag cases more than this fraction slower (default 0.1)",
+    )
+    compare_parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.0005,
+        help="ignore slowdowns of less than this many seconds (default 0.0005)",
+    )
+    noise_parser = commands.add_parser(
+        "noise", help="report matrix_fhe noise growth for every gadget base"
+    )
+    noise_parser.add_argument("--dimension", type=int, default=5)
+    noise_parser.add_argument("--precision", type=int, default=96)
+    noise_parser.add_argument("--trials", type=int, default=4)
+    noise_parser.add_argument("--seed", type=int, default=0)
+    noise_parser.add_argument(
+        "-o", "--output", help="write the report to this JSON file"
+    )
+    args = parser.parse_args(argv)
+    if args.command == "noise":
+        return noise(args)
+    if args.command == "run":
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
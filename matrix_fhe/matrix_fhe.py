@@ -1,7 +1,13 @@
 # Fully homomorphic encryption based on https://eprint.iacr.org/2013/340.pdf and https://eccc.weizmann.ac.il/report/2018/125/
 
+from collections import deque
+import functools
+import itertools
+import multiprocessing
 import random
 
+import instrumentation
+
 # Error is sampled from range(-ERROR_MAGNITUDE, ERROR_MAGNITUDE+1)
 ERROR_MAGNITUDE = 16
 
@@ -38,6 +44,8 @@ def add_vectors(*args):
 
 # M -> kM, self-explanatory
 def mul_by_const(M, factor, precision):
+    if isinstance(precision, Batch):
+        return precision.mul_by_const(M, factor)
     mask = 2**precision - 1
     return [[(x * factor) & mask for x in row] for row in M]
 
@@ -45,6 +53,8 @@ def mul_by_const(M, factor, precision):
 # Matrix addition; self-explanatory
 def matrix_add(*args):
     inputs, precision = args[:-1], args[-1]
+    if isinstance(precision, Batch):
+        return precision.add(*inputs)
     assert isinstance(precision, int)
     rows, cols = len(inputs[0]), len(inputs[0][0])
     for inp in inputs[1:]:
@@ -55,11 +65,90 @@ def matrix_add(*args):
     ]
 
 
+# Matrix backends, selected with set_backend:
+# - "list" computes every entry of a product with a Python loop over ints
+# - "packed" stores every row of the right-hand matrix as one big integer, each
+#   entry in its own fixed-width slot (the limbs of the row), so that a row of
+#   A * B is the sum over k of A[i][k] times packed row k of B: len(B) big integer
+#   multiply-adds per row instead of len(B) * cols small ones. Slots are wide
+#   enough to hold the exact sums (see packed_width), so a single mask per row
+#   reduces every entry mod 2**precision
+# Both give identical results. They are used by encrypt, decrypt and the other
+# matrix products; multiplying ciphertexts goes through gadget_multiply instead,
+# whatever the backend
+BACKENDS = ("list", "packed")
+backend = "list"
+
+
+# Returns the previous backend
+def set_backend(name):
+    global backend
+    if name not in BACKENDS:
+        raise ValueError("unknown matrix backend {}".format(name))
+    previous, backend = backend, name
+    return previous
+
+
+# Slot width in bits (whole bytes) for sums of `terms` products of an a_bits bit
+# and a b_bits bit number
+def packed_width(a_bits, b_bits, terms):
+    return -(-(a_bits + b_bits + terms.bit_length()) // 8) * 8
+
+
+# The row as one integer, entry k in bits k*width ... (k+1)*width - 1. Entries must
+# be in [0, 2**width)
+def pack_row(row, width):
+    size = width // 8
+    data = b"".join(
+        map(int.to_bytes, row, itertools.repeat(size), itertools.repeat("little"))
+    )
+    return int.from_bytes(data, "little")
+
+
+def unpack_row(x, cols, width, precision):
+    size, mask = width // 8, 2**precision - 1
+    data = x.to_bytes(size * cols, "little")
+    return [
+        int.from_bytes(data[k : k + size], "little") & mask
+        for k in range(0, len(data), size)
+    ]
+
+
+# matrix_multiply with the "packed" backend
+def packed_matrix_multiply(A, B, precision):
+    mask = 2**precision - 1
+    cols = len(B[0])
+    # Entries are reduced mod 2**precision, which is only needed if some aren't
+    # already (eg. the -1s of the fuzz matrix in encrypt)
+    if min(map(min, B)) < 0 or max(map(max, B)) > mask:
+        B = [[x & mask for x in row] for row in B]
+    width = packed_width(precision, max(map(max, B)).bit_length(), len(B))
+    rows = [pack_row(row, width) for row in B]
+    C = []
+    for a_row in A:
+        total = 0
+        for a, row in zip(a_row, rows):
+            a &= mask
+            if a:
+                total += a * row
+        # The entries are less than 2**width, so truncating the integer to
+        # cols * width bits keeps them all
+        total &= (1 << (cols * width)) - 1
+        C.append(unpack_row(total, cols, width, precision))
+    return C
+
+
 # Matrix multiplication; self-explanatory
+@instrumentation.timed("matrix_multiply")
 def matrix_multiply(A, B, precision):
     assert len(A[0]) == len(B)
     rows = len(A)
     cols = len(B[0])
+    if instrumentation.active is not None:
+        instrumentation.active.count("matrix_multiply")
+        instrumentation.active.count("multiply_adds", rows * cols * len(B))
+    if backend == "packed":
+        return packed_matrix_multiply(A, B, precision)
     C = [[0 for _ in range(cols)] for _ in range(rows)]
     for i in range(rows):
         for j in range(cols):
@@ -77,6 +166,8 @@ def identity(rows, mul_factor=1):
 # Multiply a vector by a matrix
 def vector_matrix_multiply(v, M, precision):
     assert len(M) == len(v)
+    if backend == "packed":
+        return packed_matrix_multiply([v], M, precision)[0]
     return [
         sum([M[i][j] * v[i] for i in range(len(M))]) & (2**precision - 1)
         for j in range(len(M[0]))
@@ -89,31 +180,162 @@ def inner_product(v1, v2, precision):
     return sum([v1[i] * v2[i] for i in range(len(v1))]) & (2**precision - 1)
 
 
-# Splits up each value in a matrix into bits.
+# The gadget: ciphertexts are dimension x (dimension * digits) matrices, with one
+# column per digit of every key entry (see generate_powers_matrix), and
+# multiplication splits the right-hand ciphertext into digits (see bitify). The
+# digits are bits by default. Pass a Gadget in place of the precision (everywhere,
+# from encrypt to decrypt) for digits in base 2**base_bits instead, which divides
+# the ciphertext width and the cost of a multiplication by about base_bits. The
+# price is noise:
+# - every multiplication adds the error of the left-hand ciphertext times the
+#   digits, which are up to 2**base_bits - 1 instead of 1, or with signed=True
+#   in [-2**(base_bits-1), 2**(base_bits-1)), for half the growth
+# - decryption reads the column of the top power of the gadget (see top_power),
+#   2**(base_bits*(digits-1)), which for some precisions is less than
+#   2**(precision-1), shrinking the margin for the error
+# noise_report measures both. base_bits must divide 8 (see gadget_multiply)
+class Gadget(int):
+    def __new__(cls, precision, base_bits=1, signed=False):
+        if base_bits not in (1, 2, 4, 8):
+            raise ValueError("gadget base_bits must be 1, 2, 4 or 8")
+        if signed and base_bits == 1:
+            raise ValueError("signed gadget digits need base_bits > 1")
+        self = super().__new__(cls, precision)
+        self.base_bits, self.signed = base_bits, signed
+        return self
+
+    def __repr__(self):
+        return "Gadget({}, base_bits={}, signed={})".format(
+            int(self), self.base_bits, self.signed
+        )
+
+
+def base_bits(precision):
+    return getattr(precision, "base_bits", 1)
+
+
+# Digits per key entry
+def digit_count(precision):
+    return -(-precision // base_bits(precision))
+
+
+# log2 of the largest power of the gadget
+def top_power(precision):
+    return base_bits(precision) * (digit_count(precision) - 1)
+
+
+# Signed digits are stored offset by 2**(base_bits-1), to be in [0, 2**base_bits)
+# like unsigned ones. As the digits of x are the digits of x + gadget_offset with
+# the offset taken off every digit, they are found without any carrying
+def gadget_offset(precision):
+    if not getattr(precision, "signed", False):
+        return 0
+    bits = base_bits(precision)
+    return (
+        (1 << (bits - 1))
+        * ((1 << (bits * digit_count(precision))) - 1)
+        // ((1 << bits) - 1)
+    )
+
+
+# Splits up each value in a matrix into digits (bits unless the precision is a
+# Gadget), least significant first.
 # Example: [[1, 2], [3, 4]], precision=3
-# Output: [[1, 0, 0, 0, 1, 0], [1, 1, 0, 0, 0, 1]]
+# Output: [[1, 0], [0, 1], [0, 0], [1, 0], [1, 0], [0, 1]]
 def bitify(matrix, precision):
+    bits, count = base_bits(precision), digit_count(precision)
+    instrumentation.count("bitify_values", len(matrix) * len(matrix[0]) * count)
+    mask, digit_mask = 2**precision - 1, 2**bits - 1
+    offset, width_mask = gadget_offset(precision), (1 << (bits * count)) - 1
+    half = (1 << (bits - 1)) if offset else 0
     o = []
     for row in matrix:
-        for bit in range(precision):
-            o.append([(value >> bit) % 2 for value in row])
+        row = [((value & mask) + offset) & width_mask for value in row]
+        for digit in range(count):
+            shift = digit * bits
+            o.append([((value >> shift) & digit_mask) - half for value in row])
     return o
 
 
+# bitify with every column of the output as one integer, so that bits
+# k*base_bits ... (k+1)*base_bits - 1 of packed_bitify(matrix, precision)[j] are
+# bitify(matrix, precision)[k][j] (plus 2**(base_bits-1) for signed digits)
+def packed_bitify(matrix, precision):
+    count = digit_count(precision)
+    instrumentation.count("bitify_values", len(matrix) * len(matrix[0]) * count)
+    width = base_bits(precision) * count
+    mask, offset, width_mask = (
+        2**precision - 1,
+        gadget_offset(precision),
+        (1 << width) - 1,
+    )
+    columns = [0] * len(matrix[0])
+    for i, row in enumerate(matrix):
+        shift = i * width
+        columns = [
+            c | (((value & mask) + offset) & width_mask) << shift
+            for c, value in zip(columns, row)
+        ]
+    return columns
+
+
+# Bits of a packed_bitify column handled per gadget_multiply table
+GADGET_WINDOW = 8
+
+
+# Computes matrix_multiply(A, bitify(B, precision), precision) from
+# columns = packed_bitify(B, precision), with no integer multiplications: every
+# entry is a sum of multiples of the entries of a row of A, selected by the digits
+# of a column. Each row of A is cut into windows of GADGET_WINDOW bits worth of
+# digits, and the sums for all 2**GADGET_WINDOW combinations of digits in every
+# window are tabulated once (the "Method of Four Russians"), at one addition per
+# combination. Every entry of the product is then one table lookup and addition
+# per window, indexed by the bytes of the column. The offset of signed digits is
+# taken off with the sum of the row, shifted
+@instrumentation.timed("gadget_multiply")
+def gadget_multiply(A, columns, precision):
+    instrumentation.count("gadget_multiply")
+    bits = base_bits(precision)
+    per_window = GADGET_WINDOW // bits
+    mask = 2**precision - 1
+    size = -(-len(A[0]) * bits // 8)
+    keys = [c.to_bytes(size, "little") for c in columns]
+    C = []
+    for row in A:
+        tables = []
+        for start in range(0, len(row), per_window):
+            table = [0]
+            for a in row[start : start + per_window]:
+                multiples = [a]
+                for _ in range(2**bits - 2):
+                    multiples.append(multiples[-1] + a)
+                table += [t + m for m in multiples for t in table]
+            tables.append(table)
+        offset = sum(row) << (bits - 1) if gadget_offset(precision) else 0
+        C.append(
+            [(sum(map(list.__getitem__, tables, key)) - offset) & mask for key in keys]
+        )
+    return C
+
+
 # Generates a matrix of the form eg. [[1, 2, 4, 0, 0, 0], [0, 0, 0, 1, 2, 4]]
+# (powers of 2**base_bits for a Gadget)
 # The inverse of bitify (though applicable on inputs that are not possible outputs of bitify)
 def generate_powers_matrix(dimension, precision):
+    bits, count = base_bits(precision), digit_count(precision)
     return [
         [
-            1 << (y % precision) if x == y // precision else 0
-            for y in range(dimension * precision)
+            1 << (bits * (y % count)) if x == y // count else 0
+            for y in range(dimension * count)
         ]
         for x in range(dimension)
     ]
 
 
 # Encrypts a value
+@instrumentation.timed("encrypt")
 def encrypt(key, value, precision):
+    instrumentation.count("encryptions")
     dimension = len(key)
     # Step 1: generate a dim x dim matrix A such that key * A = (small error)
     random_matrix = generate_random_matrix(dimension - 1, dimension, 0, 2**precision)
@@ -122,8 +344,8 @@ def encrypt(key, value, precision):
     )
     error = generate_random_vector(dimension, -ERROR_MAGNITUDE, ERROR_MAGNITUDE + 1)
     augmented_matrix = [add_vectors(cancelling_value, error, precision)] + random_matrix
-    # Step 2: multiply by random fuzz and get a dim x dim*precision matrix, M = AR
-    fuzz = generate_random_matrix(dimension, dimension * precision, -1, 2)
+    # Step 2: multiply by random fuzz and get a dim x dim*digits matrix, M = AR
+    fuzz = generate_random_matrix(dimension, dimension * digit_count(precision), -1, 2)
     fuzzed_matrix = matrix_multiply(augmented_matrix, fuzz, precision)
     # If we are encrypting zero, the output is M, where key * M = key * A * R = (key*A) * R = small error
     # If we are encrypting one, the output is M+[powers], where
@@ -136,18 +358,92 @@ def encrypt(key, value, precision):
         return fuzzed_matrix
 
 
+# Rows of the augmented matrix per encrypt_many table, and the number of fuzz
+# patterns for them: 3**5 = 243 fits in a byte
+FUZZ_WINDOW = 5
+FUZZ_PATTERNS = 3**FUZZ_WINDOW
+# Deletes the bytes that aren't a fuzz pattern, for rejection sampling with
+# bytes.translate
+FUZZ_REJECT = bytes(range(FUZZ_PATTERNS, 256))
+
+
+# `count` uniformly random fuzz patterns, as bytes
+def fuzz_patterns(count):
+    o = b""
+    while len(o) < count:
+        o += random.randbytes(count - len(o) + 16).translate(None, FUZZ_REJECT)
+    return o[:count]
+
+
+# Encrypts many values at once, the same as [encrypt(key, v, precision) for v in
+# values]. The randomness for all of them is drawn in bulk, and the product of
+# the augmented matrix A with the ternary fuzz matrix R needs no integer
+# multiplications: each entry of R is one base 3 digit of a pattern (0 -> 0,
+# 1 -> 1, 2 -> -1), one pattern per column and FUZZ_WINDOW rows of R. The signed
+# sums of the entries of a row of A for all patterns of a window are tabulated
+# once per row (one addition or subtraction each), and every entry of A * R is
+# then one table lookup and addition per window
+@instrumentation.timed("encrypt_many")
+def encrypt_many(key, values, precision):
+    values = list(values)
+    instrumentation.count("encryptions", len(values))
+    dimension, count = len(key), digit_count(precision)
+    mask, width = 2**precision - 1, dimension * count
+    windows = -(-dimension // FUZZ_WINDOW)
+    negated_key = [2**precision - x for x in key[1:]]
+    patterns = fuzz_patterns(len(values) * windows * width)
+    cts = []
+    for n, value in enumerate(values):
+        # Step 1, as in encrypt, with the rows of A padded with zeros to whole windows
+        random_matrix = [
+            [random.getrandbits(precision) for _ in range(dimension)]
+            for _ in range(dimension - 1)
+        ]
+        cancelling_value = vector_matrix_multiply(negated_key, random_matrix, precision)
+        error = generate_random_vector(dimension, -ERROR_MAGNITUDE, ERROR_MAGNITUDE + 1)
+        padding = [0] * (windows * FUZZ_WINDOW - dimension)
+        augmented_matrix = [
+            [c + e for c, e in zip(cancelling_value, error)] + padding
+        ] + [row + padding for row in random_matrix]
+        # Step 2: M = AR, with the patterns of window w for this value in
+        # patterns[start + w * width : start + (w + 1) * width]
+        start = n * windows * width
+        keys = [
+            patterns[start + w * width : start + (w + 1) * width]
+            for w in range(windows)
+        ]
+        ct = []
+        for row in augmented_matrix:
+            total = [0] * width
+            for w, key_bytes in enumerate(keys):
+                table = [0]
+                for a in row[w * FUZZ_WINDOW : (w + 1) * FUZZ_WINDOW]:
+                    table += [t + a for t in table] + [t - a for t in table]
+                total = [x + table[k] for x, k in zip(total, key_bytes)]
+            ct.append(total)
+        # Add the powers matrix for encryptions of 1
+        if value:
+            bits = base_bits(precision)
+            for x in range(dimension):
+                for d in range(count):
+                    ct[x][x * count + d] += 1 << (bits * d)
+        cts.append([[x & mask for x in row] for row in ct])
+    return cts
+
+
 # Decrypts a value, by distinguishing the two above scenarios
 def decrypt(key, ct, precision):
     key_powers = vector_matrix_multiply(
         key, generate_powers_matrix(len(key), precision), precision
     )
-    # The structure of the key ensures that key_powers[col] = 2**precision/2, making it maximally easy
-    # to distinguish encryptions of 1 from 0
-    col = precision - 1
+    # The structure of the key (key[0] = 1) ensures that key_powers[col] is the top
+    # power of the gadget, 2**precision/2 with binary digits, making it maximally
+    # easy to distinguish encryptions of 1 from 0
+    col, top = digit_count(precision) - 1, top_power(precision)
     # If plaintext=0, prod = small error (at that column)
     # If plaintext=1, prod = key*powers + small error (at that column)
     prod = inner_product([row[col] for row in ct], key, precision)
-    return 0 if prod >> (precision - 2) in (0, 3) else 1
+    return 1 if (prod - 2 ** (top - 1)) % 2**precision < 2**top else 0
 
 
 # Returns the log2 of the error in the ciphertext (for debugging purposes)
@@ -155,27 +451,77 @@ def get_error(key, ct, precision):
     key_powers = vector_matrix_multiply(
         key, generate_powers_matrix(len(key), precision), precision
     )
-    col = precision - 1
+    col, top = digit_count(precision) - 1, top_power(precision)
     prod = inner_product([row[col] for row in ct], key, precision)
-    return (
-        len(bin(min(prod, abs(2 ** (precision - 1) - prod), 2**precision - prod))) - 2
-    )
+    return len(bin(min(prod, abs(2**top - prod), 2**precision - prod))) - 2
 
 
 # Multiply ciphertexts
 def multiply_ciphertexts(A, B, precision):
-    o = matrix_multiply(A, bitify(B, precision), precision)
+    if isinstance(precision, Batch):
+        return precision.multiply(A, B)
+    instrumentation.count("multiplications")
+    o = gadget_multiply(A, packed_bitify(B, precision), precision)
     assert len(o) == len(A) == len(B) and len(o[0]) == len(A[0]) == len(B[0])
     return o
 
 
+# Measures the trade-off between gadget settings: for every precision (or Gadget)
+# in `settings`, squares `trials` fresh encryptions of 1 until the error reaches
+# the decryption margin (or for at most max_depth levels), which is the noise
+# growth of a balanced tree of multiplications. Errors below 2**margin_bits
+# decrypt correctly, but get_error can't tell larger ones from a random ciphertext
+# with binary digits, so levels count as failed from 2**(margin_bits-1). Returns
+# one dict per setting with the ciphertext width, seconds per multiplication, the
+# margin, the largest log2 error after each level (error_bits[0] is fresh), and
+# the depth that still decrypts
+def noise_report(dimension, settings, trials=4, max_depth=32):
+    report = []
+    for precision in settings:
+        key = generate_key(dimension, precision)
+        margin = top_power(precision) - 1
+        errors = []
+        with instrumentation.recording(quiet=True) as rec:
+            for _ in range(trials):
+                ct = encrypt(key, 1, precision)
+                for level in range(max_depth + 1):
+                    error = get_error(key, ct, precision)
+                    if level == len(errors):
+                        errors.append(error)
+                    errors[level] = max(errors[level], error)
+                    if error >= margin or level == max_depth:
+                        break
+                    ct = multiply_ciphertexts(ct, ct, precision)
+        calls, seconds = rec.timers["gadget_multiply"]
+        report.append(
+            {
+                "precision": int(precision),
+                "base_bits": base_bits(precision),
+                "signed": getattr(precision, "signed", False),
+                "width": dimension * digit_count(precision),
+                "multiply_seconds": seconds / calls,
+                "margin_bits": margin,
+                "error_bits": errors,
+                "depth": sum(error < margin for error in errors[1:]),
+            }
+        )
+    return report
+
+
 # Encode an integer into a binary representation (least significant bits first)
 def binary_encode(integer, length, encoded_zero, encoded_one):
     return [encoded_one if integer & (1 << i) else encoded_zero for i in range(length)]
 
 
 def binary_encrypt(key, integer, length, precision):
-    return [encrypt(key, (integer >> i) % 2, precision) for i in range(length)]
+    return encrypt_many(key, [(integer >> i) % 2 for i in range(length)], precision)
+
+
+# binary_encrypt for a column of integers, with one encrypt_many for all their bits
+def binary_encrypt_many(key, integers, length, precision):
+    bits = [(integer >> i) % 2 for integer in integers for i in range(length)]
+    cts = encrypt_many(key, bits, precision)
+    return [cts[k : k + length] for k in range(0, len(cts), length)]
 
 
 # Decrypt a series of ciphertexts that represent an integer in binary representation
@@ -183,6 +529,70 @@ def binary_decrypt(key, output, precision):
     return sum([decrypt(key, o, precision) << i for i, o in enumerate(output)])
 
 
+# Streaming versions of binary_encrypt and binary_decrypt, for more integers than
+# fit in memory at once. They read their input lazily, in chunks of `chunk_size`
+# integers, and yield one result at a time. With `processes`, chunks are handled
+# on a pool, at most `prefetch` (default 2 per worker) ahead of the consumer
+def encrypt_stream(
+    key, integers, length, precision, chunk_size=16, processes=None, prefetch=None
+):
+    tasks = ((key, chunk, length, precision) for chunk in chunked(integers, chunk_size))
+    for encodings in stream_map(_encrypt_chunk, tasks, processes, prefetch):
+        yield from encodings
+
+
+def decrypt_stream(
+    key, encodings, precision, chunk_size=16, processes=None, prefetch=None
+):
+    tasks = ((key, chunk, precision) for chunk in chunked(encodings, chunk_size))
+    for integers in stream_map(_decrypt_chunk, tasks, processes, prefetch):
+        yield from integers
+
+
+def _encrypt_chunk(task):
+    key, integers, length, precision = task
+    return binary_encrypt_many(key, integers, length, precision)
+
+
+def _decrypt_chunk(task):
+    key, encodings, precision = task
+    return [binary_decrypt(key, e, precision) for e in encodings]
+
+
+# Lists of up to `size` consecutive items
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Yields function(task) for every task, in order. With a pool, at most `prefetch`
+# tasks (default 2 per worker) are submitted ahead of the one being yielded, and
+# `tasks` is only read as far as that. Workers reseed their random generator, so
+# that they don't all encrypt with the random state they inherited. The pool is
+# shut down when the generator is closed, even if it wasn't run to the end
+def stream_map(function, tasks, processes=None, prefetch=None):
+    if processes is None or processes <= 1:
+        yield from map(function, tasks)
+        return
+    prefetch = prefetch or 2 * processes
+    pool = multiprocessing.Pool(processes, random.seed)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            if len(pending) >= prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 # Logical operators
 # Note that for all of these operators, you economize on error by putting the
 # highest-error argument last
@@ -245,15 +655,151 @@ def three_to_two(a, b, c, precision):
     return (odd_of_three_abc + [zero], [zero] + two_of_three_abc)
 
 
+# The adders zip their inputs together, so bring integer encodings to one length
+# (at most `bits`) by padding them with `zero`
+def pad_encodings(values, zero, bits):
+    width = min(max(len(v) for v in values), bits)
+    return [v[:width] + [zero] * (width - len(v)) for v in values]
+
+
 # Add together many numbers. Use the 3->2 adder in a tree structure (ok fine it's a DAG),
 # then finish off with a 3-to-1 or 2-to-1 as needed
+@instrumentation.timed("multi_add", span=True)
 def multi_add(values, precision, bits=999999999999999):
+    zero = mul_by_const(values[0][0], 0, precision)
+    values = pad_encodings(values, zero, bits)
     while len(values) > 2:
-        print("Multi adding {} values".format(len(values)))
+        instrumentation.log("Multi adding {} values".format(len(values)))
         o = []
-        for i in range(0, len(values) - 2, 3):
-            x, y = three_to_two(values[i], values[i + 1], values[i + 2], precision)
-            o.extend([x[:bits], y[:bits]])
+        with instrumentation.span("three_to_two"):
+            for i in range(0, len(values) - 2, 3):
+                x, y = three_to_two(values[i], values[i + 1], values[i + 2], precision)
+                o.extend([x, y])
         o.extend(values[len(values) - len(values) % 3 :])
-        values = o
-    return encoded_add(values[0], values[1], precision)[:bits]
+        values = pad_encodings(o, zero, bits)
+    with instrumentation.span("final_add"):
+        return encoded_add(values[0], values[1], precision)[:bits]
+
+
+# Batch evaluation: the same circuit on many independent records at once. Pass a
+# Batch in place of the precision to any of the gates and circuits above (they
+# only use the precision through matrix_add, mul_by_const and
+# multiply_ciphertexts, which hand batches over to it), with batch ciphertexts
+# in place of ciphertexts. A batch ciphertext has the shape of one ciphertext,
+# but every entry packs that entry of `count` ciphertexts, one per record, into
+# the slots of one integer (record r in bits r*width ... (r+1)*width - 1). Each
+# gate then does its big integer operations once for all records:
+# - additions add whole entries and mask every slot with one `&`, as the slots
+#   have GUARD_BITS spare bits for the carries
+# - multiplication by bitify(B) needs no integer multiplications at all: every
+#   entry of bitify(B) is a 0/1 per record, so it is turned into a mask of all
+#   ones or all zeros per slot, and A[i][k] * bitify(B)[k][j] becomes
+#   A[i][k] & mask
+# The results are identical to evaluating every record on its own.
+GUARD_BITS = 16
+
+
+# Slot width in bits, rounded up to whole bytes to stack and unstack with
+# int.to_bytes / int.from_bytes
+def slot_width(precision):
+    return -(-(precision + GUARD_BITS) // 8) * 8
+
+
+@functools.lru_cache(maxsize=64)
+def slot_ones(count, precision):
+    width = slot_width(precision)
+    return sum(1 << (r * width) for r in range(count))
+
+
+class Batch:
+    def __init__(self, count, precision):
+        if base_bits(precision) != 1:
+            raise ValueError("batches only support binary gadget digits")
+        self.count, self.precision = count, precision
+        self.size = slot_width(precision) // 8
+        self.ones = slot_ones(count, precision)
+        self.mask = self.ones * (2**precision - 1)
+
+    # One batch ciphertext from one ciphertext per record
+    def stack(self, cts):
+        assert len(cts) == self.count
+        return [
+            [
+                int.from_bytes(
+                    b"".join(ct[i][j].to_bytes(self.size, "little") for ct in cts),
+                    "little",
+                )
+                for j in range(len(cts[0][0]))
+            ]
+            for i in range(len(cts[0]))
+        ]
+
+    # The ciphertexts of every record
+    def unstack(self, ct):
+        size = self.size
+        entries = [[x.to_bytes(size * self.count, "little") for x in row] for row in ct]
+        return [
+            [
+                [int.from_bytes(x[r : r + size], "little") for x in row]
+                for row in entries
+            ]
+            for r in range(0, size * self.count, size)
+        ]
+
+    # Encoded integers (eg. from binary_encrypt), one per record, into one encoding
+    # of batch ciphertexts. Shorter encodings are padded with zeros
+    def stack_encodings(self, records):
+        width = max(len(r) for r in records)
+        zero = mul_by_const(records[0][0], 0, self.precision)
+        records = [r + [zero] * (width - len(r)) for r in records]
+        return [self.stack(bits) for bits in zip(*records)]
+
+    def unstack_encodings(self, encoding):
+        columns = [self.unstack(ct) for ct in encoding]
+        return [[column[r] for column in columns] for r in range(self.count)]
+
+    def add(self, *inputs):
+        rows, cols = len(inputs[0]), len(inputs[0][0])
+        for inp in inputs[1:]:
+            assert len(inp) == rows and len(inp[0]) == cols
+        assert len(inputs) < 2**GUARD_BITS
+        mask = self.mask
+        return [
+            [sum(inp[i][j] for inp in inputs) & mask for j in range(cols)]
+            for i in range(rows)
+        ]
+
+    # Only for small factors (|factor| < 2**GUARD_BITS), which is all the
+    # circuits use. Negative factors negate every slot first, as 2**precision - x
+    def mul_by_const(self, M, factor):
+        if abs(factor) >= 2**GUARD_BITS:
+            raise ValueError("batch constants must be less than 2**GUARD_BITS")
+        mask = self.mask
+        if factor < 0:
+            top = self.ones << self.precision
+            M = [[(top - x) & mask for x in row] for row in M]
+        factor = abs(factor)
+        return [[(x * factor) & mask for x in row] for row in M]
+
+    # multiply_ciphertexts for every record. Row k = row * precision + bit of
+    # bitify(B) holds bit `bit` of row `row` of B, which in every slot is
+    # expanded to 2**precision - 1 if set and 0 if not
+    @instrumentation.timed("batch_multiply")
+    def multiply(self, A, B):
+        instrumentation.count("multiplications", self.count)
+        ones, full, mask = self.ones, 2**self.precision - 1, self.mask
+        columns = [
+            [
+                ((B[row][j] >> bit) & ones) * full
+                for row in range(len(B))
+                for bit in range(self.precision)
+            ]
+            for j in range(len(B[0]))
+        ]
+        assert len(A[0]) == len(columns[0]) < 2**GUARD_BITS
+        o = [
+            [sum([a & m for a, m in zip(row, column)]) & mask for column in columns]
+            for row in A
+        ]
+        assert len(o) == len(A) == len(B) and len(o[0]) == len(A[0]) == len(B[0])
+        return o
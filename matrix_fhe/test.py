@@ -1,7 +1,11 @@
+import ast
+import os
 import random
 import functools
 import time
 
+import instrumentation
+import matrix_fhe
 from matrix_fhe import (
     generate_key,
     encrypt,
@@ -14,6 +18,22 @@ from matrix_fhe import (
     _and,
     two_of_three,
     three_to_two,
+    multiply_ciphertexts,
+    Batch,
+    encrypt_stream,
+    decrypt_stream,
+    matrix_multiply,
+    vector_matrix_multiply,
+    set_backend,
+    bitify,
+    packed_bitify,
+    gadget_multiply,
+    generate_powers_matrix,
+    Gadget,
+    noise_report,
+    encrypt_many,
+    binary_encrypt_many,
+    get_error,
 )
 
 
@@ -169,6 +189,176 @@ def less_simple_addition_test(*, dimension, precision):
     assert binary_decrypt(k, sum_ciphertext, precision) == sum(values)
 
 
+@testcase("instrumentation_test", args=args)
+def instrumentation_test(*, dimension, precision):
+    k = generate_key(dimension, precision)
+    values = [random.randrange(8) for i in range(4)]
+    ciphertexts = [binary_encrypt(k, v, 3, precision) for v in values]
+    events = []
+    with instrumentation.recording(
+        instrumentation.Recorder(events.append), quiet=True
+    ) as rec:
+        total = multi_add(ciphertexts, precision, bits=5)
+    assert binary_decrypt(k, total, precision) == sum(values)
+    assert rec.counters["gadget_multiply"] == rec.counters["multiplications"]
+    assert rec.timers["gadget_multiply"][0] == rec.counters["gadget_multiply"]
+    assert rec.counters["bitify_values"] > 0
+    [span] = rec.spans
+    assert span["name"] == "multi_add"
+    assert [s["name"] for s in span["spans"]] == ["three_to_two"] * 2 + ["final_add"]
+    assert rec.messages == ["Multi adding 4 values", "Multi adding 3 values"]
+    assert events[-1]["name"] == "multi_add" and events[0]["event"] == "log"
+    assert instrumentation.active is None and instrumentation.verbose
+
+
+# matrix_fhe is run from its own directory and doesn't import tensor_fhe, so it
+# carries a copy of code the two share: the instrumentation module, and the
+# helpers streaming is built on. A copy has to stay the same as the original,
+# line for line and with the comments above each definition
+TENSOR_FHE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tensor_fhe"
+)
+
+
+def definition(path, name):
+    with open(path) as f:
+        source = f.read()
+    lines = source.splitlines()
+    [node] = [n for n in ast.parse(source).body if getattr(n, "name", None) == name]
+    start = node.lineno - 1
+    while start > 0 and lines[start - 1].startswith("#"):
+        start -= 1
+    return lines[start : node.end_lineno]
+
+
+@testcase("copies_test")
+def copies_test():
+    original = os.path.join(TENSOR_FHE, "instrumentation.py")
+    with open(original) as f, open(instrumentation.__file__) as g:
+        assert f.read() == g.read()
+    for name in ["chunked", "stream_map"]:
+        assert definition(os.path.join(TENSOR_FHE, "streaming.py"), name) == definition(
+            matrix_fhe.__file__, name
+        )
+
+
+@testcase("batch_test", args=args)
+def batch_test(*, dimension, precision):
+    k = generate_key(dimension, precision)
+    batch = Batch(4, precision)
+    cts = [encrypt(k, random.randrange(2), precision) for _ in range(8)]
+    a, b = batch.stack(cts[:4]), batch.stack(cts[4:])
+    assert batch.unstack(a) == cts[:4]
+    assert batch.unstack(multiply_ciphertexts(a, b, batch)) == [
+        multiply_ciphertexts(x, y, precision) for x, y in zip(cts[:4], cts[4:])
+    ]
+    assert batch.unstack(_xor(a, b, batch)) == [
+        _xor(x, y, precision) for x, y in zip(cts[:4], cts[4:])
+    ]
+    values = [[random.randrange(8) for _ in range(3)] for _ in range(4)]
+    operands = [
+        batch.stack_encodings([binary_encrypt(k, v[i], 3, precision) for v in values])
+        for i in range(3)
+    ]
+    totals = batch.unstack_encodings(multi_add(operands, batch, bits=5))
+    assert [binary_decrypt(k, t, precision) for t in totals] == [sum(v) for v in values]
+
+
+@testcase("streaming_test", args=args)
+def streaming_test(*, dimension, precision):
+    k = generate_key(dimension, precision)
+    values = [random.randrange(16) for _ in range(6)]
+    encrypted = encrypt_stream(k, iter(values), 4, precision, chunk_size=4, processes=2)
+    assert list(decrypt_stream(k, encrypted, precision)) == values
+
+
+# Multiplication goes through gadget_multiply, which doesn't use the matrix
+# backends, so this checks the operations that still do: products of matrices
+# and vectors, and encrypt and decrypt, which are built on them
+@testcase("backend_test", args=args)
+def backend_test(*, dimension, precision):
+    k = generate_key(dimension, precision)
+    A = [[random.randrange(-4, 2**precision) for _ in range(6)] for _ in range(3)]
+    B = [[random.randrange(-4, 2**precision) for _ in range(5)] for _ in range(6)]
+    state = random.getstate()
+    expected = (
+        matrix_multiply(A, B, precision),
+        vector_matrix_multiply(A[0], B, precision),
+        encrypt(k, 1, precision),
+    )
+    previous = set_backend("packed")
+    try:
+        assert matrix_multiply(A, B, precision) == expected[0]
+        assert vector_matrix_multiply(A[0], B, precision) == expected[1]
+        # The same randomness gives the same ciphertext
+        random.setstate(state)
+        assert encrypt(k, 1, precision) == expected[2]
+        assert decrypt(k, expected[2], precision) == 1
+        x = binary_encrypt(k, 5, 3, precision)
+        y = binary_encrypt(k, 6, 3, precision)
+        assert binary_decrypt(k, encoded_add(x, y, precision), precision) == 11
+    finally:
+        set_backend(previous)
+
+
+@testcase("gadget_test", args=args)
+def gadget_test(*, dimension, precision):
+    for rows, n, p in [(2, 3, 7), (3, 2, 13), (dimension, dimension, precision)]:
+        A = [[random.randrange(-4, 2**p) for _ in range(n * p)] for _ in range(rows)]
+        B = [[random.randrange(-4, 2**p) for _ in range(n * p)] for _ in range(n)]
+        expected = matrix_multiply(A, bitify(B, p), p)
+        assert gadget_multiply(A, packed_bitify(B, p), p) == expected
+
+
+@testcase("gadget_base_test", args=args)
+def gadget_base_test(*, dimension, precision):
+    for gadget in [
+        Gadget(precision, 4),
+        Gadget(precision, 4, True),
+        Gadget(13, 8, True),
+    ]:
+        B = [[random.randrange(-4, 2**gadget) for _ in range(5)] for _ in range(3)]
+        digits = bitify(B, gadget)
+        powers = generate_powers_matrix(3, gadget)
+        assert matrix_multiply(powers, digits, gadget) == [
+            [x % 2**gadget for x in row] for row in B
+        ]
+        A = [
+            [random.randrange(2**gadget) for _ in range(len(digits))] for _ in range(2)
+        ]
+        expected = matrix_multiply(A, digits, gadget)
+        assert gadget_multiply(A, packed_bitify(B, gadget), gadget) == expected
+    gadget = Gadget(precision, 4, True)
+    k = generate_key(dimension, gadget)
+    one, zero = encrypt(k, 1, gadget), encrypt(k, 0, gadget)
+    assert len(one[0]) == dimension * precision // 4
+    assert decrypt(k, _xor(one, zero, gadget), gadget) == 1
+    x, y = binary_encrypt(k, 5, 3, gadget), binary_encrypt(k, 3, 3, gadget)
+    assert binary_decrypt(k, encoded_add(x, y, gadget), gadget) == 8
+    [report] = noise_report(dimension, [gadget], trials=1, max_depth=3)
+    assert report["width"] == len(one[0]) and report["depth"] == 3
+    try:
+        Batch(2, gadget)
+        assert False
+    except ValueError:
+        pass
+
+
+@testcase("encrypt_many_test", args=args)
+def encrypt_many_test(*, dimension, precision):
+    for gadget in [precision, Gadget(precision, 4, True)]:
+        k = generate_key(dimension, gadget)
+        values = [random.randrange(2) for _ in range(12)]
+        cts = encrypt_many(k, values, gadget)
+        assert [decrypt(k, ct, gadget) for ct in cts] == values
+        assert max(get_error(k, ct, gadget) for ct in cts) < 16
+        product = multiply_ciphertexts(cts[0], cts[1], gadget)
+        assert decrypt(k, product, gadget) == values[0] & values[1]
+        integers = [random.randrange(16) for _ in range(3)]
+        encodings = binary_encrypt_many(k, integers, 4, gadget)
+        assert [binary_decrypt(k, e, gadget) for e in encodings] == integers
+
+
 def test():
     basic_test()
 
@@ -182,6 +372,22 @@ def test():
 
     less_simple_addition_test()
 
+    instrumentation_test()
+
+    copies_test()
+
+    batch_test()
+
+    streaming_test()
+
+    backend_test()
+
+    gadget_test()
+
+    gadget_base_test()
+
+    encrypt_many_test()
+
 
 if __name__ == "__main__":
     test()
@@ -0,0 +1,268 @@
+# Batch evaluation: run one circuit over many independent records at once.
+#
+# A CiphertextBatch holds the same bit of `count` records (eg. bit 3 of the first
+# operand of every record), stacked into one packed vector of count * length
+# slots, record r in slots r*length ... (r+1)*length - 1. It has the same
+# interface as a ciphertext for the adders in homomorphic_encryption.py:
+# - `+` (XOR) and flip() are one big integer operation for the whole batch
+# - AND goes through BatchKey, which stands in for the transit key (see the
+#   `multiply` hook in multiply_ciphertexts). It walks the transit key once per
+#   gate instead of once per record, and shares the work of summing up digits
+#   between the records (see multiply_batches)
+# So encoded_add(a, b, BatchKey(tk)) on batches is one gate evaluation per gate
+# of the circuit, whatever the number of records, and the same goes for circuits
+# traced with circuit.py and run with a BatchKey. Outputs decrypt to the same
+# values as evaluating each record on its own.
+
+from dataclasses import dataclass, field
+import functools
+
+import instrumentation
+
+from homomorphic_encryption import (
+    ERROR_BITS,
+    GUARD_BITS,
+    Ciphertext,
+    Constant,
+    PLAIN_ZERO,
+    PackedVector,
+    add_noise,
+    bootstrap_encodings,
+    encoded_add,
+    materialize,
+    multi_add,
+    multiplication_noise,
+    pack_vector,
+    pad_encodings,
+    slot_mask,
+    slot_width,
+)
+
+
+# The same bit of `count` records. `length` is the length of one ciphertext
+@dataclass
+class CiphertextBatch:
+    values: PackedVector
+    length: int
+    precision: int
+    # The largest noise estimate of the records
+    noise: float = field(default=None, compare=False)
+
+    @property
+    def count(self):
+        return self.values.length // self.length
+
+    def __add__(self, other):
+        if isinstance(other, Constant):
+            return other + self
+        if instrumentation.active is not None:
+            instrumentation.active.count("additions")
+        assert self.length == other.length and self.precision == other.precision
+        return CiphertextBatch(
+            values=self.values + other.values,
+            length=self.length,
+            precision=self.precision,
+            noise=add_noise(self.noise, other.noise),
+        )
+
+    def flip(self):
+        return CiphertextBatch(
+            values=PackedVector(
+                self.values.slots ^ flip_mask(self.count, self.length, self.precision),
+                self.values.length,
+                self.precision,
+            ),
+            length=self.length,
+            precision=self.precision,
+            noise=self.noise,
+        )
+
+
+# 2**(precision - 1) in the first slot of every record
+@functools.lru_cache(maxsize=64)
+def flip_mask(count, length, precision):
+    block = slot_width(precision) * length
+    return sum(1 << (r * block) for r in range(count)) << (precision - 1)
+
+
+# Stack ciphertexts of one shape (one per record) into a batch
+def stack(cts):
+    length, precision = len(cts[0].values), cts[0].precision
+    size = slot_width(precision) // 8 * length
+    data = b"".join(
+        pack_vector(ct.values, precision).slots.to_bytes(size, "little") for ct in cts
+    )
+    noises = [ct.noise for ct in cts]
+    return CiphertextBatch(
+        values=PackedVector(
+            int.from_bytes(data, "little"), len(cts) * length, precision
+        ),
+        length=length,
+        precision=precision,
+        noise=None if None in noises else max(noises),
+    )
+
+
+# The ciphertexts of the records of a batch, packed
+def unstack(batch):
+    length, precision = batch.length, batch.precision
+    size = slot_width(precision) // 8 * length
+    data = batch.values.slots.to_bytes(size * batch.count, "little")
+    return [
+        Ciphertext(
+            values=PackedVector(
+                int.from_bytes(data[r : r + size], "little"), length, precision
+            ),
+            precision=precision,
+            noise=batch.noise,
+        )
+        for r in range(0, len(data), size)
+    ]
+
+
+# Stack one bit of every record. If it's the same constant for all of them it
+# stays a constant (so the gates it goes into are still folded), otherwise the
+# constants are replaced by noiseless encryptions
+def stack_bits(bits):
+    cts = [b for b in bits if not isinstance(b, Constant)]
+    if not cts:
+        if all(b == bits[0] for b in bits):
+            return bits[0]
+        raise ValueError("can't stack differing constants without a ciphertext")
+    return stack([materialize(b, cts[0]) for b in bits])
+
+
+def unstack_bits(bit, count):
+    return [bit] * count if isinstance(bit, Constant) else unstack(bit)
+
+
+# Turn one encoded integer per record into one encoding of batches, padding the
+# encodings to the same length with PLAIN_ZERO
+def stack_encodings(records):
+    records = pad_encodings(records, PLAIN_ZERO, max(len(r) for r in records))
+    return [stack_bits(bits) for bits in zip(*records)]
+
+
+# The inverse of stack_encodings: one encoded integer per record
+def unstack_encodings(encoding, count):
+    columns = [unstack_bits(bit, count) for bit in encoding]
+    return [[column[r] for column in columns] for r in range(count)]
+
+
+# Stands in for the transit key when the adders are run on batches
+class BatchKey:
+    def __init__(self, tk):
+        self.tk = tk
+
+    def multiply(self, b1, b2):
+        return multiply_batches(b1, b2, self.tk)
+
+
+# Window size for a batch of `count` records: a table costs 2**window additions
+# per window to build and saves about window/2 additions per window per record
+def batch_window(count):
+    return min(range(1, 9), key=lambda w: (2**w + count) / w)
+
+
+# The same as fused_multiply_ciphertexts on every record of two batches (the
+# outputs are identical), but each transit key component is only visited once
+# per gate. Its digits are read once and turned into window tables like the
+# ones of WindowTableCache (as plain integers, and only for this gate), which
+# are then shared by all records, so every record needs one addition per window
+# of its index instead of one per set bit. `window` defaults to batch_window
+@instrumentation.timed("multiply_batches")
+def multiply_batches(b1, b2, tk, window=None):
+    assert b1.length == b2.length and b1.precision == b2.precision
+    count, precision, mask = b1.count, b1.precision, 2**b1.precision - 1
+    instrumentation.count("multiplications", count)
+    window = window or batch_window(count)
+    shift, bits = precision - 1, range(ERROR_BITS + 1)
+    # The flattened values of every record
+    flat1, flat2 = [
+        [
+            [(x << b) & mask for x in values[r : r + b1.length] for b in bits]
+            for r in range(0, len(values), b1.length)
+        ]
+        for values in (b1.values.tolist(), b2.values.tolist())
+    ]
+    digit = tk.pairs[0][0].digits[0]
+    length, key_precision = len(digit.values), digit.precision
+    slots_mask = slot_mask(length, key_precision)
+    totals = [0] * count
+    # Every table entry is a sum of up to `window` digits. Count how many digits
+    # may have gone into the totals since they were last reduced
+    pending, terms, window_mask = 0, 0, 2**window - 1
+    for i in range(len(flat1[0])):
+        row = tk.pairs[i]
+        for j in range(i + 1):
+            digits = row[j].digit_slots()
+            # tables[k][v] is the sum of the digits of window k selected by the bits of v
+            tables = []
+            for start in range(0, len(digits), window):
+                entries = [0]
+                for d in digits[start : start + window]:
+                    entries += [entry + d for entry in entries]
+                tables.append(entries)
+            if pending + len(tables) * window >= 2**GUARD_BITS - 1:
+                totals = [total & slots_mask for total in totals]
+                pending = 0
+            pending += len(tables) * window
+            for r in range(count):
+                v1, v2 = flat1[r], flat2[r]
+                index = (v1[i] * v2[j]) >> shift
+                if j != i:
+                    index += (v2[i] * v1[j]) >> shift
+                index &= mask
+                total = totals[r]
+                for entries in tables:
+                    if index & window_mask:
+                        total += entries[index & window_mask]
+                        terms += 1
+                    index >>= window
+                totals[r] = total
+    instrumentation.count("digit_sums", terms)
+    size = slot_width(key_precision) // 8 * length
+    data = b"".join((total & slots_mask).to_bytes(size, "little") for total in totals)
+    return CiphertextBatch(
+        values=PackedVector(
+            int.from_bytes(data, "little"), count * length, key_precision
+        ),
+        length=length,
+        precision=key_precision,
+        noise=multiplication_noise(
+            b1.noise, b2.noise, b1.length, precision, digit.noise
+        ),
+    )
+
+
+# Batch versions of the circuits in homomorphic_encryption.py. They take and
+# return one encoded integer (or ciphertext) per record
+def batch_encoded_add(a, b, tk):
+    out = encoded_add(stack_encodings(a), stack_encodings(b), BatchKey(tk))
+    return unstack_encodings(out, len(a))
+
+
+# `records[r]` is the list of encoded integers that record r adds up
+def batch_multi_add(records, tk, bits=999999999999999):
+    values = [stack_encodings(operands) for operands in zip(*records)]
+    out = multi_add(values, PLAIN_ZERO, BatchKey(tk), bits)
+    return unstack_encodings(out, len(records))
+
+
+# Bootstrap a ciphertext of every record. Which key bits go into the sum depends
+# on the ciphertext, so bits that are constant for some records and not for
+# others become noiseless encryptions, and don't get folded
+@instrumentation.timed("bootstrap_batch", span=True)
+def batch_bootstrap(cts, bk, tk):
+    instrumentation.log("Bootstrapping {} ciphertexts".format(len(cts)))
+    encodings = [bootstrap_encodings(ct, bk) for ct in cts]
+    rows = max(len(e) for e in encodings)
+    padding = [PLAIN_ZERO] * bk.short_precision
+    encodings = [e + [padding] * (rows - len(e)) for e in encodings]
+    integers = [stack_encodings(records) for records in zip(*encodings)]
+    instrumentation.log("Adding {} integers".format(len(integers)))
+    total = multi_add(integers, PLAIN_ZERO, BatchKey(tk), bk.short_precision)
+    out = total[bk.short_precision - 1] + total[bk.short_precision - 2]
+    if isinstance(out, Constant):
+        out = out + stack([bk.zero] * len(cts))
+    return unstack(out)
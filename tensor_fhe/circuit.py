@@ -0,0 +1,256 @@
+# Tracing gate circuits into a DAG, and evaluating the DAG level by level on a
+# process pool.
+#
+# The adders in homomorphic_encryption.py only ever use `+` (XOR), `flip()` and
+# `_and`/`_or` on their inputs, so we can run them on Wire objects instead of
+# ciphertexts, with a Circuit in place of the transit key. This records every gate
+# instead of evaluating it. All AND gates at the same multiplicative depth are
+# independent of each other, so they can be evaluated in parallel; the additions
+# and flips in between are cheap and are done in the main process. Constant bits
+# are folded away while tracing and never become nodes.
+
+from dataclasses import dataclass
+import multiprocessing
+
+import instrumentation
+
+from homomorphic_encryption import (
+    BootstrappingKey,
+    Constant,
+    _and,
+    bootstrap,
+    match_precision,
+    encoded_add,
+    encoded_add3,
+    multi_add,
+)
+
+
+# A value inside a circuit
+@dataclass(eq=False)
+class Wire:
+    circuit: "Circuit"
+    index: int
+
+    # XOR
+    def __add__(self, other):
+        if isinstance(other, Constant):
+            return other + self
+        return self.circuit.node("add", self, self.circuit.wire(other))
+
+    def __radd__(self, other):
+        if isinstance(other, Constant):
+            return other + self
+        return self.circuit.node("add", self.circuit.wire(other), self)
+
+    def flip(self):
+        return self.circuit.node("flip", self)
+
+
+# A DAG of gates. Each node is (op, args) where op is one of
+# - "input": args is the ciphertext
+# - "add": XOR of two wires
+# - "flip": NOT of one wire
+# - "and": AND of two wires (the only gate that needs the transit key)
+# OR gates are recorded the way _or computes them, as a + b + and(a, b).
+# Nodes are only ever appended after their arguments, so node order is a valid
+# evaluation order
+class Circuit:
+    def __init__(self):
+        self.nodes = []
+        self.depths = []
+        self.input_wires = {}  # id(ciphertext) -> Wire
+
+    def node(self, op, *args):
+        if op == "input":
+            depth = 0
+        else:
+            depth = max(self.depths[a.index] for a in args) + (op == "and")
+        self.nodes.append((op, args))
+        self.depths.append(depth)
+        return Wire(self, len(self.nodes) - 1)
+
+    # The same ciphertext (eg. a shared encryption of zero) always maps to one wire
+    def input(self, ct):
+        if id(ct) not in self.input_wires:
+            self.input_wires[id(ct)] = self.node("input", ct)
+        return self.input_wires[id(ct)]
+
+    # Turns ciphertexts (or nested lists of them) into input wires. Constants are
+    # kept as they are
+    def inputs(self, cts):
+        if isinstance(cts, list):
+            return [self.inputs(c) for c in cts]
+        if isinstance(cts, Constant):
+            return cts
+        return self.wire(cts)
+
+    def wire(self, value):
+        if isinstance(value, Wire):
+            assert value.circuit is self
+            return value
+        return self.input(value)
+
+    # Called by multiply_ciphertexts when the circuit is passed as the transit key
+    def multiply(self, c1, c2):
+        return self.node("and", self.wire(c1), self.wire(c2))
+
+    # Indices of all nodes that the given wires depend on, in evaluation order
+    def needed(self, outputs):
+        needed, stack = set(), [w.index for w in flatten_wires(outputs)]
+        while stack:
+            i = stack.pop()
+            if i not in needed:
+                needed.add(i)
+                op, args = self.nodes[i]
+                if op != "input":
+                    stack.extend(a.index for a in args)
+        return sorted(needed)
+
+    # Multiplicative depth of the given outputs
+    def depth(self, outputs):
+        return max((self.depths[w.index] for w in flatten_wires(outputs)), default=0)
+
+    # AND gates needed for the given outputs, grouped by depth. All gates in one
+    # level can be evaluated at the same time
+    def levels(self, outputs):
+        levels = [[] for _ in range(self.depth(outputs))]
+        for i in self.needed(outputs):
+            if self.nodes[i][0] == "and":
+                levels[self.depths[i] - 1].append(i)
+        return levels
+
+    # Evaluate the circuit and return the values of `outputs` (a wire or a nested
+    # list of wires). AND gates are run on a pool of `processes` workers, each of
+    # which receives the transit key once when it starts. With processes=None or 1
+    # everything runs in this process. Passing a ModulusLadder as `tk` switches to
+    # lower precisions level by level, so the outputs may have lower precision
+    # than the inputs
+    @instrumentation.timed("circuit", span=True)
+    def run(self, outputs, tk, processes=None):
+        order = self.needed(outputs)
+        values = {}
+
+        def evaluate_cheap(max_depth):
+            for i in order:
+                op, args = self.nodes[i]
+                if i in values or op == "and" or self.depths[i] > max_depth:
+                    continue
+                if op == "input":
+                    values[i] = args[0]
+                elif op == "add":
+                    a, b = match_precision(values[args[0].index], values[args[1].index])
+                    values[i] = a + b
+                else:
+                    values[i] = values[args[0].index].flip()
+
+        pool = None
+        if processes is not None and processes > 1:
+            # The workers get their copy of a ModulusLadder now, so it needs all
+            # of its keys already
+            if hasattr(tk, "prepare"):
+                tk.prepare()
+            pool = multiprocessing.Pool(processes, _init_worker, (tk,))
+        levels = self.levels(outputs)
+        try:
+            for depth, level in enumerate(levels):
+                evaluate_cheap(depth)
+                pairs = [
+                    tuple(values[a.index] for a in self.nodes[i][1]) for i in level
+                ]
+                # A ModulusLadder lowers the precision as the depth gets used up
+                if hasattr(tk, "switch_pairs"):
+                    pairs = tk.switch_pairs(pairs, len(levels) - depth)
+                instrumentation.count("circuit_and_gates", len(pairs))
+                if pool is None:
+                    results = [_and(a, b, tk) for a, b in pairs]
+                else:
+                    chunksize = max(1, len(pairs) // (4 * processes))
+                    results = pool.map(_worker_and, pairs, chunksize)
+                values.update(zip(level, results))
+            evaluate_cheap(max(self.depths, default=0))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return map_wires(
+            outputs, lambda w: w if isinstance(w, Constant) else values[w.index]
+        )
+
+
+# Multiplicative depth and number of AND gates of a circuit function (eg.
+# encoded_multiply) on inputs of the given shapes: an int for an encoded integer
+# of that many bits, None for a single bit. Found by tracing it, so constant
+# folding is taken into account
+def circuit_cost(function, *shapes, **kwargs):
+    circuit = Circuit()
+    inputs = [
+        (
+            circuit.input(object())
+            if shape is None
+            else [circuit.input(object()) for _ in range(shape)]
+        )
+        for shape in shapes
+    ]
+    outputs = function(*inputs, circuit, **kwargs)
+    return circuit.depth(outputs), sum(map(len, circuit.levels(outputs)))
+
+
+# The wires in a nested list of outputs, skipping constants
+def flatten_wires(outputs):
+    if isinstance(outputs, (list, tuple)):
+        return [w for o in outputs for w in flatten_wires(o)]
+    return [] if isinstance(outputs, Constant) else [outputs]
+
+
+def map_wires(outputs, f):
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(map_wires(o, f) for o in outputs)
+    return f(outputs)
+
+
+# Each worker keeps its own copy of the transit key for its whole lifetime
+_worker_tk = None
+
+
+def _init_worker(tk):
+    global _worker_tk
+    _worker_tk = tk
+
+
+def _worker_and(pair):
+    return _and(pair[0], pair[1], _worker_tk)
+
+
+# Parallel versions of the circuits in homomorphic_encryption.py: trace the
+# circuit, then run it level by level
+def parallel_encoded_add(a, b, tk, processes=None):
+    circuit = Circuit()
+    out = encoded_add(circuit.inputs(a), circuit.inputs(b), circuit)
+    return circuit.run(out, tk, processes)
+
+
+def parallel_encoded_add3(a, b, c, tk, processes=None):
+    circuit = Circuit()
+    a, b, c = circuit.inputs([a, b, c])
+    out = encoded_add3(a, b, c, circuit)
+    return circuit.run(out, tk, processes)
+
+
+def parallel_multi_add(values, zero, tk, bits=999999999999999, processes=None):
+    circuit = Circuit()
+    out = multi_add(circuit.inputs(values), circuit.inputs(zero), circuit, bits)
+    return circuit.run(out, tk, processes)
+
+
+def parallel_bootstrap(ct, bk, tk, processes=None):
+    circuit = Circuit()
+    traced_bk = BootstrappingKey(
+        values=circuit.inputs(bk.values),
+        zero=circuit.input(bk.zero),
+        one=circuit.input(bk.one),
+        short_precision=bk.short_precision,
+        long_precision=bk.long_precision,
+    )
+    out = bootstrap(ct, traced_bk, circuit)
+    return circuit.run(out, tk, processes)
@@ -1,11 +1,25 @@
 # A toy homomorphic encryption implementation, based on
 # https://eprint.iacr.org/2012/078.pdf
 
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import functools
+import math
+import hashlib
+import multiprocessing
 import random
+import sys
+import time
+
+import instrumentation
 
 ERROR_BITS = 6
 
+# Packed vectors store every value in its own slot of one big integer. Slots have
+# GUARD_BITS spare bits above the precision, so up to 2**GUARD_BITS - 1 vectors
+# can be added up before carries could spill into the neighbouring slot
+GUARD_BITS = 16
+
 
 # Returns the bit length of n, eg. 6 -> 110 -> 3, 31 -> 11111 -> 5, 32 -> 100000 -> 6
 def bit_length(n):
@@ -18,64 +32,432 @@ def random_vector(l, precision):
 
 
 # Generates a noise value within some small range
-def noise():
-    return random.randrange(-(2**ERROR_BITS), ERROR_BITS)
+def noise(rng=random):
+    return rng.randrange(-(2**ERROR_BITS), ERROR_BITS)
+
+
+# Noise tracking. Every ciphertext carries an estimate of the size of its error e
+# (its root mean square, in units of 1), computed from the noise of its inputs
+# without the secret key. Decryption is correct while |e| < q/4, so the estimate
+# tells us how many more gates a ciphertext can go through before it has to be
+# bootstrapped. Estimates are kept pessimistic: errors of ciphertexts that are
+# added are assumed to be fully correlated, so they add up linearly
+NOISE_RANGE = range(-(2**ERROR_BITS), ERROR_BITS)
+FRESH_NOISE = math.sqrt(sum(e * e for e in NOISE_RANGE) / len(NOISE_RANGE))
+# noise() is not centered, so sums of many independent fresh errors grow like
+# their count times the mean plus the square root of their count times the spread
+NOISE_MEAN = abs(sum(NOISE_RANGE) / len(NOISE_RANGE))
+NOISE_SPREAD = math.sqrt(FRESH_NOISE**2 - NOISE_MEAN**2)
+
+# How many times the estimate the error can be before we consider it too large
+NOISE_SIGMAS = 6
+
+
+def add_noise(*noises):
+    return None if None in noises else sum(noises)
+
+
+# Noise of the product of ciphertexts with noise n1 and n2 and `length` values.
+# With c.s = m*q/2 + e + w*q (w counts how often the inner product wraps around q,
+# about dim/4 for the flattened ciphertexts), (c1.s)*(c2.s)/(q/2) has error
+# (2*w2 + 1)*e1 + (2*w1 + 1)*e2 + 2*e1*e2/q, plus rounding the dim**2 products to
+# integers, plus the noise of the transit key digits used (on average half of the
+# `precision` digits for each of the dim*(dim+1)/2 components). `key_noise` is the
+# noise of the digits if they are not fresh encryptions (see truncate_transit_key);
+# their error then comes from rounding, which always goes the same way
+def multiplication_noise(n1, n2, length, precision, key_noise=None):
+    if n1 is None or n2 is None:
+        return None
+    dim = length * (ERROR_BITS + 1)
+    digits = dim * (dim + 1) // 2 * precision / 2
+    return (
+        (dim / 2 + 1) * (n1 + n2)
+        + n1 * n2 / 2 ** (precision - 1)
+        + dim * dim / 4
+        + digit_sum_noise(digits, key_noise)
+    )
+
+
+# Noise of a sum of `digits` key digits with noise `key_noise` (None for fresh
+# encryptions, whose errors are independent)
+def digit_sum_noise(digits, key_noise=None):
+    if key_noise is None or key_noise <= FRESH_NOISE:
+        return NOISE_MEAN * digits + NOISE_SPREAD * math.sqrt(digits)
+    return key_noise * digits
+
+
+# Noise after adjust_ciphertext_precision: rounding each value changes c.s by up
+# to the key value, which is at most 2**(ERROR_BITS + 1)
+def adjusted_noise(n, length, old_precision, new_precision):
+    if n is None:
+        return None
+    if new_precision >= old_precision:
+        return n * 2 ** (new_precision - old_precision)
+    rounding = math.sqrt(length) * 2**ERROR_BITS
+    return n / 2 ** (old_precision - new_precision) + rounding
+
+
+# Bits of error the estimate allows for, comparable to error_bits
+def noise_bits(ct):
+    if isinstance(ct, Constant):
+        return 0
+    return bit_length(math.ceil(NOISE_SIGMAS * ct.noise))
+
+
+# Largest estimated noise that still leaves `margin` bits below q/4
+def noise_limit(precision, margin=0):
+    return 2 ** (precision - 2 - margin) / NOISE_SIGMAS
+
+
+# Whether the estimated error is close enough to q/4 that decryption may fail.
+# `margin` bits of room are kept, eg. for the gates about to be applied
+def noise_exceeded(ct, margin=0):
+    if isinstance(ct, Constant) or ct.noise is None:
+        return False
+    return ct.noise >= noise_limit(ct.precision, margin)
+
+
+# Width of one slot of a packed vector, rounded up to whole bytes so that
+# packing and unpacking can go through int.to_bytes / int.from_bytes
+def slot_width(precision):
+    return -(-(precision + GUARD_BITS) // 8) * 8
+
+
+# 2**precision - 1 repeated in each of `length` slots. Masking a packed sum with
+# this reduces every slot modulo 2**precision at once
+@functools.lru_cache(maxsize=None)
+def slot_mask(length, precision):
+    width = slot_width(precision)
+    return (2**precision - 1) * ((2 ** (width * length) - 1) // (2**width - 1))
+
+
+# A vector of values mod 2**precision packed into the slots of a single integer
+# (value i sits at bit i * slot_width(precision)). Addition of two packed vectors
+# is one big integer addition plus a mask instead of a Python loop. Supports
+# len(), iteration and indexing, so it can be used anywhere a list of values is
+class PackedVector:
+    __slots__ = ("slots", "length", "precision")
+
+    def __init__(self, slots, length, precision):
+        self.slots = slots
+        self.length = length
+        self.precision = precision
+
+    @classmethod
+    def from_list(cls, values, precision):
+        size, mask = slot_width(precision) // 8, 2**precision - 1
+        data = b"".join((x & mask).to_bytes(size, "little") for x in values)
+        return cls(int.from_bytes(data, "little"), len(values), precision)
+
+    def tolist(self):
+        size = slot_width(self.precision) // 8
+        data = self.slots.to_bytes(size * self.length, "little")
+        return [
+            int.from_bytes(data[i : i + size], "little")
+            for i in range(0, len(data), size)
+        ]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.tolist()[index]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("packed vector index out of range")
+        width = slot_width(self.precision)
+        return (self.slots >> (index * width)) & (2**self.precision - 1)
+
+    def __eq__(self, other):
+        if isinstance(other, PackedVector):
+            return (self.slots, self.length, self.precision) == (
+                other.slots,
+                other.length,
+                other.precision,
+            )
+        return self.tolist() == list(other)
+
+    def __add__(self, other):
+        assert self.precision == other.precision and self.length == other.length
+        return PackedVector(
+            (self.slots + other.slots) & slot_mask(self.length, self.precision),
+            self.length,
+            self.precision,
+        )
+
+    def __repr__(self):
+        return "PackedVector({}, precision={})".format(self.tolist(), self.precision)
+
+
+# PRG for seed-compressed ciphertexts: the random values in slots 1..length-1 of
+# a packed vector (slot 0 is left as zero), generated from a 128 bit seed with
+# SHAKE-128, so that anyone can expand the same seed into the same values
+def expand_seed(seed, length, precision):
+    size = slot_width(precision) // 8
+    stream = hashlib.shake_128(seed.to_bytes(16, "little")).digest((length - 1) * size)
+    return (int.from_bytes(stream, "little") & slot_mask(length - 1, precision)) << (
+        size * 8
+    )
+
+
+# A packed vector whose values after the first are expand_seed(seed, ...), so it
+# only needs to store the first value and the seed. Fresh encryptions have this
+# form, since all but their first value are uniformly random. The full vector is
+# computed when `slots` is first needed, and kept if `cache` is set
+class SeededVector(PackedVector):
+    __slots__ = ("first", "seed", "cache", "expanded")
+
+    def __init__(self, first, seed, length, precision, cache=True):
+        self.first, self.seed, self.cache, self.expanded = first, seed, cache, None
+        self.length = length
+        self.precision = precision
+
+    @property
+    def slots(self):
+        if self.expanded is not None:
+            return self.expanded
+        slots = expand_seed(self.seed, self.length, self.precision) | self.first
+        if self.cache:
+            self.expanded = slots
+        return slots
+
+    def __getitem__(self, index):
+        if index == 0:
+            return self.first
+        return super().__getitem__(index)
+
+    # Pickle in compressed form
+    def __reduce__(self):
+        return (
+            SeededVector,
+            (self.first, self.seed, self.length, self.precision, self.cache),
+        )
+
+
+# Expand seed-compressed ciphertexts into ordinary packed ones, eg. after
+# receiving them
+def expand_ciphertexts(cts):
+    return [
+        Ciphertext(
+            values=PackedVector(c.values.slots, c.values.length, c.precision),
+            precision=c.precision,
+            noise=c.noise,
+        )
+        for c in cts
+    ]
+
+
+def pack_vector(values, precision):
+    if isinstance(values, PackedVector):
+        return values
+    return PackedVector.from_list(values, precision)
+
+
+# Add up many packed vectors, masking only as often as the guard bits require
+def sum_packed_vectors(vectors):
+    L, p = vectors[0].length, vectors[0].precision
+    mask, chunk = slot_mask(L, p), 2**GUARD_BITS - 1
+    total = 0
+    for i in range(0, len(vectors), chunk):
+        total = (total + sum(v.slots for v in vectors[i : i + chunk])) & mask
+    return PackedVector(total, L, p)
+
+
+# For every bit position b, the mask selecting the slots i where bit b of
+# weights[i] is set. Cached, since we mostly take inner products with a key
+@functools.lru_cache(maxsize=256)
+def bit_plane_masks(weights, precision):
+    width, slot = slot_width(precision), 2**precision - 1
+    return [
+        sum(slot << (i * width) for i, w in enumerate(weights) if (w >> b) % 2)
+        for b in range(bit_length(max(weights, default=0)))
+    ]
+
+
+# Sum of all slots of a packed integer, by repeatedly folding the top half
+# of the slots onto the bottom half. Needs length < 2**GUARD_BITS
+def horizontal_sum(slots, length, width):
+    while length > 1:
+        half = (length + 1) // 2
+        slots = (slots & ((1 << (half * width)) - 1)) + (slots >> (half * width))
+        length = half
+    return slots
+
+
+# Inner product of a packed vector with a vector of integers. Split the weights
+# into bit planes: vec.weights = sum(2**b * (sum of vec[i] where bit b of weights[i]
+# is set)), and each inner sum is one mask and a few folds of the packed integer
+def packed_prod(vec, weights, precision):
+    mask, width = 2**precision - 1, slot_width(vec.precision)
+    weights = tuple(weights)[: len(vec)]
+    if weights and (min(weights) < 0 or max(weights) > mask):
+        weights = tuple(x & mask for x in weights)
+    return (
+        sum(
+            horizontal_sum(vec.slots & plane, len(vec), width) << b
+            for b, plane in enumerate(bit_plane_masks(weights, vec.precision))
+        )
+        & mask
+    )
 
 
 # Inner product of two vectors, that is compute sum(vec1[i] * vec2[i]).
 # Note that it is done modulo 2**precision.
 def prod(vec1, vec2, precision):
+    if isinstance(vec1, PackedVector):
+        return packed_prod(vec1, vec2, precision)
+    if isinstance(vec2, PackedVector):
+        return packed_prod(vec2, vec1, precision)
     return sum([i * j for i, j in zip(vec1, vec2)]) & (2**precision - 1)
 
 
-# Generates a private key. The first value must always be 1.
-def generate_key(length, precision):
+# Generates a private key from `rng` (the global generator by default). The
+# first value must always be 1.
+def generate_key(length, precision, rng=None):
+    rng = rng or random
     return [1] + [
-        (2**ERROR_BITS + noise()) & (2**precision - 1) for _ in range(1, length)
+        (2**ERROR_BITS + noise(rng)) & (2**precision - 1) for _ in range(1, length)
     ]
 
 
 # A ciphertext representing some value m in {0,1}. A ciphertext is a
 # vector v where v . k = m * q/2 + e where . is the inner product,
-# q is the modulus (2**precision) and e is the error
+# q is the modulus (2**precision) and e is the error.
+# `values` is either a list of ints or a PackedVector; the two can be mixed freely
 @dataclass
 class Ciphertext:
-    values: list  # [int]
+    values: list  # [int] or PackedVector
     precision: int
+    # Estimated size of the error, see FRESH_NOISE. None if not known, eg. for
+    # ciphertexts read from a file
+    noise: float = field(default=None, compare=False)
+
+    def __post_init__(self):
+        if instrumentation.active is not None:
+            instrumentation.active.count("ciphertexts")
 
     # Add together two ciphertexts into one, linearly adding together the values
     # Note that this combines the magnitudes of the error, so if you add waaaaay
     # too many times the error may overflow
     def __add__(self, other):
+        if isinstance(other, Constant):
+            return other + self
+        if instrumentation.active is not None:
+            instrumentation.active.count("additions")
         assert self.precision == other.precision and len(self.values) == len(
             other.values
         )
+        if isinstance(self.values, PackedVector) or isinstance(
+            other.values, PackedVector
+        ):
+            return Ciphertext(
+                values=pack_vector(self.values, self.precision)
+                + pack_vector(other.values, self.precision),
+                precision=self.precision,
+                noise=add_noise(self.noise, other.noise),
+            )
         return Ciphertext(
             values=[
                 (x + y) & (2**self.precision - 1)
                 for x, y in zip(self.values, other.values)
             ],
             precision=self.precision,
+            noise=add_noise(self.noise, other.noise),
         )
 
     # Convert 0 to 1 or 1 to 0
     def flip(self):
+        if isinstance(self.values, PackedVector):
+            # The first value lives in the lowest slot
+            return Ciphertext(
+                values=PackedVector(
+                    self.values.slots ^ (2 ** (self.precision - 1)),
+                    self.values.length,
+                    self.precision,
+                ),
+                precision=self.precision,
+                noise=self.noise,
+            )
         new_first_value = self.values[0] ^ (2 ** (self.precision - 1))
         return Ciphertext(
-            values=new_first_value + self.values[1:], precision=self.precision
+            values=[new_first_value] + self.values[1:],
+            precision=self.precision,
+            noise=self.noise,
         )
 
 
+# A bit whose value is public, eg. the zero padding of an encoded integer. Gates
+# with a constant input are folded away (XOR with a constant is either nothing or
+# a flip, AND with 0 is 0, OR with 1 is 1, ...), so they never touch the transit
+# key and add no noise. Constants can be mixed with ciphertexts (or circuit wires)
+# anywhere the adders take bits
+@dataclass(frozen=True)
+class Constant:
+    value: int
+
+    def __add__(self, other):
+        if isinstance(other, Constant):
+            return Constant(self.value ^ other.value)
+        return other.flip() if self.value else other
+
+    __radd__ = __add__
+
+    def flip(self):
+        return Constant(1 - self.value)
+
+
+PLAIN_ZERO = Constant(0)
+PLAIN_ONE = Constant(1)
+
+
+# Noiseless encryption of a constant with the same shape as `like`, valid under
+# any key (since key[0] == 1). Ciphertexts are returned as they are
+def materialize(bit, like):
+    if not isinstance(bit, Constant):
+        return bit
+    values = [bit.value << (like.precision - 1)] + [0] * (len(like.values) - 1)
+    if isinstance(like.values, PackedVector):
+        values = PackedVector.from_list(values, like.precision)
+    return Ciphertext(values=values, precision=like.precision, noise=0)
+
+
+# Convert between the list and packed representations of a ciphertext
+def pack_ciphertext(ct):
+    return Ciphertext(
+        values=pack_vector(ct.values, ct.precision),
+        precision=ct.precision,
+        noise=ct.noise,
+    )
+
+
+def unpack_ciphertext(ct):
+    return Ciphertext(values=list(ct.values), precision=ct.precision, noise=ct.noise)
+
+
 # Add together more than 2 ciphertexts
 def sum_ciphertexts(ciphertexts):
     assert len(ciphertexts) >= 1
     L, p = len(ciphertexts[0].values), ciphertexts[0].precision
     for c in ciphertexts[1:]:
         assert c.precision == p and len(c.values) == L
+    noise = add_noise(*[c.noise for c in ciphertexts])
+    instrumentation.count("additions", len(ciphertexts) - 1)
+    if any(isinstance(c.values, PackedVector) for c in ciphertexts):
+        return Ciphertext(
+            values=sum_packed_vectors([pack_vector(c.values, p) for c in ciphertexts]),
+            precision=p,
+            noise=noise,
+        )
     mask = (2**p) - 1
     return Ciphertext(
         values=[sum([c.values[i] for c in ciphertexts]) & mask for i in range(L)],
         precision=p,
+        noise=noise,
     )
 
 
@@ -85,36 +467,181 @@ class PublicKey:
     samples: list  # [Ciphertext]
 
 
-def mk_public_key(key, q):
+# An encryption sums up to all of the samples, so their noise together has to stay
+# below noise_limit. At 12 bits only a handful fit, too few for a public key
+def check_public_key_noise(samples, sample_noise, precision):
+    if sample_noise is not None and samples * sample_noise > noise_limit(precision):
+        raise ValueError(
+            "{} bit precision is too small for a public key of {} samples".format(
+                precision, samples
+            )
+        )
+
+
+def mk_public_key(key, q, packed=False, rng=None, samples=100):
+    check_public_key_noise(samples, FRESH_NOISE, q)
+    return PublicKey(samples=partial_encrypt_many(key, [0] * samples, q, packed, rng))
+
+
+# Public key encryption: a random subset sum of the samples (encryptions of zero)
+# is an encryption of zero under the same key, and adding m*q/2 to its first value
+# makes it an encryption of m. Anyone with the public key can encrypt this way
+def encrypt_pk(pk, message, packed=False, rng=None):
+    return encrypt_pk_many(pk, [message], packed, rng)[0]
+
+
+# Encrypt many values with a public key. All the subset sums are taken at once
+# with window tables (the Method of Four Russians): the samples are cut into
+# windows of `window`, and for each window the sums of all 2**window subsets are
+# computed once, as packed integers. Every ciphertext is then one table lookup
+# and addition per window, instead of one addition per sample in its subset
+def encrypt_pk_many(pk, messages, packed=False, rng=None, window=8):
+    rng = rng or random
+    sample = pk.samples[0]
+    length, precision = len(sample.values), sample.precision
+    instrumentation.count("encryptions", len(messages))
+    slots = [pack_vector(c.values, precision).slots for c in pk.samples]
+    tables = []
+    for start in range(0, len(slots), window):
+        entries = [0]
+        for x in slots[start : start + window]:
+            entries += [entry + x for entry in entries]
+        tables.append(entries)
+    # Every entry is a sum of at most `window` samples, so this many table
+    # entries can be added before the guard bits could overflow
+    assert len(tables) * window < 2**GUARD_BITS
+    noises = [c.noise for c in pk.samples]
+    sample_noise = None if None in noises else max(noises)
+    check_public_key_noise(len(slots), sample_noise, precision)
+    mask, window_mask = slot_mask(length, precision), 2**window - 1
     o = []
-    for i in range(100):
-        rv = random_vector(len(key) - 1, q)
-        canceling_value = -prod(rv, key[1:], q) % q
-        o.append(Ciphertext([(noise() + canceling_value) % q] + rv, q))
-    return PublicKey(samples=o)
+    for message in messages:
+        subset = rng.getrandbits(len(slots))
+        total = message << (precision - 1)
+        for k, entries in enumerate(tables):
+            total += entries[(subset >> (k * window)) & window_mask]
+        values = PackedVector(total & mask, length, precision)
+        noise = None if sample_noise is None else bin(subset).count("1") * sample_noise
+        o.append(
+            Ciphertext(
+                values=values if packed else values.tolist(),
+                precision=precision,
+                noise=noise,
+            )
+        )
+    return o
 
 
 # Encrypt a value
-def encrypt(key, message, precision):
-    return partial_encrypt(key, message * 2 ** (precision - 1), precision)
+def encrypt(key, message, precision, packed=False):
+    return partial_encrypt(key, message * 2 ** (precision - 1), precision, packed)
 
 
 # Partially encrypt a value, assuming it's already in rescaled form
 # (ie. 0 for a normal 0 and q/2 for a normal 1). Used directly when
 # encrypting key shares for relinerization
-def partial_encrypt(key, message, precision):
+def partial_encrypt(key, message, precision, packed=False):
     assert key[0] == 1
     for k in key:
         assert k <= 2 ** (ERROR_BITS + 1)
+    instrumentation.count("encryptions")
     rv = random_vector(len(key) - 1, precision)
     # -k[1:].v[1:]. Adding this value in as v[0] ensures that
     # v[0] + k[1:].v[1:] = k[0]*v[0] + k[1:].v[1:] = k.v equals the desired message
     canceling_value = -prod(rv, key[1:], precision)
-    return Ciphertext(
-        [(noise() + canceling_value + message) & (2**precision - 1)] + rv, precision
+    values = [(noise() + canceling_value + message) & (2**precision - 1)] + rv
+    if packed:
+        values = PackedVector.from_list(values, precision)
+    return Ciphertext(values, precision, FRESH_NOISE)
+
+
+# Encrypt many values, see partial_encrypt_many
+def encrypt_many(key, messages, precision, packed=False, rng=None, compressed=False):
+    return partial_encrypt_many(
+        key,
+        [m * 2 ** (precision - 1) for m in messages],
+        precision,
+        packed,
+        rng,
+        compressed=compressed,
     )
 
 
+# Partially encrypt many values at once. Equivalent to calling partial_encrypt on
+# each, but:
+# - all randomness comes in bulk from `rng` (a random.Random, so keys can be made
+#   reproducible by seeding it; defaults to the global generator)
+# - the random vectors are drawn column by column, as packed vectors with one slot
+#   per message. The canceling values -R.k[1:] for all messages are then a sum of
+#   len(key)-1 packed columns each scaled by one key value, ie. one matrix-vector
+#   product done as a handful of big integer operations
+# Messages are processed in batches of `batch_size`. With `compressed` set, the
+# ciphertexts are seed-compressed instead, see partial_encrypt_compressed
+def partial_encrypt_many(
+    key, messages, precision, packed=False, rng=None, batch_size=1024, compressed=False
+):
+    assert key[0] == 1
+    for k in key:
+        assert k <= 2 ** (ERROR_BITS + 1)
+    rng = rng or random
+    if compressed:
+        return partial_encrypt_compressed(key, messages, precision, rng)
+    instrumentation.count("encryptions", len(messages))
+    o = []
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start : start + batch_size]
+        n, mask = len(batch), slot_mask(len(batch), precision)
+        size = slot_width(precision) // 8
+        columns = [rng.getrandbits(n * size * 8) & mask for _ in key[1:]]
+        # Each slot holds at most (sum of key values added so far) * 2**precision,
+        # so reduce before that can overflow the guard bits
+        canceling, bound = 0, 0
+        for k, column in zip(key[1:], columns):
+            if bound + k >= 2**GUARD_BITS:
+                canceling, bound = canceling & mask, 1
+            canceling, bound = canceling + k * column, bound + k
+        # 2**precision - x in every slot, ie. -x mod 2**precision
+        negated = (mask + (mask // (2**precision - 1)) - (canceling & mask)) & mask
+        noises = rng.choices(range(-(2**ERROR_BITS), ERROR_BITS), k=n)
+        first = (
+            negated
+            + PackedVector.from_list(batch, precision).slots
+            + PackedVector.from_list(noises, precision).slots
+        ) & mask
+        # Transpose: ciphertext m is slot m of `first` followed by slot m of each column
+        data = [c.to_bytes(n * size, "little") for c in [first] + columns]
+        for m in range(0, n * size, size):
+            row = [d[m : m + size] for d in data]
+            if packed:
+                values = PackedVector(
+                    int.from_bytes(b"".join(row), "little"), len(key), precision
+                )
+            else:
+                values = [int.from_bytes(x, "little") for x in row]
+            o.append(Ciphertext(values, precision, FRESH_NOISE))
+    return o
+
+
+# Partially encrypt values into seed-compressed ciphertexts: the random values of
+# each ciphertext are expand_seed(seed) for a fresh 128 bit seed from `rng`, and
+# only the first value and the seed are stored (see SeededVector). This makes
+# them about len(key) times smaller to store or send
+def partial_encrypt_compressed(key, messages, precision, rng=None):
+    rng = rng or random
+    instrumentation.count("encryptions", len(messages))
+    mask, length = 2**precision - 1, len(key)
+    noises = rng.choices(range(-(2**ERROR_BITS), ERROR_BITS), k=len(messages))
+    o = []
+    for message, e in zip(messages, noises):
+        seed = rng.getrandbits(128)
+        tail = PackedVector(expand_seed(seed, length, precision), length, precision)
+        # The first slot of the tail is 0, so this is k[1:].v[1:]
+        first = (e + message - packed_prod(tail, key, precision)) & mask
+        values = SeededVector(first, seed, length, precision)
+        o.append(Ciphertext(values, precision, FRESH_NOISE))
+    return o
+
+
 # Partially decrypt a ciphertext, providing the output (0 or 1) plus noise (e)
 # Useful mainly for debugging
 def partial_decrypt(key, ciphertext):
@@ -131,34 +658,351 @@ def error_bits(key, ciphertext):
 
 # Decrypt a ciphertext, outputting the message 0 or 1
 def decrypt(key, ciphertext):
+    if isinstance(ciphertext, Constant):
+        return ciphertext.value
     values, p = ciphertext.values, ciphertext.precision
     return 1 if (2 ** (p - 2) < prod(values, key, p) <= 3 * 2 ** (p - 2)) else 0
 
 
+# A trivial (noiseless) encryption of zero with the same shape as `ct`
+def zero_like(ct):
+    if isinstance(ct.values, PackedVector):
+        return Ciphertext(
+            values=PackedVector(0, len(ct.values), ct.precision),
+            precision=ct.precision,
+        )
+    return Ciphertext(values=[0] * len(ct.values), precision=ct.precision)
+
+
+# Rough in-memory size of a ciphertext, in bytes
+def ciphertext_nbytes(ct):
+    if isinstance(ct.values, PackedVector):
+        return sys.getsizeof(ct.values.slots)
+    return sys.getsizeof(ct.values) + sum(sys.getsizeof(x) for x in ct.values)
+
+
 # A transit key component contains
 @dataclass
 class TransitKeyComponent:
     digits: list  # [[ciphertext]]
 
-    def get_combination_for(self, index):
+    def get_combination_for(self, index, window_cache=None):
         if index:
-            return sum_ciphertexts(
-                [
-                    self.digits[power]
-                    for power in range(len(self.digits))
-                    if (index >> power) % 2 == 1
-                ]
-            )
+            terms = self.combination_terms(index, window_cache)
+            instrumentation.count("digit_sums", len(terms))
+            return sum_ciphertexts(terms)
         else:
-            return Ciphertext(
-                values=[0] * len(self.digits[0].values),
-                precision=self.digits[0].precision,
-            )
+            return zero_like(self.digits[0])
+
+    # The ciphertexts that add up to get_combination_for(index)
+    def combination_terms(self, index, window_cache=None):
+        if index and window_cache is not None:
+            table = window_cache.table_for(self)
+            if table is not None:
+                return window_cache.combination_terms(table, index)
+        return [
+            self.digits[power]
+            for power in range(len(self.digits))
+            if (index >> power) % 2 == 1
+        ]
+
+    # Add the terms of get_combination_for(index) to a CiphertextAccumulator,
+    # returning how many there were
+    def add_combination(self, acc, index, window_cache=None):
+        terms = self.combination_terms(index, window_cache)
+        for term in terms:
+            acc.add(term)
+        return len(terms)
+
+    # The digits as packed integers
+    def digit_slots(self):
+        return [pack_vector(d.values, d.precision).slots for d in self.digits]
+
+
+# Precomputed window tables for transit key components. The digits of a component
+# are cut into windows of `window` consecutive powers, and for each window we store
+# the sums of all 2**window subsets of its digits. A combination then costs one
+# table lookup per window (precision/window additions) instead of one addition
+# per set bit of the index. The results are identical to the bit-by-bit sums.
+# Tables take (2**window - 1)/window times the memory of the digits themselves,
+# so only the most recently used components are kept, up to `max_bytes` in total
+class WindowTableCache:
+    def __init__(self, window=4, max_bytes=2**30):
+        self.window = window
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()  # id(component) -> (component, table, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def build_table(self, component):
+        table = []
+        for start in range(0, len(component.digits), self.window):
+            digits = component.digits[start : start + self.window]
+            # entries[v] is the sum of the digits selected by the bits of v
+            entries = [None]
+            for digit in digits:
+                entries += [digit] + [entry + digit for entry in entries[1:]]
+            table.append(entries)
+        return table
+
+    # Returns the table for the component, building it (and evicting the least
+    # recently used tables) if needed. Returns None if it can't fit at all
+    def table_for(self, component):
+        key = id(component)
+        if key in self.tables:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            return self.tables[key][1]
+        self.misses += 1
+        windows = -(-len(component.digits) // self.window)
+        nbytes = windows * (2**self.window - 1) * ciphertext_nbytes(component.digits[0])
+        if nbytes > self.max_bytes:
+            return None
+        while self.nbytes + nbytes > self.max_bytes:
+            _, (_, _, evicted_nbytes) = self.tables.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+        table = self.build_table(component)
+        self.tables[key] = (component, table, nbytes)
+        self.nbytes += nbytes
+        return table
+
+    def combination_terms(self, table, index):
+        mask = 2**self.window - 1
+        return [
+            entries[(index >> (k * self.window)) & mask]
+            for k, entries in enumerate(table)
+            if (index >> (k * self.window)) & mask
+        ]
+
+    def clear(self):
+        self.tables.clear()
+        self.nbytes = 0
 
 
 @dataclass
 class TransitKey:
     pairs: list  # [list][TransitKeyComponent]
+    window_cache: WindowTableCache = None
+
+
+# The digits of one component of a PackedPairs. Looks like a list of ciphertexts,
+# but only holds the position of the digits in the buffer; a digit is read (as a
+# packed ciphertext) when it's accessed, and slots(power) reads it as the bare
+# packed integer
+class PackedDigits:
+    __slots__ = ("view", "offset", "length", "precision", "size", "noise")
+
+    def __init__(self, view, offset, length, precision, noise=None):
+        self.view, self.offset = view, offset
+        self.length, self.precision, self.noise = length, precision, noise
+        self.size = slot_width(precision) // 8 * length
+
+    def slots(self, power):
+        start = self.offset + power * self.size
+        return int.from_bytes(self.view[start : start + self.size], "little")
+
+    def __len__(self):
+        return self.precision
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.precision))]
+        if index < 0:
+            index += self.precision
+        if not 0 <= index < self.precision:
+            raise IndexError("digit index out of range")
+        return Ciphertext(
+            values=PackedVector(self.slots(index), self.length, self.precision),
+            precision=self.precision,
+            noise=self.noise,
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(self.precision))
+
+
+# A transit key component whose digits are a PackedDigits. Sums of digits are
+# added up straight from the buffer, without making a ciphertext for each digit
+# (unless window tables are used, which are built from ciphertexts)
+class PackedComponent(TransitKeyComponent):
+    def get_combination_for(self, index, window_cache=None):
+        if window_cache is not None or not index:
+            return super().get_combination_for(index, window_cache)
+        digits = self.digits
+        acc = CiphertextAccumulator(digits.length, digits.precision, True)
+        terms = self.add_combination(acc, index)
+        instrumentation.count("digit_sums", terms)
+        out = acc.result()
+        out.noise = None if digits.noise is None else digits.noise * terms
+        return out
+
+    def add_combination(self, acc, index, window_cache=None):
+        if window_cache is not None:
+            return super().add_combination(acc, index, window_cache)
+        digits = self.digits
+        view, start, size = digits.view, digits.offset, digits.size
+        total, terms = 0, 0
+        # The bits of the index, lowest first
+        for bit in bin(index)[:1:-1]:
+            if bit == "1":
+                total += int.from_bytes(view[start : start + size], "little")
+                terms += 1
+            start += size
+        acc.add_slots(total, terms)
+        return terms
+
+    def digit_slots(self):
+        return [self.digits.slots(power) for power in range(self.digits.precision)]
+
+
+# Compact storage for a transit key: the digits of all components in one buffer,
+# component by component (pairs[0][0], pairs[1][0], pairs[1][1], ...), each one's
+# digits by power, and each digit as its packed slots in little-endian bytes (the
+# byte layout of a PackedVector, and of the body of a saved transit key, see
+# serialization.py). So digit (i, j, power) is at a computable offset, and takes
+# exactly its slot_width(precision) // 8 * length bytes, where a list of
+# Ciphertexts spends several times that on the Python objects around every digit.
+#
+# Stands in for TransitKey.pairs: pairs[i][j] for j <= i. Component objects are
+# created on first use and then kept, so they can be used as keys of a
+# WindowTableCache. `noise` is the noise of every digit
+class PackedPairs:
+    # Digits are never seed-compressed here (but see serialization.MappedPairs)
+    compressed = False
+
+    def __init__(self, data, rows, length, precision, noise=None, offset=0):
+        self.data, self.view = data, memoryview(data)
+        self.rows, self.length, self.precision = rows, length, precision
+        self.noise, self.offset = noise, offset
+        self.component_size = precision * slot_width(precision) // 8 * length
+        self.components = {}
+
+    # Size of the digits in bytes
+    @property
+    def nbytes(self):
+        return self.rows * (self.rows + 1) // 2 * self.component_size
+
+    def component_offset(self, i, j):
+        return self.offset + (i * (i + 1) // 2 + j) * self.component_size
+
+    def component(self, i, j):
+        assert 0 <= j <= i < self.rows
+        if (i, j) not in self.components:
+            digits = PackedDigits(
+                self.view,
+                self.component_offset(i, j),
+                self.length,
+                self.precision,
+                self.noise,
+            )
+            self.components[i, j] = PackedComponent(digits=digits)
+        return self.components[i, j]
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.rows
+        if not 0 <= i < self.rows:
+            raise IndexError("transit key row out of range")
+        return PackedRow(self, i)
+
+    def __iter__(self):
+        return (self[i] for i in range(self.rows))
+
+    def digit_bytes(self):
+        return self.view[self.offset : self.offset + self.nbytes]
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedPairs):
+            return NotImplemented
+        shape = (self.rows, self.length, self.precision)
+        return shape == (other.rows, other.length, other.precision) and (
+            self.digit_bytes() == other.digit_bytes()
+        )
+
+    def __reduce__(self):
+        return (
+            PackedPairs,
+            (
+                bytes(self.digit_bytes()),
+                self.rows,
+                self.length,
+                self.precision,
+                self.noise,
+            ),
+        )
+
+
+class PackedRow:
+    def __init__(self, pairs, i):
+        self.pairs, self.i = pairs, i
+
+    def __len__(self):
+        return self.i + 1
+
+    def __getitem__(self, j):
+        if j < 0:
+            j += self.i + 1
+        if not 0 <= j <= self.i:
+            raise IndexError("transit key column out of range")
+        return self.pairs.component(self.i, j)
+
+    def __iter__(self):
+        return (self[j] for j in range(self.i + 1))
+
+
+# The same transit key with its digits in one PackedPairs buffer. The digits'
+# noise becomes the largest of their estimates
+def pack_transit_key(tk):
+    digit = tk.pairs[0][0].digits[0]
+    length, precision = len(digit.values), digit.precision
+    size = slot_width(precision) // 8 * length
+    noises = []
+    data = bytearray()
+    for row in tk.pairs:
+        for component in row:
+            assert len(component.digits) == precision
+            noises += [d.noise for d in component.digits]
+            data += b"".join(
+                s.to_bytes(size, "little") for s in component.digit_slots()
+            )
+    noise = None if None in noises else max(noises)
+    return TransitKey(
+        pairs=PackedPairs(data, len(tk.pairs), length, precision, noise),
+        window_cache=tk.window_cache,
+    )
+
+
+# A transit key for a lower precision, made from the digits of `tk`: digit k of a
+# component encrypts s[i]*s[j]*2**k mod 2**P, so chopping the low P - precision
+# bits off digit k + P - precision gives an encryption of s[i]*s[j]*2**k mod
+# 2**precision. The new digits have more noise than fresh ones, from the rounding
+def truncate_transit_key(tk, precision):
+    full = tk.pairs[0][0].digits[0].precision
+    assert precision <= full
+    return TransitKey(
+        pairs=[
+            [
+                TransitKeyComponent(
+                    digits=[
+                        adjust_ciphertext_precision(d, precision)
+                        for d in component.digits[full - precision :]
+                    ]
+                )
+                for component in row
+            ]
+            for row in tk.pairs
+        ]
+    )
+
+
+# Turn on window tables for a transit key, see WindowTableCache
+def enable_window_tables(tk, window=4, max_bytes=2**30):
+    tk.window_cache = WindowTableCache(window, max_bytes)
+    return tk
 
 
 # Converts a key [s1, s2, s3...] into a key [first bit of s1, second bit of s1 ..., first bit of s2, second bit of s2...]
@@ -184,28 +1028,169 @@ def flatten_ciphertext(ct):
     )
 
 
-def mk_transit_key(s, t, precision):
+# Seed for one independent piece of a bigger job (eg. one chunk of a transit key),
+# derived from a master seed. Since every piece has its own seed, the result only
+# depends on the master seed and not on how the pieces are spread over processes
+def derive_seed(seed, *path):
+    digest = hashlib.sha256(repr((seed,) + path).encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+# Returns a progress callback for keygen that prints percentage done and ETA,
+# at most once every `interval` seconds
+def print_progress(label, interval=5):
+    last = [0]
+
+    def progress(done, total, eta):
+        if done == total or time.time() - last[0] >= interval:
+            last[0] = time.time()
+            percentage = 100 * done / total
+            instrumentation.log(
+                "{}: {:.1f}% done, ETA {:.0f}s".format(label, percentage, eta)
+            )
+
+    return progress
+
+
+def _run_indexed(args):
+    function, index, task = args
+    return index, function(task)
+
+
+# Runs function(task) for every task, on a pool of `processes` workers (or in this
+# process if processes is None or 1), and returns the results in task order.
+# Calls progress(done, total, eta_seconds) as results come in, where done and
+# total are measured in `weights` (eg. number of ciphertexts per task)
+def run_tasks(function, tasks, processes=None, progress=None, weights=None):
+    weights = weights or [1] * len(tasks)
+    total, done, start = sum(weights), 0, time.time()
+    results = [None] * len(tasks)
+    # Biggest tasks first, so that no worker is left with a big one at the end
+    order = sorted(range(len(tasks)), key=lambda i: -weights[i])
+    jobs = [(function, i, tasks[i]) for i in order]
+    pool = None
+    if processes is not None and processes > 1:
+        pool = multiprocessing.Pool(processes)
+    try:
+        outputs = (pool.imap_unordered if pool else map)(_run_indexed, jobs)
+        for i, result in outputs:
+            results[i] = result
+            done += weights[i]
+            if progress is not None:
+                elapsed = time.time() - start
+                progress(done, total, elapsed * (total - done) / done)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
+
+
+# Number of powers of two encrypted together in one keygen task
+KEYGEN_CHUNK = 16
+
+
+# Returns the digits of row i for `powers`, ordered by component and then power.
+# For a contiguous key they come as the bytes of their packed slots
+def _transit_key_task(task):
+    s, t, i, powers, precision, packed, compressed, contiguous, seed = task
+    messages = [(s[i] * s[j]) << power for j in range(i + 1) for power in powers]
+    digits = partial_encrypt_many(
+        t, messages, precision, packed, random.Random(seed), compressed=compressed
+    )
+    if contiguous:
+        size = slot_width(precision) // 8 * len(t)
+        return b"".join(d.values.slots.to_bytes(size, "little") for d in digits)
+    return digits
+
+
+def mk_transit_key(
+    s,
+    t,
+    precision,
+    packed=False,
+    rng=None,
+    processes=None,
+    seed=None,
+    progress=None,
+    compressed=False,
+    contiguous=False,
+):
     # For each v=s[i], and for each product v = s[i] * s[j], encrypt v, v*2, v*4, v*8.....
     # under the key `t`.
     # This allows us to compute s[i] * b or s[i] * s[j] * b for any b with a logarithmic number
     # of additions (and hence logarithmic-sized error blowup)
+    #
+    # The rows i are independent, and so are the powers, so the work is split into
+    # tasks of one row and KEYGEN_CHUNK powers, each with a seed derived from `seed`
+    # (which itself is drawn from `rng` if not given), and can be run on a pool.
+    #
+    # With `compressed` set the digits are seed-compressed, which makes the key about
+    # len(t) times smaller to store, at the cost of expanding each digit when used
+    #
+    # With `contiguous` set the key is packed, and its digits are stored in one
+    # buffer (see PackedPairs). The workers send back the bytes of their digits,
+    # which are copied into place, so the key never exists as ciphertext objects
+    if contiguous and compressed:
+        raise ValueError("a contiguous transit key can't be seed-compressed")
+    packed = packed or contiguous
     s = flatten_key(s)
-    pairs = []
-    for i in range(len(s)):
-        pairs.append(
-            [
-                TransitKeyComponent(
-                    digits=[
-                        partial_encrypt(t, (s[i] * s[j]) << power, precision)
-                        for power in range(precision)
-                    ]
-                )
-                for j in range(i + 1)
-            ]
+    if seed is None:
+        seed = (rng or random).getrandbits(64)
+    chunks = [
+        range(p, min(p + KEYGEN_CHUNK, precision))
+        for p in range(0, precision, KEYGEN_CHUNK)
+    ]
+    tasks = [
+        (
+            s,
+            t,
+            i,
+            c,
+            precision,
+            packed,
+            compressed,
+            contiguous,
+            derive_seed(seed, "transit", i, c.start),
+        )
+        for i in range(len(s))
+        for c in chunks
+    ]
+    results = run_tasks(
+        _transit_key_task,
+        tasks,
+        processes,
+        progress,
+        [(task[2] + 1) * len(task[3]) for task in tasks],
+    )
+    if contiguous:
+        digit_size = slot_width(precision) // 8 * len(t)
+        pairs = PackedPairs(
+            bytearray(len(s) * (len(s) + 1) // 2 * precision * digit_size),
+            len(s),
+            len(t),
+            precision,
+            FRESH_NOISE,
         )
-    return TransitKey(pairs=pairs)
+        for k, task in enumerate(tasks):
+            i, powers = task[2], task[3]
+            digits, results[k] = results[k], None
+            size = len(powers) * digit_size
+            for j in range(i + 1):
+                start = pairs.component_offset(i, j) + powers.start * digit_size
+                pairs.view[start : start + size] = digits[j * size : (j + 1) * size]
+        return TransitKey(pairs=pairs)
+    pairs = [[[] for j in range(i + 1)] for i in range(len(s))]
+    for task, digits in zip(tasks, results):
+        i, powers = task[2], task[3]
+        for j in range(i + 1):
+            pairs[i][j].extend(digits[j * len(powers) : (j + 1) * len(powers)])
+    return TransitKey(
+        pairs=[[TransitKeyComponent(digits=d) for d in row] for row in pairs]
+    )
 
 
+@instrumentation.timed("multiply")
 def multiply_ciphertexts(c1, c2, transit_key):
     # The idea here is that we take the equation
     #
@@ -216,18 +1201,111 @@ def multiply_ciphertexts(c1, c2, transit_key):
     # except instead of evaluating it directly (we can't because we don't have the key), we
     # use the transit key to evaluate the equation as a linear combination of s[i]*s[j],
     # giving us the decrypted output, encrypted under `t` (the target key of the transit key)
+    #
+    # Anything else with a `multiply` method can stand in for the transit key, eg. to
+    # record the multiplication instead of doing it (see circuit.py)
+    if hasattr(transit_key, "multiply"):
+        return transit_key.multiply(c1, c2)
+    instrumentation.count("multiplications")
+    noise = multiplication_noise(
+        c1.noise,
+        c2.noise,
+        len(c1.values),
+        c1.precision,
+        transit_key.pairs[0][0].digits[0].noise,
+    )
     c1, c2 = flatten_ciphertext(c1), flatten_ciphertext(c2)
     v1, v2 = c1.values, c2.values
     dim, precision, mask = len(v1), c1.precision, (2**c1.precision) - 1
-    return sum_ciphertexts(
+    out = sum_ciphertexts(
         [
             transit_key.pairs[max(i, j)][min(i, j)].get_combination_for(
-                ((v1[i] * v2[j]) >> (precision - 1)) & mask
+                ((v1[i] * v2[j]) >> (precision - 1)) & mask, transit_key.window_cache
             )
             for i in range(dim)
             for j in range(dim)
         ]
     )
+    out.noise = noise
+    return out
+
+
+# A running sum of ciphertexts of one shape. Packed values are added straight into
+# one big integer and only masked when the guard bits are about to run out; list
+# values are added into one list of unreduced ints that is masked at the end
+class CiphertextAccumulator:
+    def __init__(self, length, precision, packed):
+        self.length, self.precision, self.packed = length, precision, packed
+        self.total = 0 if packed else [0] * length
+        self.pending = 0
+
+    def add(self, ct):
+        if self.packed:
+            self.add_slots(pack_vector(ct.values, self.precision).slots)
+        else:
+            total = self.total
+            for k, x in enumerate(ct.values):
+                total[k] += x
+
+    # Add the slots of a packed vector, or an unreduced sum of `count` of them
+    def add_slots(self, slots, count=1):
+        if self.pending + count > 2**GUARD_BITS - 1:
+            self.total &= slot_mask(self.length, self.precision)
+            self.pending = 0
+        self.total += slots
+        self.pending += count
+
+    def result(self):
+        if self.packed:
+            values = PackedVector(
+                self.total & slot_mask(self.length, self.precision),
+                self.length,
+                self.precision,
+            )
+        else:
+            values = [x & (2**self.precision - 1) for x in self.total]
+        return Ciphertext(values=values, precision=self.precision)
+
+
+# Same result as multiply_ciphertexts (up to noise), but cheaper:
+# - (i, j) and (j, i) share the transit key component pairs[max][min], so instead
+#   of looking up both we look up the sum of their indices once. Since the
+#   component encrypts s[i]*s[j]*index mod q, this is the same plaintext, from
+#   at most `precision` digits instead of up to twice that
+# - the digits are added straight into one accumulator instead of building
+#   dim**2 intermediate ciphertexts
+# - the flattened values c << b are computed straight from the coefficients as
+#   plain ints, without building flatten_ciphertext(c1) and flatten_ciphertext(c2)
+@instrumentation.timed("multiply")
+def fused_multiply_ciphertexts(c1, c2, transit_key):
+    if hasattr(transit_key, "multiply"):
+        return transit_key.multiply(c1, c2)
+    instrumentation.count("multiplications")
+    precision, mask = c1.precision, (2**c1.precision) - 1
+    shift, bits = precision - 1, range(ERROR_BITS + 1)
+    v1 = [(x << b) & mask for x in c1.values for b in bits]
+    v2 = [(x << b) & mask for x in c2.values for b in bits]
+    digit = transit_key.pairs[0][0].digits[0]
+    acc = CiphertextAccumulator(
+        len(digit.values), digit.precision, isinstance(digit.values, PackedVector)
+    )
+    cache = transit_key.window_cache
+    terms = 0
+    for i in range(len(v1)):
+        x1, x2, row = v1[i], v2[i], transit_key.pairs[i]
+        for j in range(i + 1):
+            index = (x1 * v2[j]) >> shift
+            if j != i:
+                index += (x2 * v1[j]) >> shift
+            index &= mask
+            if index:
+                terms += row[j].add_combination(acc, index, cache)
+    instrumentation.count("digit_sums", terms)
+    out = acc.result()
+    out.noise = multiplication_noise(
+        c1.noise, c2.noise, len(c1.values), precision, digit.noise
+    )
+    return out
 
 
 # Encode an integer into a binary representation (least significant bits first)
@@ -235,18 +1313,32 @@ def binary_encode(integer, length, encoded_zero, encoded_one):
     return [encoded_one if integer & (1 << i) else encoded_zero for i in range(length)]
 
 
+# Encode a public integer as constant bits, eg. to add it to an encrypted one
+def constant_encode(integer, length):
+    return binary_encode(integer, length, PLAIN_ZERO, PLAIN_ONE)
+
+
 # Decrypt a series of ciphertexts that represent an integer in binary representation
 def binary_decrypt(key, output):
     return sum([decrypt(key, o) << i for i, o in enumerate(output)])
 
 
-# Logical OR
-def _or(a, b, tk):
-    return a + b + multiply_ciphertexts(a, b, tk)
+# Logical AND
+def _and(a, b, tk):
+    if isinstance(a, Constant):
+        return b if a.value else a
+    if isinstance(b, Constant):
+        return a if b.value else b
+    return fused_multiply_ciphertexts(a, b, tk)
 
 
-# Logical AND
-_and = multiply_ciphertexts
+# Logical OR
+def _or(a, b, tk):
+    if isinstance(a, Constant):
+        return a if a.value else b
+    if isinstance(b, Constant):
+        return b if b.value else a
+    return a + b + _and(a, b, tk)
 
 
 # Kogge-Stone adder, see https://upload.wikimedia.org/wikipedia/commons/1/1c/4_bit_Kogge_Stone_Adder_Example_new.png
@@ -258,31 +1350,42 @@ def encoded_add(a, b, tk):
     )
 
 
+# a + b + c = (a xor b xor c) + 2 * majority(a, b, c); the majority bits are one
+# place higher than the xor bits, so they can't go straight into the propagate step
 def encoded_add3(a, b, c, tk):
-    return kogge_stone_propagate(
-        [ai + bi + ci for ai, bi, ci in zip(a, b, c)],
-        [
-            _and(ai + bi, ai + ci, tk) + ai for ai, bi, ci in zip(a, b, c)
-        ],  # (a+b)(a+c)-a = (a+b)(a+c)-a2 = a2+ac+ab+bc-a2 = ab+ac+bc
-        tk,
-    )
+    x, y = three_to_two(a, b, c, PLAIN_ZERO, tk)
+    return encoded_add(x, y, tk)
+
+
+# Combine the (generate, propagate) bits of two adjacent groups of bit positions
+# into those of the whole group: it generates a carry if the high group does, or
+# if the low group does and the high group propagates it. A group can't both
+# generate and propagate (that would take a position with a and b both 1 and
+# both different), so the OR is an XOR, which saves a multiplication and a level
+# of depth. Passing None as the low propagate bit skips computing it
+def combine_propagate(high, low, tk):
+    (g_high, p_high), (g_low, p_low) = high, low
+    g = g_high + _and(p_high, g_low, tk)
+    return g, None if p_low is None else _and(p_low, p_high, tk)
 
 
 def kogge_stone_propagate(p, g, tk):
     origp = p[::]
     offset = 1
-    while 2**offset <= len(p):
+    while offset < len(p):
         newg = g[::]
         newp = p[::]
         for i in range(0, len(p) - offset):
-            newg[i + offset] = _or(g[i + offset], _and(p[i + offset], g[i], tk), tk)
-            newp[i + offset] = _and(p[i], p[i + offset], tk)
+            newg[i + offset], newp[i + offset] = combine_propagate(
+                (g[i + offset], p[i + offset]), (g[i], p[i]), tk
+            )
         g, p = newg, newp
         offset *= 2
     return [origp[0]] + [origp[i] + g[i - 1] for i in range(1, len(p))] + [g[-1]]
 
 
 # Converts a+b+c into v+w such that a+b+c = v+w. Multiplicative depth 1.
+# `zero` pads the outputs and can be PLAIN_ZERO
 def three_to_two(a, b, c, zero, tk):
     return (
         [ai + bi + ci for ai, bi, ci in zip(a, b, c)] + [zero],
@@ -290,32 +1393,195 @@ def three_to_two(a, b, c, zero, tk):
     )
 
 
+# The adders zip their inputs together, so bring integer encodings to one length
+# (at most `bits`) by padding them with `zero`
+def pad_encodings(values, zero, bits):
+    width = min(max(len(v) for v in values), bits)
+    return [v[:width] + [zero] * (width - len(v)) for v in values]
+
+
 # Add together many numbers. Use the 3->2 adder in a tree structure (ok fine it's a DAG),
-# then finish off with a 3-to-1 or 2-to-1 as needed
+# then finish off with a 3-to-1 or 2-to-1 as needed. Passing PLAIN_ZERO as `zero`
+# saves the multiplications on the padding bits
+@instrumentation.timed("multi_add", span=True)
 def multi_add(values, zero, tk, bits=999999999999999):
+    values = pad_encodings(values, zero, bits)
     while len(values) > 2:
-        print("Multi adding {} values".format(len(values)))
+        instrumentation.log("Multi adding {} values".format(len(values)))
         o = []
-        for i in range(0, len(values) - 2, 3):
-            x, y = three_to_two(values[i], values[i + 1], values[i + 2], zero, tk)
-            o.extend([x[:bits], y[:bits]])
+        with instrumentation.span("three_to_two"):
+            for i in range(0, len(values) - 2, 3):
+                x, y = three_to_two(values[i], values[i + 1], values[i + 2], zero, tk)
+                o.extend([x, y])
         o.extend(values[len(values) - len(values) % 3 :])
-        values = o
-    return (
-        encoded_add(values[0], values[1], tk)[:bits]
-        if len(values) == 2
-        else encoded_add3(values[0], values[1], values[2], tk)[:bits]
-    )
+        values = pad_encodings(o, zero, bits)
+    with instrumentation.span("final_add"):
+        if len(values) == 2:
+            return encoded_add(values[0], values[1], tk)[:bits]
+        return encoded_add3(values[0], values[1], values[2], tk)[:bits]
+
+
+# Multiply two encoded integers (a Wallace tree). The partial products a * b[i]
+# are one AND per bit (shifted up by i, with constant zeros below), and multi_add
+# sums them with layers of 3-to-2 compressors and one Kogge-Stone adder at the
+# end. The product has len(a) + len(b) bits, or the low `bits` of them
+def encoded_multiply(a, b, tk, bits=None):
+    assert a and b
+    bits = len(a) + len(b) if bits is None else bits
+    partials = [
+        [PLAIN_ZERO] * i + [_and(aj, bi, tk) for aj in a[: bits - i]]
+        for i, bi in enumerate(b[:bits])
+    ]
+    # multi_add needs at least two values to finish with an adder
+    partials += [[]] * (2 - len(partials))
+    total = multi_add(partials, PLAIN_ZERO, tk, bits)
+    return total + [PLAIN_ZERO] * (bits - len(total))
+
+
+# 1 if two encoded integers are equal: AND together the bits that agree, as a
+# balanced tree. Depth ceil(log2(bits))
+def encoded_equal(a, b, tk):
+    a, b = pad_encodings([a, b], PLAIN_ZERO, max(len(a), len(b)))
+    same = [(ai + bi).flip() for ai, bi in zip(a, b)]
+    while len(same) > 1:
+        same = [
+            _and(same[i], same[i + 1], tk) if i + 1 < len(same) else same[i]
+            for i in range(0, len(same), 2)
+        ]
+    return same[0] if same else PLAIN_ONE
+
+
+# 1 if a < b (unsigned). a - b = a + ~b + 1 doesn't carry out of the top bit
+# exactly when a < b, and the carry is the generate bit of the whole width,
+# combined from the bits with combine_propagate as a balanced tree rather than
+# a full Kogge-Stone prefix. Depth 1 + ceil(log2(bits))
+def encoded_less_than(a, b, tk):
+    a, b = pad_encodings([a, b], PLAIN_ZERO, max(len(a), len(b)))
+    groups = [(_and(ai, bi.flip(), tk), (ai + bi).flip()) for ai, bi in zip(a, b)]
+    if not groups:
+        return PLAIN_ZERO
+    # The carry into bit 0 is 1, so bit 0 carries if it generates or propagates.
+    # The lowest group's propagate bit is never needed
+    groups[0] = (groups[0][0] + groups[0][1], None)
+    while len(groups) > 1:
+        groups = [
+            (
+                combine_propagate(groups[i + 1], groups[i], tk)
+                if i + 1 < len(groups)
+                else groups[i]
+            )
+            for i in range(0, len(groups), 2)
+        ]
+    return groups[0][0].flip()
+
+
+# a if `condition` is 1, else b, bit by bit as b + condition * (a + b). Depth 1
+def encoded_select(condition, a, b, tk):
+    a, b = pad_encodings([a, b], PLAIN_ZERO, max(len(a), len(b)))
+    return [bi + _and(condition, ai + bi, tk) for ai, bi in zip(a, b)]
+
+
+# Brings two ciphertexts to the lower of their precisions, eg. to add them
+def match_precision(a, b):
+    if isinstance(a, Constant) or isinstance(b, Constant):
+        return a, b
+    if a.precision > b.precision:
+        a = adjust_ciphertext_precision(a, b.precision)
+    elif b.precision > a.precision:
+        b = adjust_ciphertext_precision(b, a.precision)
+    return a, b
+
+
+# Scale every value of a packed vector to a new precision, as x >> (p - p') or
+# x << (p' - p). The shift is done on all slots at once; if the slot width changes,
+# the slots are then moved by slicing bytes, as all values fit in the new width
+def rescale_packed(vec, new_precision):
+    old, new = slot_width(vec.precision) // 8, slot_width(new_precision) // 8
+    slots, length = vec.slots, vec.length
+    if new_precision < vec.precision:
+        # Bits shifted in from the next slot end up above new_precision
+        slots = (slots >> (vec.precision - new_precision)) & slot_mask(
+            length, vec.precision
+        )
+    if new != old:
+        data = slots.to_bytes(old * length, "little")
+        if new < old:
+            data = b"".join(data[i : i + new] for i in range(0, len(data), old))
+        else:
+            padding = b"\0" * (new - old)
+            data = b"".join(
+                data[i : i + old] + padding for i in range(0, len(data), old)
+            )
+        slots = int.from_bytes(data, "little")
+    if new_precision > vec.precision:
+        slots <<= new_precision - vec.precision
+    return PackedVector(slots & slot_mask(length, new_precision), length, new_precision)
 
 
 # Adjusts a ciphertext's precision, chopping off lower-order bits. This does not
 # magnify the error by more than a small amount!
 def adjust_ciphertext_precision(ct, new_precision):
-    if new_precision < ct.precision:
+    if isinstance(ct, Constant):
+        return ct
+    if isinstance(ct.values, PackedVector):
+        new_values = rescale_packed(ct.values, new_precision)
+    elif new_precision < ct.precision:
         new_values = [x >> (ct.precision - new_precision) for x in ct.values]
     else:
         new_values = [x << (new_precision - ct.precision) for x in ct.values]
-    return Ciphertext(values=new_values, precision=new_precision)
+    noise = adjusted_noise(ct.noise, len(ct.values), ct.precision, new_precision)
+    return Ciphertext(values=new_values, precision=new_precision, noise=noise)
+
+
+# A key switching key moves ciphertexts from key `s` to key `t` (which can be
+# shorter), at `precision` (which can differ from the ciphertexts'). It is built
+# like a transit key: component i holds encryptions under t of s[i] * 2**k for
+# every power k, so for a ciphertext c (rescaled to `precision`), c[0] plus the
+# combination for c[i] of every component i >= 1 is a ciphertext under t with
+# the same phase c.s, plus the errors of the digits used. Since key[0] == 1,
+# c[0] goes into the first value as it is.
+#
+# Ciphertexts under a short key are cheaper to store and to add up, so circuits
+# can do their bulk additions there and switch back to the transit key's key (with
+# a second key switching key) only for multiplication or bootstrapping
+@dataclass
+class KeySwitchingKey:
+    components: list  # [TransitKeyComponent], for s[1], s[2], ...
+    precision: int
+
+
+def mk_key_switching_key(s, t, precision, packed=False, rng=None):
+    powers = range(precision)
+    messages = [x << power for x in s[1:] for power in powers]
+    digits = partial_encrypt_many(t, messages, precision, packed, rng)
+    return KeySwitchingKey(
+        components=[
+            TransitKeyComponent(digits=digits[i : i + precision])
+            for i in range(0, len(digits), precision)
+        ],
+        precision=precision,
+    )
+
+
+@instrumentation.timed("switch_key")
+def switch_key(ct, ksk):
+    if isinstance(ct, Constant):
+        return ct
+    assert len(ct.values) == len(ksk.components) + 1
+    ct = adjust_ciphertext_precision(ct, ksk.precision)
+    digit = ksk.components[0].digits[0]
+    packed = isinstance(digit.values, PackedVector)
+    acc = CiphertextAccumulator(len(digit.values), ksk.precision, packed)
+    first = [ct.values[0]] + [0] * (len(digit.values) - 1)
+    acc.add(Ciphertext(values=first, precision=ksk.precision))
+    terms = 0
+    for component, x in zip(ksk.components, ct.values[1:]):
+        if x:
+            terms += component.add_combination(acc, x)
+    instrumentation.count("digit_sums", terms)
+    out = acc.result()
+    out.noise = add_noise(ct.noise, digit_sum_noise(terms, digit.noise))
+    return out
 
 
 # A key used for the bootstrapping procedure. This involves running a decryption circuit for
@@ -330,25 +1596,54 @@ class BootstrappingKey:
     long_precision: int
 
 
-def mk_bootstrapping_key(s, t, long_precision, short_precision):
-    # Basically an encryption of every bit of every s[i] under t
-    values = []
-    for x in s:
-        bits = []
-        for j in range(ERROR_BITS + 1):
-            bits.append(encrypt(t, (x >> j) % 2, long_precision))
-        values.append(bits)
+def _bootstrapping_key_task(task):
+    t, messages, precision, packed, compressed, seed = task
+    return encrypt_many(t, messages, precision, packed, random.Random(seed), compressed)
+
+
+def mk_bootstrapping_key(
+    s,
+    t,
+    long_precision,
+    short_precision,
+    packed=False,
+    rng=None,
+    processes=None,
+    seed=None,
+    progress=None,
+    compressed=False,
+):
+    # Basically an encryption of every bit of every s[i] under t, plus a zero and
+    # a one. Like mk_transit_key, done as one task per s[i], each with its own seed
+    if seed is None:
+        seed = (rng or random).getrandbits(64)
+    messages = [[(x >> j) % 2 for j in range(ERROR_BITS + 1)] for x in s] + [[0, 1]]
+    tasks = [
+        (
+            t,
+            m,
+            long_precision,
+            packed,
+            compressed,
+            derive_seed(seed, "bootstrapping", i),
+        )
+        for i, m in enumerate(messages)
+    ]
+    values = run_tasks(
+        _bootstrapping_key_task, tasks, processes, progress, [len(m) for m in messages]
+    )
     return BootstrappingKey(
-        values=values,
-        zero=encrypt(t, 0, long_precision),
-        one=encrypt(t, 1, long_precision),
+        values=values[:-1],
+        zero=values[-1][0],
+        one=values[-1][1],
         short_precision=short_precision,
         long_precision=long_precision,
     )
 
 
-def bootstrap(ct, bk, tk):
-    print("Bootstrapping")
+# The integers that add up to s.ct (the decryption of `ct` before rounding), as
+# encodings of bits of the bootstrapping key
+def bootstrap_encodings(ct, bk):
     # Start by squashing the ciphertext to a shorter precision for easier calculation
     squashed_ct = adjust_ciphertext_precision(ct, bk.short_precision)
     # The i'th bin represents bits with place value 2**i
@@ -363,21 +1658,166 @@ def bootstrap(ct, bk, tk):
             if (ct_value >> ct_bit) % 2:
                 for key_bit in range(min(ERROR_BITS + 1, bk.short_precision - ct_bit)):
                     inner_product_bits[ct_bit + key_bit].append(bk_value[key_bit])
-    print("Packed bits")
+    instrumentation.log("Packed bits")
     # To combine all the bins, we'll just keep grabbing one bit from each bin, pretend
     # that's an integer, and add up all the integers
     max_inner_product_bit_count = max(len(x) for x in inner_product_bits)
     as_integer_encodings = [
         [
-            inner_product_bits[i][j] if j < len(inner_product_bits[i]) else bk.zero
+            inner_product_bits[i][j] if j < len(inner_product_bits[i]) else PLAIN_ZERO
             for i in range(bk.short_precision)
         ]
         for j in range(max_inner_product_bit_count)
     ]
-    print("Adding {} integers".format(len(as_integer_encodings)))
+    return as_integer_encodings
+
+
+@instrumentation.timed("bootstrap", span=True)
+def bootstrap(ct, bk, tk):
+    instrumentation.log("Bootstrapping")
+    as_integer_encodings = bootstrap_encodings(ct, bk)
+    instrumentation.log("Adding {} integers".format(len(as_integer_encodings)))
+    instrumentation.count("bootstrap_integers", len(as_integer_encodings))
     # Final sum mod 2**short_precision
-    total = multi_add(as_integer_encodings, bk.zero, tk, bk.short_precision)
+    # The padding is constant, so the adders skip the gates it goes into
+    total = multi_add(as_integer_encodings, PLAIN_ZERO, tk, bk.short_precision)
     # 1 if the top two digits are 10 or 01, 0 if they are 00 or 11
     # This is equivalent to "1 if the value is closer to q/2, 0 if it's
     # closer to 0"
-    return total[bk.short_precision - 1] + total[bk.short_precision - 2]
+    out = total[bk.short_precision - 1] + total[bk.short_precision - 2]
+    # Only constant if the sum didn't depend on the key at all
+    return out + bk.zero if isinstance(out, Constant) else out
+
+
+# Evaluation mode that bootstraps only when it has to. Pass it in place of the
+# transit key: before each multiplication it predicts the noise of the product
+# from the noise estimates of the inputs, and bootstraps the noisier input (and
+# then the other one, if that's not enough) when the product would come within
+# `margin` bits of the decryption threshold. If `key` is given, the estimates are
+# checked against the actual error of every product and bootstrap output
+class AutoBootstrap:
+    def __init__(self, tk, bk, margin=2, key=None):
+        self.tk, self.bk, self.margin, self.key = tk, bk, margin, key
+        self.bootstraps = 0
+        self.multiplications = 0
+
+    def too_noisy(self, c1, c2):
+        noise = multiplication_noise(
+            c1.noise,
+            c2.noise,
+            len(c1.values),
+            c1.precision,
+            self.tk.pairs[0][0].digits[0].noise,
+        )
+        return noise is not None and noise >= noise_limit(c1.precision, self.margin)
+
+    def bootstrap(self, ct):
+        self.bootstraps += 1
+        out = bootstrap(ct, self.bk, self.tk)
+        self.check(out)
+        return out
+
+    def check(self, ct):
+        if self.key is not None and ct.noise is not None:
+            assert error_bits(self.key, ct) <= noise_bits(ct), "noise estimate too low"
+
+    def multiply(self, c1, c2):
+        # Bootstrap the noisier input first
+        if (c2.noise or 0) > (c1.noise or 0):
+            c1, c2 = c2, c1
+        if self.too_noisy(c1, c2):
+            same = c1 is c2
+            c1 = self.bootstrap(c1)
+            if same:
+                c2 = c1
+            elif self.too_noisy(c1, c2):
+                c2 = self.bootstrap(c2)
+            if self.too_noisy(c1, c2):
+                raise ValueError("precision too small to multiply after bootstrapping")
+        self.multiplications += 1
+        out = fused_multiply_ciphertexts(c1, c2, self.tk)
+        self.check(out)
+        return out
+
+
+# Modulus switching: evaluate a circuit at decreasing precisions as it uses up its
+# depth. Later gates then work on narrower integers and look up fewer digits,
+# which makes them cheaper (a multiplication costs about dim**2 * precision / 2
+# digit additions). Switching doesn't add depth, it only spends headroom that
+# the rest of the circuit doesn't need.
+#
+# The ladder has a transit key for each of `precisions`: the ones given in `keys`
+# (eg. generated for that precision), and otherwise `tk` truncated to it with
+# truncate_transit_key the first time it's needed. Pass the ladder in place of
+# the transit key to Circuit.run, which calls switch_pairs before each level of
+# AND gates; called directly, it just multiplies at the lower of the two input
+# precisions
+class ModulusLadder:
+    def __init__(self, tk, precisions, margin=3, keys=None):
+        self.tk, self.margin = tk, margin
+        self.full = tk.pairs[0][0].digits[0].precision
+        self.keys = {self.full: tk, **(keys or {})}
+        self.precisions = sorted(set(precisions) | set(self.keys))
+
+    def key_for(self, precision):
+        if precision not in self.keys:
+            self.keys[precision] = truncate_transit_key(self.tk, precision)
+        return self.keys[precision]
+
+    # Build the keys for every precision on the ladder now, rather than when they
+    # are first used. Done before handing the ladder to a pool of workers, so that
+    # they all inherit the keys instead of each truncating the transit key itself
+    def prepare(self):
+        for precision in self.precisions:
+            if precision <= self.full:
+                self.key_for(precision)
+        return self
+
+    # Noise of the digits of the key for `precision`, without building it
+    def key_noise(self, precision):
+        if precision in self.keys:
+            return self.keys[precision].pairs[0][0].digits[0].noise
+        digit = self.tk.pairs[0][0].digits[0]
+        return adjusted_noise(digit.noise, len(digit.values), self.full, precision)
+
+    # Whether ciphertexts with noise `noise` and `length` values, switched from
+    # `current` to `precision`, stay decryptable through `depth` more levels of
+    # multiplication
+    def survives(self, noise, length, current, precision, depth):
+        key_noise = self.key_noise(precision)
+        noise = adjusted_noise(noise, length, current, precision)
+        for _ in range(depth):
+            noise = multiplication_noise(noise, noise, length, precision, key_noise)
+            if noise is None or noise >= noise_limit(precision, self.margin):
+                return False
+        return True
+
+    # The lowest precision on the ladder that survives `depth` more levels
+    def precision_for(self, noise, length, current, depth):
+        for precision in self.precisions:
+            if precision <= current and self.survives(
+                noise, length, current, precision, depth
+            ):
+                return precision
+        return current
+
+    # Switch the inputs of one level of AND gates, with `depth` levels (including
+    # this one) left to go, to the lowest precision that is safe for all of them
+    def switch_pairs(self, pairs, depth):
+        cts = [c for pair in pairs for c in pair if not isinstance(c, Constant)]
+        if not cts or any(c.noise is None for c in cts):
+            return pairs
+        current = min(c.precision for c in cts)
+        noisiest = max(
+            adjusted_noise(c.noise, len(c.values), c.precision, current) for c in cts
+        )
+        precision = self.precision_for(noisiest, len(cts[0].values), current, depth)
+        self.key_for(precision)
+        return [
+            tuple(adjust_ciphertext_precision(c, precision) for c in pair)
+            for pair in pairs
+        ]
+
+    def multiply(self, c1, c2):
+        c1, c2 = match_precision(c1, c2)
+        return fused_multiply_ciphertexts(c1, c2, self.key_for(c1.precision))
@@ -0,0 +1,206 @@
+# Counters, timers and nested spans for seeing where the time goes, plus the
+# progress messages that used to be plain prints.
+#
+# Nothing is recorded unless a Recorder is active, and the hooks in the hot paths
+# check `instrumentation.active is not None` first, so the cost when it's off is
+# one attribute lookup. Use it as
+#
+#     with instrumentation.recording() as rec:
+#         total = multi_add(...)
+#     print(rec.to_json(indent=2))
+#
+# - counters: number of times something happened (or a total size), by name
+# - timers: number of calls and total seconds, by name
+# - spans: a tree of timed phases (eg. multi_add > three_to_two), each with
+#   the counters that changed while it was open
+# Work done in pool workers is not recorded, only the time the main process spends
+# waiting for it. Messages go to log(), which prints them if `verbose` is set (the
+# default) and also records them if a recorder is active.
+
+import functools
+import json
+import time
+
+# The current Recorder, or None
+active = None
+# Whether log() prints messages
+verbose = True
+
+
+class Recorder:
+    # `callback`, if given, is called with an event dict for every finished span
+    # and every message, eg. to stream them somewhere
+    def __init__(self, callback=None):
+        self.counters = {}
+        self.timers = {}  # name -> [calls, seconds]
+        self.spans = []  # finished top-level spans
+        self.stack = []  # open spans
+        self.messages = []
+        self.callback = callback
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+
+    def log(self, message):
+        self.messages.append(message)
+        if self.callback is not None:
+            self.callback({"event": "log", "message": message})
+
+    def span(self, name):
+        return Span(self, name)
+
+    def timer(self, name):
+        return Timer(self, name)
+
+    def to_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "timers": {
+                name: {"calls": calls, "seconds": seconds}
+                for name, (calls, seconds) in self.timers.items()
+            },
+            "spans": self.spans,
+            "messages": self.messages,
+        }
+
+    def to_json(self, indent=None):
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_json(indent=2))
+
+
+# A timed phase. Spans opened inside it become its children
+class Span:
+    def __init__(self, recorder, name):
+        self.recorder, self.name = recorder, name
+
+    def __enter__(self):
+        self.node = {"name": self.name, "seconds": None, "counters": {}, "spans": []}
+        self.counters = dict(self.recorder.counters)
+        self.recorder.stack.append(self.node)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        recorder, node = self.recorder, self.node
+        node["seconds"] = seconds
+        node["counters"] = {
+            name: n - self.counters.get(name, 0)
+            for name, n in recorder.counters.items()
+            if n != self.counters.get(name, 0)
+        }
+        recorder.stack.pop()
+        (recorder.stack[-1]["spans"] if recorder.stack else recorder.spans).append(node)
+        recorder.add_time(self.name, seconds)
+        if recorder.callback is not None:
+            recorder.callback(
+                {
+                    "event": "span",
+                    "name": self.name,
+                    "depth": len(recorder.stack),
+                    "seconds": seconds,
+                    "counters": node["counters"],
+                }
+            )
+        return False
+
+
+# Like a span, but only added to the timers, for things that happen too often to
+# keep a tree node for each
+class Timer:
+    def __init__(self, recorder, name):
+        self.recorder, self.name = recorder, name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.recorder.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_CONTEXT = NullContext()
+
+
+def count(name, n=1):
+    if active is not None:
+        active.count(name, n)
+
+
+def span(name):
+    return NULL_CONTEXT if active is None else active.span(name)
+
+
+def timer(name):
+    return NULL_CONTEXT if active is None else active.timer(name)
+
+
+def log(message):
+    if active is not None:
+        active.log(message)
+    if verbose:
+        print(message)
+
+
+# Decorator that records calls to a function in the timer (or, with span=True,
+# as a span) `name`
+def timed(name, span=False):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active is None:
+                return function(*args, **kwargs)
+            with active.span(name) if span else active.timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def enable(recorder=None):
+    global active
+    active = recorder or Recorder()
+    return active
+
+
+def disable():
+    global active
+    recorder, active = active, None
+    return recorder
+
+
+# Record everything inside a with block, restoring whatever was active before
+class recording:
+    def __init__(self, recorder=None, quiet=False):
+        self.recorder, self.quiet = recorder or Recorder(), quiet
+
+    def __enter__(self):
+        global active, verbose
+        self.previous = active, verbose
+        active = self.recorder
+        if self.quiet:
+            verbose = False
+        return self.recorder
+
+    def __exit__(self, *exc):
+        global active, verbose
+        active, verbose = self.previous
+        return False
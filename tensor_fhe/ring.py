@@ -0,0 +1,376 @@
+# Ring variant of the scheme: keys and ciphertexts are polynomials in
+# R_q = Z_q[x]/(x^n + 1), with q = 2**precision as before and n a power of two.
+#
+# The secret s is a polynomial with coefficients in {-1, 0, 1}. A ciphertext of a
+# bit m is a pair of polynomials (c0, c1) with
+#
+#     c0 + c1*s = m*q/2 + e (mod q)
+#
+# for a small error polynomial e, ie. the message sits in the constant
+# coefficient and the other coefficients of the phase are just error. Adding
+# ciphertexts adds the messages mod 2, and flip() adds q/2, so XOR and NOT work
+# as for the LWE ciphertexts.
+#
+# AND is the scale-invariant tensor product (Brakerski, Fan-Vercauteren): with
+# the coefficients of both ciphertexts lifted to (-q/2, q/2], the product of the
+# phases is d0 + d1*s + d2*s^2 over the integers, and rounding (2/q)*d gives an
+# encryption of m*m' under (1, s, s^2). The transit key gets rid of the s^2 term
+# the same way mk_transit_key does for the s[i]*s[j]: it holds encryptions of
+# s^2 * 2**(k*digit_bits) for every digit k, so that d2*s^2 is the sum over k of
+# digit k of d2 times the k-th encryption. A transit key from s to a different
+# key t also holds encryptions of s * 2**(k*digit_bits), to switch the d1 term.
+#
+# Polynomial products go through a negacyclic number theoretic transform, modulo
+# a prime P = 1 mod 2n that is big enough for the products of lifted coefficients
+# to be exact, so that they can then be reduced mod the power of two q. The
+# transit key is kept transformed. An AND costs 4 + precision/digit_bits forward
+# and 5 inverse transforms of O(n log n) each, and the transit key is
+# 2*precision/digit_bits polynomials, where an LWE transit key of the same
+# dimension has about n**2 * precision / 2 ciphertexts of n values each.
+#
+# The functions here mirror the ones in homomorphic_encryption.py, and the gates
+# and adders there (_and, _or, encoded_add, multi_add, circuit.py, ...) work
+# unchanged with ring ciphertexts and a RingTransitKey in place of the transit
+# key. There is no ring bootstrapping.
+
+from dataclasses import dataclass, field
+import functools
+import math
+import random
+
+import instrumentation
+
+from homomorphic_encryption import ERROR_BITS, Constant, add_noise, bit_length
+
+# Error coefficients are uniform in [-2**ERROR_BITS, 2**ERROR_BITS]
+RING_NOISE_BOUND = 2**ERROR_BITS
+# Root mean square of an error coefficient
+RING_FRESH_NOISE = math.sqrt(RING_NOISE_BOUND * (RING_NOISE_BOUND + 1) / 3)
+
+
+# Deterministic enough for a toy: a composite passes all 32 rounds with
+# probability below 4**-32
+def is_probable_prime(n, rounds=32):
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d, r = d // 2, r + 1
+    rng = random.Random(n)
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(r - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def bit_reverse(k, bits):
+    return int(format(k, "0{}b".format(bits))[::-1], 2) if bits else 0
+
+
+# Negacyclic NTT of size n modulo a prime P = 1 mod 2n of at least `bits` bits.
+# forward() leaves the values in bit-reversed order and inverse() expects them
+# that way, which is fine since in between they are only multiplied pointwise
+class NTT:
+    def __init__(self, n, bits):
+        assert n >= 2 and n & (n - 1) == 0, "n must be a power of two"
+        self.n = n
+        k = (2**bits) // (2 * n) + 1
+        while not is_probable_prime(k * 2 * n + 1):
+            k += 1
+        P = self.modulus = k * 2 * n + 1
+        # A primitive 2n-th root of unity: psi**n = -1
+        g = 2
+        while pow(pow(g, (P - 1) // (2 * n), P), n, P) != P - 1:
+            g += 1
+        psi = pow(g, (P - 1) // (2 * n), P)
+        levels = n.bit_length() - 1
+        self.psi = [pow(psi, bit_reverse(k, levels), P) for k in range(n)]
+        self.psi_inverse = [pow(x, P - 2, P) for x in self.psi]
+        self.n_inverse = pow(n, P - 2, P)
+
+    def forward(self, poly):
+        P, n = self.modulus, self.n
+        a = [x % P for x in poly]
+        t, m = n, 1
+        while m < n:
+            t //= 2
+            for i in range(m):
+                start, w = 2 * i * t, self.psi[m + i]
+                low, high = a[start : start + t], a[start + t : start + 2 * t]
+                high = [x * w % P for x in high]
+                a[start : start + t] = [(x + y) % P for x, y in zip(low, high)]
+                a[start + t : start + 2 * t] = [(x - y) % P for x, y in zip(low, high)]
+            m *= 2
+        return a
+
+    # The inverse transform, with the result lifted to (-P/2, P/2], so that it is
+    # the exact product as long as that is within the range
+    def inverse(self, values):
+        P, n = self.modulus, self.n
+        a = list(values)
+        t, m = 1, n
+        while m > 1:
+            h = m // 2
+            for i in range(h):
+                start, w = 2 * i * t, self.psi_inverse[h + i]
+                low, high = a[start : start + t], a[start + t : start + 2 * t]
+                a[start : start + t] = [(x + y) % P for x, y in zip(low, high)]
+                a[start + t : start + 2 * t] = [
+                    (x - y) * w % P for x, y in zip(low, high)
+                ]
+            t, m = 2 * t, h
+        half, scale = P // 2, self.n_inverse
+        return [y - P if y > half else y for y in (x * scale % P for x in a)]
+
+    @staticmethod
+    def pointwise(a, b, P):
+        return [x * y % P for x, y in zip(a, b)]
+
+
+# The transform for polynomials of degree < n with coefficients mod 2**precision.
+# P fits the sum of two products of lifted coefficients: 2 * n * (q/2)**2
+@functools.lru_cache(maxsize=None)
+def ring_ntt(n, precision):
+    return NTT(n, 2 * precision + n.bit_length() + 2)
+
+
+# Product of two polynomials in Z[x]/(x^n + 1), exact for coefficients bounded
+# as for ring_ntt
+def poly_multiply(a, b, ntt):
+    P = ntt.modulus
+    return ntt.inverse(NTT.pointwise(ntt.forward(a), ntt.forward(b), P))
+
+
+# Coefficients mod q lifted to (-q/2, q/2]
+def centered(poly, precision):
+    half, q = 2 ** (precision - 1), 2**precision
+    return [x - q if x > half else x for x in poly]
+
+
+def generate_key(n, precision):
+    return [random.choice((-1, 0, 1)) for _ in range(n)]
+
+
+@dataclass
+class RingCiphertext:
+    c0: list
+    c1: list
+    precision: int
+    # Estimated root mean square of the error coefficients, see RING_FRESH_NOISE
+    noise: float = field(default=None, compare=False)
+
+    def __post_init__(self):
+        if instrumentation.active is not None:
+            instrumentation.active.count("ciphertexts")
+
+    def __add__(self, other):
+        if isinstance(other, Constant):
+            return other + self
+        if instrumentation.active is not None:
+            instrumentation.active.count("additions")
+        assert self.precision == other.precision and len(self.c0) == len(other.c0)
+        mask = 2**self.precision - 1
+        return RingCiphertext(
+            c0=[(x + y) & mask for x, y in zip(self.c0, other.c0)],
+            c1=[(x + y) & mask for x, y in zip(self.c1, other.c1)],
+            precision=self.precision,
+            noise=add_noise(self.noise, other.noise),
+        )
+
+    # Convert 0 to 1 or 1 to 0, by adding q/2 to the constant coefficient
+    def flip(self):
+        return RingCiphertext(
+            c0=[self.c0[0] ^ 2 ** (self.precision - 1)] + self.c0[1:],
+            c1=self.c1,
+            precision=self.precision,
+            noise=self.noise,
+        )
+
+
+# Encryptions of the polynomials `messages` (lists of coefficients, taken mod q)
+# under `key`. All randomness comes from `rng`
+def partial_encrypt_many(key, messages, precision, rng=None):
+    rng = rng or random
+    n, mask = len(key), 2**precision - 1
+    ntt = ring_ntt(n, precision)
+    key_transform = ntt.forward(key)
+    instrumentation.count("encryptions", len(messages))
+    out = []
+    for message in messages:
+        a = [rng.getrandbits(precision) for _ in range(n)]
+        a_s = ntt.inverse(
+            NTT.pointwise(
+                ntt.forward(centered(a, precision)), key_transform, ntt.modulus
+            )
+        )
+        errors = [rng.randint(-RING_NOISE_BOUND, RING_NOISE_BOUND) for _ in range(n)]
+        c0 = [(m + e - x) & mask for m, e, x in zip(message, errors, a_s)]
+        out.append(RingCiphertext(c0, a, precision, RING_FRESH_NOISE))
+    return out
+
+
+def encrypt_many(key, messages, precision, rng=None):
+    n = len(key)
+    return partial_encrypt_many(
+        key,
+        [[m * 2 ** (precision - 1)] + [0] * (n - 1) for m in messages],
+        precision,
+        rng,
+    )
+
+
+def encrypt(key, message, precision):
+    return encrypt_many(key, [message], precision)[0]
+
+
+# The constant coefficient of c0 + c1*s mod q. Only needs one coefficient of the
+# negacyclic product: c1[0]*s[0] - sum of c1[i]*s[n-i]
+def phase_constant(key, ct):
+    c1 = ct.c1
+    total = ct.c0[0] + c1[0] * key[0] - sum(c1[i] * key[-i] for i in range(1, len(c1)))
+    return total & (2**ct.precision - 1)
+
+
+def decrypt(key, ct):
+    if isinstance(ct, Constant):
+        return ct.value
+    p = ct.precision
+    return 1 if 2 ** (p - 2) < phase_constant(key, ct) <= 3 * 2 ** (p - 2) else 0
+
+
+def binary_decrypt(key, output):
+    return sum([decrypt(key, o) << i for i, o in enumerate(output)])
+
+
+# Bits of the largest error coefficient
+def error_bits(key, ct):
+    p = ct.precision
+    ntt = ring_ntt(len(key), p)
+    c1_s = poly_multiply(centered(ct.c1, p), key, ntt)
+    phase = [(x + y) & (2**p - 1) for x, y in zip(ct.c0, c1_s)]
+    phase[0] = (phase[0] - decrypt(key, ct) * 2 ** (p - 1)) & (2**p - 1)
+    return bit_length(max(abs(x) for x in centered(phase, p)))
+
+
+# Noise of the product of ciphertexts with noise n1 and n2, in n coefficients.
+# With c.s = m*q/2 + e + q*r, where r has coefficients of about sqrt(n/18) (the
+# lifted c1 times a ternary s, over q), the rounded tensor product has error
+# 2*(e1*r2 + e2*r1) + m1*e2 + m2*e1 + 2*e1*e2/q, plus the rounding of d0, d1 and
+# d2 times 1, s and s^2, plus the digits of d2 (about 2**digit_bits/sqrt(3))
+# times the errors of the transit key
+def ring_multiplication_noise(n1, n2, n, precision, digit_bits, key_noise):
+    if n1 is None or n2 is None:
+        return None
+    r = math.sqrt(n / 18)
+    tensor = 2 * math.sqrt(n) * r * (n1 + n2) + n1 + n2
+    tensor += 2 * math.sqrt(n) * n1 * n2 / 2**precision
+    rounding = 1 + math.sqrt(n / 18) + n / 5
+    digits = -(-precision // digit_bits)
+    relinearization = math.sqrt(digits * n) * 2**digit_bits / math.sqrt(3) * key_noise
+    return tensor + rounding + relinearization
+
+
+# Encryptions of key * 2**(k*digit_bits) under `target`, transformed, for every
+# digit k of a coefficient
+def digit_encryptions(key, target, precision, digit_bits, rng):
+    ntt = ring_ntt(len(key), precision)
+    messages = [
+        [x * 2 ** (k * digit_bits) for x in key]
+        for k in range(0, -(-precision // digit_bits))
+    ]
+    return [
+        (
+            ntt.forward(centered(ct.c0, precision)),
+            ntt.forward(centered(ct.c1, precision)),
+        )
+        for ct in partial_encrypt_many(target, messages, precision, rng)
+    ]
+
+
+@dataclass
+class RingTransitKey:
+    n: int
+    precision: int
+    digit_bits: int
+    # Transformed (c0, c1) of s^2 * 2**(k*digit_bits) under the target key
+    square: list
+    # The same for s, if the target key isn't s
+    linear: list = None
+    noise: float = RING_FRESH_NOISE
+
+    def multiply(self, c1, c2):
+        return ring_multiply(c1, c2, self)
+
+
+# Digits of base 2**digit_bits make the transit key and the multiplication cost
+# precision/digit_bits transforms, for 2**digit_bits times more key noise per digit
+def mk_transit_key(s, t, precision, digit_bits=4, rng=None):
+    rng = rng or random
+    n = len(s)
+    assert len(t) == n
+    square = poly_multiply(s, s, ring_ntt(n, precision))
+    return RingTransitKey(
+        n=n,
+        precision=precision,
+        digit_bits=digit_bits,
+        square=digit_encryptions(square, t, precision, digit_bits, rng),
+        linear=(
+            None if s == t else digit_encryptions(s, t, precision, digit_bits, rng)
+        ),
+    )
+
+
+# Add digit k of every coefficient of `poly` (in [0, q)) times the k-th of the
+# transformed encryptions to the transformed sums acc0 and acc1
+def add_digit_products(acc0, acc1, poly, encryptions, digit_bits, ntt):
+    P, mask = ntt.modulus, 2**digit_bits - 1
+    for k, (b, a) in enumerate(encryptions):
+        digit = ntt.forward([(x >> (k * digit_bits)) & mask for x in poly])
+        acc0[:] = [(x + d * y) % P for x, d, y in zip(acc0, digit, b)]
+        acc1[:] = [(x + d * y) % P for x, d, y in zip(acc1, digit, a)]
+
+
+@instrumentation.timed("ring_multiply")
+def ring_multiply(c1, c2, tk):
+    instrumentation.count("multiplications")
+    precision, n = c1.precision, tk.n
+    assert precision == c2.precision == tk.precision and len(c1.c0) == n
+    ntt, mask = ring_ntt(n, precision), 2**precision - 1
+    P = ntt.modulus
+    a0, a1, b0, b1 = (
+        ntt.forward(centered(poly, precision)) for poly in (c1.c0, c1.c1, c2.c0, c2.c1)
+    )
+    tensor = [
+        ntt.pointwise(a0, b0, P),
+        [(x * y + z * w) % P for x, y, z, w in zip(a0, b1, a1, b0)],
+        ntt.pointwise(a1, b1, P),
+    ]
+    # round(2*d/q) mod q
+    half = 2 ** (precision - 1)
+    d0, d1, d2 = (
+        [((2 * x + half) >> precision) & mask for x in ntt.inverse(t)] for t in tensor
+    )
+    acc0, acc1 = [0] * n, [0] * n
+    add_digit_products(acc0, acc1, d2, tk.square, tk.digit_bits, ntt)
+    if tk.linear is not None:
+        add_digit_products(acc0, acc1, d1, tk.linear, tk.digit_bits, ntt)
+        d1 = [0] * n
+    out0, out1 = ntt.inverse(acc0), ntt.inverse(acc1)
+    return RingCiphertext(
+        c0=[(x + y) & mask for x, y in zip(d0, out0)],
+        c1=[(x + y) & mask for x, y in zip(d1, out1)],
+        precision=precision,
+        noise=ring_multiplication_noise(
+            c1.noise, c2.noise, n, precision, tk.digit_bits, tk.noise
+        ),
+    )
@@ -0,0 +1,329 @@
+# Compact binary file format for keys, so that they only need to be generated once.
+#
+# Every file starts with a 64 byte header: magic, format version, kind of object
+# and the shape parameters, followed by ciphertexts. A ciphertext is stored as its
+# values in order, each as a fixed-width little-endian integer of
+# slot_width(precision) // 8 bytes, which is exactly the byte layout of a
+# PackedVector, so a packed ciphertext is read with a single int.from_bytes.
+#
+# Transit keys are stored component by component (pairs[0][0], pairs[1][0],
+# pairs[1][1], pairs[2][0], ...), each component being its `precision` digits. Every
+# digit is at a fixed, computable offset, so a transit key is loaded lazily through
+# mmap: opening it only reads the header, and get_combination_for reads (and the OS
+# pages in) just the digits it uses. Processes that map the same file share the
+# pages through the OS page cache. The body is laid out like a PackedPairs buffer,
+# so contiguous keys are saved with a single write.
+#
+# Seed-compressed ciphertexts (see SeededVector) are stored as just their first
+# value followed by their 16 byte seed, which is flagged in the header. Keys are
+# stored compressed whenever all their ciphertexts are.
+
+import mmap
+import struct
+
+from homomorphic_encryption import (
+    BootstrappingKey,
+    Ciphertext,
+    PackedPairs,
+    PackedVector,
+    PublicKey,
+    SeededVector,
+    TransitKey,
+    TransitKeyComponent,
+    pack_vector,
+    slot_width,
+)
+
+MAGIC = b"TFHE"
+FORMAT_VERSION = 2
+# Version 1 is the same format without the compressed flag
+SUPPORTED_VERSIONS = (1, 2)
+HEADER_SIZE = 64
+
+KIND_TRANSIT_KEY = 1
+KIND_BOOTSTRAPPING_KEY = 2
+KIND_PUBLIC_KEY = 3
+KIND_CIPHERTEXTS = 4
+
+# magic, version, kind, then up to 5 kind-specific unsigned ints and the flags
+HEADER_FORMAT = "<4sHH6I"
+
+FLAG_COMPRESSED = 1
+SEED_SIZE = 16
+
+
+def pack_header(kind, *fields, compressed=False):
+    fields = fields + (0,) * (5 - len(fields)) + (FLAG_COMPRESSED * compressed,)
+    header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, kind, *fields)
+    return header + b"\0" * (HEADER_SIZE - len(header))
+
+
+# Returns the kind-specific fields, and whether the ciphertexts are compressed
+def unpack_header(data, kind):
+    magic, version, found_kind, *fields = struct.unpack_from(HEADER_FORMAT, data)
+    if magic != MAGIC:
+        raise ValueError("not a tensor_fhe key file")
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError("unsupported format version {}".format(version))
+    if found_kind != kind:
+        raise ValueError("expected object kind {}, found {}".format(kind, found_kind))
+    return fields[:5], bool(fields[5] & FLAG_COMPRESSED)
+
+
+# Whether ciphertexts can be stored compressed
+def is_compressed(cts):
+    return all(isinstance(ct.values, SeededVector) for ct in cts)
+
+
+# Size in bytes of a stored ciphertext
+def ciphertext_nbytes_on_disk(length, precision, compressed=False):
+    if compressed:
+        return slot_width(precision) // 8 + SEED_SIZE
+    return length * slot_width(precision) // 8
+
+
+def ciphertext_to_bytes(ct, compressed=False):
+    if compressed:
+        values = ct.values
+        size = slot_width(ct.precision) // 8
+        return values.first.to_bytes(size, "little") + values.seed.to_bytes(
+            SEED_SIZE, "little"
+        )
+    size = ciphertext_nbytes_on_disk(len(ct.values), ct.precision)
+    return pack_vector(ct.values, ct.precision).slots.to_bytes(size, "little")
+
+
+def ciphertext_from_bytes(data, length, precision, packed=True, compressed=False):
+    if compressed:
+        values = SeededVector(
+            int.from_bytes(data[:-SEED_SIZE], "little"),
+            int.from_bytes(data[-SEED_SIZE:], "little"),
+            length,
+            precision,
+        )
+    else:
+        values = PackedVector(int.from_bytes(data, "little"), length, precision)
+    return Ciphertext(values if packed else values.tolist(), precision)
+
+
+# Write ciphertexts, which must all have the same shape
+def write_ciphertexts(f, cts, compressed=False):
+    for ct in cts:
+        f.write(ciphertext_to_bytes(ct, compressed))
+
+
+def read_ciphertexts(
+    data, offset, count, length, precision, packed=True, compressed=False
+):
+    size = ciphertext_nbytes_on_disk(length, precision, compressed)
+    return [
+        ciphertext_from_bytes(
+            data[offset + k * size : offset + (k + 1) * size],
+            length,
+            precision,
+            packed,
+            compressed,
+        )
+        for k in range(count)
+    ]
+
+
+def save_transit_key(tk, path):
+    digit = tk.pairs[0][0].digits[0]
+    precision, length = digit.precision, len(digit.values)
+    if isinstance(tk.pairs, PackedPairs):
+        # Already in the file layout
+        with open(path, "wb") as f:
+            f.write(
+                pack_header(
+                    KIND_TRANSIT_KEY,
+                    precision,
+                    length,
+                    len(tk.pairs),
+                    compressed=tk.pairs.compressed,
+                )
+            )
+            f.write(tk.pairs.digit_bytes())
+        return
+    compressed = all(is_compressed(c.digits) for row in tk.pairs for c in row)
+    with open(path, "wb") as f:
+        f.write(
+            pack_header(
+                KIND_TRANSIT_KEY,
+                precision,
+                length,
+                len(tk.pairs),
+                compressed=compressed,
+            )
+        )
+        for row in tk.pairs:
+            for component in row:
+                assert len(component.digits) == precision
+                write_ciphertexts(f, component.digits, compressed)
+
+
+# The digits of one component of a mapped transit key. Looks like a list of
+# ciphertexts, but only reads a digit from the file when it's accessed
+class MappedDigits:
+    def __init__(self, data, offset, precision, length, packed, compressed=False):
+        self.data, self.offset = data, offset
+        self.precision, self.length, self.packed = precision, length, packed
+        self.compressed = compressed
+        self.size = ciphertext_nbytes_on_disk(length, precision, compressed)
+
+    def __len__(self):
+        return self.precision
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.precision))]
+        if index < 0:
+            index += self.precision
+        if not 0 <= index < self.precision:
+            raise IndexError("digit index out of range")
+        start = self.offset + index * self.size
+        return ciphertext_from_bytes(
+            self.data[start : start + self.size],
+            self.length,
+            self.precision,
+            self.packed,
+            self.compressed,
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(self.precision))
+
+
+# Stands in for TransitKey.pairs of a mapped transit key: pairs[i][j] for j <= i.
+# The file body has the layout of a PackedPairs buffer, so packed, uncompressed
+# keys are read through one straight from the mapped pages. Otherwise component
+# objects with MappedDigits are created on first use and then kept, so they can
+# be used as keys of a WindowTableCache
+class MappedPairs(PackedPairs):
+    def __init__(self, path, packed=True):
+        self.path, self.packed = path, packed
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fields, self.compressed = unpack_header(data, KIND_TRANSIT_KEY)
+        precision, length, rows = fields[:3]
+        super().__init__(data, rows, length, precision, offset=HEADER_SIZE)
+        self.component_size = precision * ciphertext_nbytes_on_disk(
+            length, precision, self.compressed
+        )
+        if len(data) != HEADER_SIZE + self.nbytes:
+            raise ValueError("transit key file has the wrong size")
+
+    def component(self, i, j):
+        if self.packed and not self.compressed:
+            return super().component(i, j)
+        assert 0 <= j <= i < self.rows
+        if (i, j) not in self.components:
+            digits = MappedDigits(
+                self.data,
+                self.component_offset(i, j),
+                self.precision,
+                self.length,
+                self.packed,
+                self.compressed,
+            )
+            self.components[i, j] = TransitKeyComponent(digits=digits)
+        return self.components[i, j]
+
+    # Pickle as the path, so that pool workers map the file themselves instead of
+    # receiving a copy of it
+    def __reduce__(self):
+        return (MappedPairs, (self.path, self.packed))
+
+
+# Open a transit key saved with save_transit_key. Nothing but the header is read
+# until the key is used
+def load_transit_key(path, packed=True):
+    return TransitKey(pairs=MappedPairs(path, packed))
+
+
+def save_bootstrapping_key(bk, path):
+    ct = bk.zero
+    compressed = is_compressed([bk.zero, bk.one] + [c for b in bk.values for c in b])
+    with open(path, "wb") as f:
+        f.write(
+            pack_header(
+                KIND_BOOTSTRAPPING_KEY,
+                ct.precision,
+                len(ct.values),
+                len(bk.values),
+                len(bk.values[0]),
+                bk.short_precision,
+                compressed=compressed,
+            )
+        )
+        write_ciphertexts(f, [bk.zero, bk.one], compressed)
+        for bits in bk.values:
+            write_ciphertexts(f, bits, compressed)
+
+
+def load_bootstrapping_key(path, packed=True):
+    with open(path, "rb") as f:
+        data = f.read()
+    fields, compressed = unpack_header(data, KIND_BOOTSTRAPPING_KEY)
+    precision, length, rows, bits, short_precision = fields
+    cts = read_ciphertexts(
+        data, HEADER_SIZE, 2 + rows * bits, length, precision, packed, compressed
+    )
+    return BootstrappingKey(
+        values=[cts[2 + i * bits : 2 + (i + 1) * bits] for i in range(rows)],
+        zero=cts[0],
+        one=cts[1],
+        short_precision=short_precision,
+        long_precision=precision,
+    )
+
+
+def save_public_key(pk, path):
+    ct = pk.samples[0]
+    compressed = is_compressed(pk.samples)
+    with open(path, "wb") as f:
+        f.write(
+            pack_header(
+                KIND_PUBLIC_KEY,
+                ct.precision,
+                len(ct.values),
+                len(pk.samples),
+                compressed=compressed,
+            )
+        )
+        write_ciphertexts(f, pk.samples, compressed)
+
+
+def load_public_key(path, packed=True):
+    with open(path, "rb") as f:
+        data = f.read()
+    fields, compressed = unpack_header(data, KIND_PUBLIC_KEY)
+    precision, length, count = fields[:3]
+    return PublicKey(
+        samples=read_ciphertexts(
+            data, HEADER_SIZE, count, length, precision, packed, compressed
+        )
+    )
+
+
+# Lists of ciphertexts of one shape, eg. the bits of an encoded integer. Fresh
+# compressed encryptions are sent compressed
+def ciphertexts_to_bytes(cts):
+    ct = cts[0]
+    compressed = is_compressed(cts)
+    header = pack_header(
+        KIND_CIPHERTEXTS,
+        ct.precision,
+        len(ct.values),
+        len(cts),
+        compressed=compressed,
+    )
+    return header + b"".join(ciphertext_to_bytes(c, compressed) for c in cts)
+
+
+def ciphertexts_from_bytes(data, packed=True):
+    fields, compressed = unpack_header(data, KIND_CIPHERTEXTS)
+    precision, length, count = fields[:3]
+    return read_ciphertexts(
+        data, HEADER_SIZE, count, length, precision, packed, compressed
+    )
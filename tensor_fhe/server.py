@@ -0,0 +1,516 @@
+# An evaluation service: an asyncio server that keeps the transit and bootstrapping
+# keys resident and evaluates gates for clients that only hold ciphertexts.
+#
+#     python server.py --transit-key tk.bin --bootstrapping-key bk.bin --port 7040
+#
+# Requests and responses are length-prefixed frames on a TCP connection. A request
+# is an operation and its arguments, each argument a record as written by
+# serialization.ciphertexts_to_bytes (a single ciphertext is a record of one). A
+# client can send any number of requests without waiting, and responses come back
+# as they are ready, tagged with the request id.
+#
+# Requests from all connections go into one queue. The batcher takes whatever is
+# queued (waiting up to `max_delay` after the first request for more to arrive),
+# groups the requests by operation and ciphertext shape, and runs each group as
+# one batch (see batch.py) on a pool of worker processes, each of which receives
+# the keys once when it starts. So many clients multiplying at the same time cost
+# about one walk over the transit key per batch instead of one per request.
+#
+# Back-pressure: at most `max_batches` batches run at a time, and at most
+# `max_pending` requests wait in the queue. When the queue is full, connections
+# stop being read until there's room, so TCP flow control slows the clients down
+# instead of the server buffering without bound.
+#
+# Every response carries the time the request spent queued, its total time in
+# the server and the size of the batch it ran in, and the server keeps the same
+# numbers for the most recent requests of every operation (see
+# EvaluationServer.metrics).
+
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import statistics
+import struct
+import time
+
+import instrumentation
+
+from batch import batch_bootstrap, batch_encoded_add, multiply_batches, stack, unstack
+from homomorphic_encryption import materialize
+from serialization import (
+    HEADER_SIZE,
+    KIND_CIPHERTEXTS,
+    ciphertext_nbytes_on_disk,
+    ciphertexts_from_bytes,
+    ciphertexts_to_bytes,
+    load_bootstrapping_key,
+    load_transit_key,
+    unpack_header,
+)
+
+OP_ADD = 1
+OP_MULTIPLY = 2
+OP_ENCODED_ADD = 3
+OP_BOOTSTRAP = 4
+
+# name and number of arguments of every operation
+OPERATIONS = {
+    OP_ADD: ("add", 2),
+    OP_MULTIPLY: ("multiply", 2),
+    OP_ENCODED_ADD: ("encoded_add", 2),
+    OP_BOOTSTRAP: ("bootstrap", 1),
+}
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# size of the rest of the frame, request id, operation, number of records
+REQUEST_HEADER = struct.Struct("<IQBB")
+# size of the rest of the frame, request id, status, number of records, batch
+# size, seconds queued, seconds in the server. An error has its message as body
+RESPONSE_HEADER = struct.Struct("<IQBBIdd")
+
+# Requests of each operation that EvaluationServer.metrics looks at
+METRICS_WINDOW = 10000
+
+
+# Split the body of a frame into its records, using the size in each header
+def split_records(data, count):
+    records, offset = [], 0
+    for _ in range(count):
+        if offset + HEADER_SIZE > len(data):
+            raise ValueError("truncated request")
+        header = data[offset : offset + HEADER_SIZE]
+        fields, compressed = unpack_header(header, KIND_CIPHERTEXTS)
+        precision, length, cts = fields[:3]
+        size = HEADER_SIZE + cts * ciphertext_nbytes_on_disk(
+            length, precision, compressed
+        )
+        if offset + size > len(data):
+            raise ValueError("truncated request")
+        records.append(data[offset : offset + size])
+        offset += size
+    if offset != len(data):
+        raise ValueError("trailing data in request")
+    return records
+
+
+# Precision, ciphertext length and number of ciphertexts of a record. Only
+# requests whose arguments have the same shapes go into one batch
+def record_shape(record):
+    fields = unpack_header(record, KIND_CIPHERTEXTS)[0]
+    return fields[0], fields[1], fields[2]
+
+
+# Check the records of a request against what `op` takes and the shape of the
+# transit key, so that a malformed request is turned away before it is batched
+# with others
+def check_records(op, records, precision, length):
+    for record in records:
+        record_precision, record_length, count = record_shape(record)
+        if (record_precision, record_length) != (precision, length):
+            raise ValueError(
+                "ciphertexts must have precision {} and length {}".format(
+                    precision, length
+                )
+            )
+        if count == 0 or (op != OP_ENCODED_ADD and count != 1):
+            raise ValueError(
+                "{} takes {} ciphertexts per argument".format(
+                    OPERATIONS[op][0], "at least one" if op == OP_ENCODED_ADD else 1
+                )
+            )
+
+
+# Each worker keeps its own copy of the keys for its whole lifetime. A transit key
+# opened with load_transit_key is sent as its path and mapped by every worker
+_worker_tk = None
+_worker_bk = None
+
+
+def _init_worker(tk, bk):
+    global _worker_tk, _worker_bk
+    _worker_tk, _worker_bk = tk, bk
+    instrumentation.verbose = False
+
+
+# Evaluate one batch of requests of the same operation in a worker. Takes and
+# returns records, so the event loop never decodes a ciphertext. Every job gets
+# its own result, the output record or the exception it failed with: jobs that
+# can't be decoded fail on their own, and if the batch fails, its jobs are run
+# one by one, so that a bad job doesn't fail the others
+def _run_batch(op, jobs):
+    results, args, decoded = [None] * len(jobs), [], []
+    for k, job in enumerate(jobs):
+        try:
+            args.append([ciphertexts_from_bytes(record) for record in job])
+            decoded.append(k)
+        except Exception as e:
+            results[k] = ValueError("bad ciphertext: {}".format(e))
+    try:
+        outputs = _evaluate(op, args) if args else []
+    except Exception:
+        outputs = []
+        for arg in args:
+            try:
+                outputs += _evaluate(op, [arg])
+            except Exception as e:
+                outputs.append(e)
+    for k, output in zip(decoded, outputs):
+        results[k] = output
+    return results
+
+
+def _evaluate(op, args):
+    if op == OP_ADD:
+        outputs = [[a[0] + b[0]] for a, b in args]
+    elif op == OP_MULTIPLY:
+        a, b = (stack([arg[k][0] for arg in args]) for k in range(2))
+        outputs = [[ct] for ct in unstack(multiply_batches(a, b, _worker_tk))]
+    elif op == OP_ENCODED_ADD:
+        outputs = batch_encoded_add(
+            [a for a, b in args], [b for a, b in args], _worker_tk
+        )
+    else:
+        if _worker_bk is None:
+            raise ValueError("the server has no bootstrapping key")
+        cts = batch_bootstrap([arg[0][0] for arg in args], _worker_bk, _worker_tk)
+        outputs = [[ct] for ct in cts]
+    return [
+        ciphertexts_to_bytes([materialize(bit, arg[0][0]) for bit in output])
+        for output, arg in zip(outputs, args)
+    ]
+
+
+# A request waiting for its result
+@dataclass(eq=False)
+class Job:
+    id: int
+    op: int
+    records: list
+    future: asyncio.Future
+    received: float = field(default_factory=time.perf_counter)
+
+
+class EvaluationServer:
+    # `tk` and `bk` are the keys (bk is only needed for bootstrapping). Batches
+    # have at most `max_batch` requests, and run on `processes` workers, at most
+    # `max_batches` at a time (default 2 per worker, so that a worker never waits
+    # for the next batch to be formed)
+    def __init__(
+        self,
+        tk,
+        bk=None,
+        processes=2,
+        max_batch=64,
+        max_delay=0.005,
+        max_pending=1024,
+        max_batches=None,
+    ):
+        self.tk, self.bk, self.processes = tk, bk, processes
+        digit = tk.pairs[0][0].digits[0]
+        self.precision, self.length = digit.precision, len(digit.values)
+        self.max_batch, self.max_delay = max_batch, max_delay
+        self.max_pending = max_pending
+        self.max_batches = max_batches or 2 * processes
+        # op -> recent (seconds queued, seconds in the server, batch size)
+        self.latencies = {op: deque(maxlen=METRICS_WINDOW) for op in OPERATIONS}
+        self.requests = dict.fromkeys(OPERATIONS, 0)
+        self.errors = 0
+        self.batches = 0
+
+    # Start listening, returning the (host, port) the server is bound to. Port 0
+    # picks a free port
+    async def start(self, host="127.0.0.1", port=0):
+        self.queue = asyncio.Queue(self.max_pending)
+        self.running = asyncio.Semaphore(self.max_batches)
+        self.executor = ProcessPoolExecutor(
+            self.processes, initializer=_init_worker, initargs=(self.tk, self.bk)
+        )
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.batcher = asyncio.ensure_future(self.batch_loop())
+        self.batch_tasks = set()
+        self.address = self.server.sockets[0].getsockname()[:2]
+        return self.address
+
+    # Stop accepting requests, finish the batches that are running and fail the
+    # requests still queued. The pool is shut down in a thread, so the event loop
+    # keeps running meanwhile
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        await asyncio.gather(*self.batch_tasks)
+        while not self.queue.empty():
+            self.queue.get_nowait().future.set_exception(
+                ConnectionError("the server is closing")
+            )
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def serve_forever(self):
+        await self.server.serve_forever()
+
+    # Read requests from one connection until it's closed. Responses are written
+    # as the results come in, so they can be out of order
+    async def handle(self, reader, writer):
+        lock, replies = asyncio.Lock(), set()
+        try:
+            while True:
+                try:
+                    size, id, op, count = REQUEST_HEADER.unpack(
+                        await reader.readexactly(REQUEST_HEADER.size)
+                    )
+                    body = await reader.readexactly(size)
+                except asyncio.IncompleteReadError:
+                    break
+                future = asyncio.get_running_loop().create_future()
+                reply = asyncio.ensure_future(self.reply(writer, lock, id, future))
+                replies.add(reply)
+                reply.add_done_callback(replies.discard)
+                try:
+                    if op not in OPERATIONS:
+                        raise ValueError("unknown operation {}".format(op))
+                    if count != OPERATIONS[op][1]:
+                        raise ValueError(
+                            "{} takes {} arguments".format(*OPERATIONS[op])
+                        )
+                    if op == OP_BOOTSTRAP and self.bk is None:
+                        raise ValueError("the server has no bootstrapping key")
+                    records = split_records(body, count)
+                    check_records(op, records, self.precision, self.length)
+                    job = Job(id, op, records, future)
+                except ValueError as e:
+                    future.set_exception(e)
+                    continue
+                self.requests[op] += 1
+                # Waits (and stops reading) while the queue is full
+                await self.queue.put(job)
+            await asyncio.gather(*replies)
+        finally:
+            writer.close()
+
+    async def reply(self, writer, lock, id, future):
+        try:
+            records, batch_size, queued, seconds = await future
+            status, body = STATUS_OK, b"".join(records)
+        except Exception as e:
+            self.errors += 1
+            records, batch_size, queued, seconds = [], 0, 0.0, 0.0
+            status, body = STATUS_ERROR, str(e).encode()
+        header = RESPONSE_HEADER.pack(
+            len(body), id, status, len(records), batch_size, queued, seconds
+        )
+        async with lock:
+            writer.write(header + body)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    # Form batches out of the queued requests and start them
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(jobs) < self.max_batch:
+                if not self.queue.empty():
+                    jobs.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    jobs.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            groups = {}
+            for job in jobs:
+                key = (job.op,) + tuple(map(record_shape, job.records))
+                groups.setdefault(key, []).append(job)
+            for group in groups.values():
+                await self.running.acquire()
+                task = asyncio.ensure_future(self.run_batch(group))
+                self.batch_tasks.add(task)
+                task.add_done_callback(self.batch_tasks.discard)
+
+    async def run_batch(self, jobs):
+        try:
+            started = time.perf_counter()
+            self.batches += 1
+            try:
+                outputs = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, _run_batch, jobs[0].op, [j.records for j in jobs]
+                )
+            except Exception as e:
+                for job in jobs:
+                    job.future.set_exception(e)
+                return
+            finished = time.perf_counter()
+            for job, output in zip(jobs, outputs):
+                if isinstance(output, Exception):
+                    job.future.set_exception(output)
+                    continue
+                queued, seconds = started - job.received, finished - job.received
+                self.latencies[job.op].append((queued, seconds, len(jobs)))
+                job.future.set_result(([output], len(jobs), queued, seconds))
+        finally:
+            self.running.release()
+
+    # Latency and batching statistics of the recent requests of every operation
+    def metrics(self):
+        operations = {}
+        for op, (name, _) in OPERATIONS.items():
+            latencies = self.latencies[op]
+            if not latencies:
+                continue
+            seconds = sorted(s for _, s, _ in latencies)
+            operations[name] = {
+                "requests": self.requests[op],
+                "mean": statistics.mean(seconds),
+                "p50": seconds[len(seconds) // 2],
+                "p95": seconds[int(len(seconds) * 0.95)],
+                "max": seconds[-1],
+                "mean_queued": statistics.mean(q for q, _, _ in latencies),
+                "mean_batch": statistics.mean(b for _, _, b in latencies),
+            }
+        return {
+            "operations": operations,
+            "pending": self.queue.qsize(),
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+# The result of a request, with the server's numbers for it
+@dataclass
+class Response:
+    outputs: list
+    batch_size: int
+    # seconds queued and in total in the server, and the round trip as seen by
+    # the client
+    queued: float
+    seconds: float
+    round_trip: float
+
+
+class EvaluationClient:
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.pending = {}  # request id -> (future, time sent)
+        self.next_id = 0
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=7040):
+        return cls(*await asyncio.open_connection(host, port))
+
+    async def close(self):
+        self.writer.close()
+        await self.receiver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def receive(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(RESPONSE_HEADER.size)
+                size, id, status, count, batch_size, queued, seconds = (
+                    RESPONSE_HEADER.unpack(header)
+                )
+                body = await self.reader.readexactly(size)
+                future, sent = self.pending.pop(id)
+                if status != STATUS_OK:
+                    future.set_exception(RuntimeError(body.decode()))
+                    continue
+                outputs = [
+                    ciphertexts_from_bytes(r) for r in split_records(body, count)
+                ]
+                round_trip = time.perf_counter() - sent
+                future.set_result(
+                    Response(outputs, batch_size, queued, seconds, round_trip)
+                )
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("connection closed"))
+            self.pending.clear()
+
+    # Send a request and wait for its Response. `args` are lists of ciphertexts
+    async def call(self, op, *args):
+        id, self.next_id = self.next_id, self.next_id + 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id] = future, time.perf_counter()
+        body = b"".join(ciphertexts_to_bytes(arg) for arg in args)
+        self.writer.write(REQUEST_HEADER.pack(len(body), id, op, len(args)) + body)
+        await self.writer.drain()
+        return await future
+
+    async def add(self, c1, c2):
+        return (await self.call(OP_ADD, [c1], [c2])).outputs[0][0]
+
+    async def multiply(self, c1, c2):
+        return (await self.call(OP_MULTIPLY, [c1], [c2])).outputs[0][0]
+
+    async def encoded_add(self, a, b):
+        return (await self.call(OP_ENCODED_ADD, a, b)).outputs[0]
+
+    async def bootstrap(self, ct):
+        return (await self.call(OP_BOOTSTRAP, [ct])).outputs[0][0]
+
+
+async def serve(args):
+    tk = load_transit_key(args.transit_key)
+    bk = None
+    if args.bootstrapping_key:
+        bk = load_bootstrapping_key(args.bootstrapping_key)
+    server = EvaluationServer(
+        tk,
+        bk,
+        processes=args.processes,
+        max_batch=args.max_batch,
+        max_delay=args.max_delay,
+        max_pending=args.max_pending,
+    )
+    host, port = await server.start(args.host, args.port)
+    instrumentation.log("Listening on {}:{}".format(host, port))
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="tensor_fhe evaluation server")
+    parser.add_argument("--transit-key", required=True, help="saved transit key")
+    parser.add_argument("--bootstrapping-key", help="saved bootstrapping key")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7040)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay", type=float, default=0.005)
+    parser.add_argument("--max-pending", type=int, default=1024)
+    asyncio.run(serve(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
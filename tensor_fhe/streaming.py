@@ -0,0 +1,154 @@
+# Streaming encryption and decryption of integers, for datasets that don't fit in
+# memory at once.
+#
+# encrypt_stream takes any iterable of integers and yields their encodings one by
+# one, and decrypt_stream does the reverse. Both read their input lazily and work
+# in chunks of `chunk_size` integers: a chunk is encrypted with one call to
+# encrypt_many (so its randomness comes in bulk), and at most `prefetch` chunks
+# are in progress at a time, on a pool of `processes` workers if given. So memory
+# use is bounded by a few chunks, however long the input is, and the workers stay
+# busy while the consumer handles the previous results.
+#
+# write_encodings and read_encodings store a stream of encodings in a file, one
+# record (as serialization.ciphertexts_to_bytes) after another.
+
+from collections import deque
+import itertools
+import multiprocessing
+import random
+
+from homomorphic_encryption import (
+    PublicKey,
+    binary_decrypt,
+    derive_seed,
+    encrypt_many,
+    encrypt_pk_many,
+)
+from serialization import (
+    HEADER_SIZE,
+    KIND_CIPHERTEXTS,
+    ciphertext_nbytes_on_disk,
+    ciphertexts_from_bytes,
+    ciphertexts_to_bytes,
+    unpack_header,
+)
+
+
+# Lists of up to `size` consecutive items
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Yields function(task) for every task, in order. With a pool, at most `prefetch`
+# tasks (default 2 per worker) are submitted ahead of the one being yielded, and
+# `tasks` is only read as far as that. Workers reseed their random generator, so
+# that they don't all encrypt with the random state they inherited. The pool is
+# shut down when the generator is closed, even if it wasn't run to the end
+def stream_map(function, tasks, processes=None, prefetch=None):
+    if processes is None or processes <= 1:
+        yield from map(function, tasks)
+        return
+    prefetch = prefetch or 2 * processes
+    pool = multiprocessing.Pool(processes, random.seed)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(function, (task,)))
+            if len(pending) >= prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _encrypt_chunk(task):
+    key, integers, bits, precision, packed, compressed, seed = task
+    messages = [(x >> i) % 2 for x in integers for i in range(bits)]
+    if isinstance(key, PublicKey):
+        cts = encrypt_pk_many(key, messages, packed, random.Random(seed))
+    else:
+        cts = encrypt_many(
+            key, messages, precision, packed, random.Random(seed), compressed
+        )
+    return [cts[k : k + bits] for k in range(0, len(cts), bits)]
+
+
+# Encrypt every integer into `bits` fresh ciphertexts (least significant first).
+# Every chunk has its own seed derived from `seed`, so the output only depends
+# on `seed` and `chunk_size`, not on the number of processes. `key` can also be
+# a PublicKey (then `precision` and `compressed` are ignored)
+def encrypt_stream(
+    key,
+    integers,
+    bits,
+    precision,
+    packed=False,
+    compressed=False,
+    chunk_size=64,
+    processes=None,
+    prefetch=None,
+    seed=None,
+):
+    if seed is None:
+        seed = random.getrandbits(64)
+    tasks = (
+        (
+            key,
+            chunk,
+            bits,
+            precision,
+            packed,
+            compressed,
+            derive_seed(seed, "stream", i),
+        )
+        for i, chunk in enumerate(chunked(integers, chunk_size))
+    )
+    for encodings in stream_map(_encrypt_chunk, tasks, processes, prefetch):
+        yield from encodings
+
+
+def _decrypt_chunk(task):
+    key, encodings = task
+    return [binary_decrypt(key, e) for e in encodings]
+
+
+# Decrypt every encoding back into an integer
+def decrypt_stream(key, encodings, chunk_size=64, processes=None, prefetch=None):
+    tasks = ((key, chunk) for chunk in chunked(encodings, chunk_size))
+    for integers in stream_map(_decrypt_chunk, tasks, processes, prefetch):
+        yield from integers
+
+
+# Write encodings to a binary file as they come, returning how many were written.
+# All ciphertexts of one encoding must have the same shape
+def write_encodings(f, encodings):
+    count = 0
+    for encoding in encodings:
+        f.write(ciphertexts_to_bytes(encoding))
+        count += 1
+    return count
+
+
+# Read back encodings written with write_encodings, one at a time. Each record's
+# header gives its size, so only one record is in memory at once
+def read_encodings(f, packed=True):
+    while True:
+        header = f.read(HEADER_SIZE)
+        if not header:
+            return
+        if len(header) != HEADER_SIZE:
+            raise ValueError("truncated ciphertext stream")
+        fields, compressed = unpack_header(header, KIND_CIPHERTEXTS)
+        precision, length, count = fields[:3]
+        size = count * ciphertext_nbytes_on_disk(length, precision, compressed)
+        body = f.read(size)
+        if len(body) != size:
+            raise ValueError("truncated ciphertext stream")
+        yield ciphertexts_from_bytes(header + body, packed)
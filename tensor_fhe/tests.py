@@ -1,6 +1,16 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
 import random
+import tempfile
 
+import instrumentation
+import ring
 from homomorphic_encryption import (
+    ERROR_BITS,
     encrypt,
     decrypt,
     binary_encode,
@@ -9,6 +19,7 @@ from homomorphic_encryption import (
     error_bits,
     binary_decrypt,
     multiply_ciphertexts,
+    fused_multiply_ciphertexts,
     generate_key,
     bit_length,
     adjust_ciphertext_precision,
@@ -16,10 +27,95 @@ from homomorphic_encryption import (
     encoded_add3,
     multi_add,
     partial_decrypt,
+    encrypt_many,
+    partial_encrypt_many,
+    mk_public_key,
+    PublicKey,
+    encrypt_pk,
+    encrypt_pk_many,
     mk_bootstrapping_key,
     bootstrap,
     flatten_ciphertext,
     flatten_key,
+    pack_ciphertext,
+    unpack_ciphertext,
+    sum_ciphertexts,
+    prod,
+    PackedVector,
+    TransitKey,
+    TransitKeyComponent,
+    WindowTableCache,
+    PackedPairs,
+    pack_transit_key,
+    mk_key_switching_key,
+    switch_key,
+    enable_window_tables,
+    derive_seed,
+    print_progress,
+    SeededVector,
+    expand_ciphertexts,
+    Constant,
+    PLAIN_ZERO,
+    PLAIN_ONE,
+    materialize,
+    constant_encode,
+    _and,
+    _or,
+    noise_bits,
+    noise_exceeded,
+    AutoBootstrap,
+    ModulusLadder,
+    truncate_transit_key,
+    match_precision,
+    encoded_multiply,
+    encoded_equal,
+    encoded_less_than,
+    encoded_select,
+)
+from serialization import (
+    save_transit_key,
+    load_transit_key,
+    save_bootstrapping_key,
+    load_bootstrapping_key,
+    save_public_key,
+    load_public_key,
+    ciphertexts_to_bytes,
+    ciphertexts_from_bytes,
+    ciphertext_to_bytes,
+    pack_header,
+    KIND_CIPHERTEXTS,
+)
+from circuit import (
+    Circuit,
+    circuit_cost,
+    parallel_encoded_add,
+    parallel_multi_add,
+)
+from streaming import (
+    decrypt_stream,
+    encrypt_stream,
+    read_encodings,
+    write_encodings,
+)
+from server import (
+    OP_ADD,
+    OP_MULTIPLY,
+    _init_worker,
+    _run_batch,
+    EvaluationClient,
+    EvaluationServer,
+)
+from batch import (
+    BatchKey,
+    batch_bootstrap,
+    batch_encoded_add,
+    batch_multi_add,
+    multiply_batches,
+    stack,
+    stack_bits,
+    stack_encodings,
+    unstack,
+    unstack_encodings,
 )
 
 SHORT_PRECISION = 12
@@ -27,20 +123,30 @@ MEDIUM_PRECISION = 48
 LARGE_PRECISION = 112
 
 
-def generate_keys(precision):
+# With a seed, the keys and the encryptions of 0 and 1 only depend on the seed
+def generate_keys(precision, processes=None, seed=None):
     print("Generating keys for {} bit precision".format(precision))
-    s = generate_key(17, precision)
-    zero = encrypt(s, 0, precision)
-    one = encrypt(s, 1, precision)
-    tk = mk_transit_key(s, s, precision)
+    rng = None if seed is None else random.Random(derive_seed(seed, "s"))
+    s = generate_key(17, precision, rng)
+    zero, one = encrypt_many(s, [0, 1], precision, rng=rng)
+    tk = mk_transit_key(
+        s,
+        s,
+        precision,
+        processes=processes,
+        seed=seed,
+        progress=print_progress("Transit key") if processes else None,
+    )
     return s, zero, one, tk
 
 
-def generate_all_keys():
+# The precisions are generated one after another, each on its own pool of
+# `processes` workers, with a seed derived from `seed`
+def generate_all_keys(processes=None, seed=None):
+    seed = random.getrandbits(64) if seed is None else seed
     return {
-        SHORT_PRECISION: generate_keys(SHORT_PRECISION),
-        MEDIUM_PRECISION: generate_keys(MEDIUM_PRECISION),
-        LARGE_PRECISION: generate_keys(LARGE_PRECISION),
+        precision: generate_keys(precision, processes, derive_seed(seed, precision))
+        for precision in (SHORT_PRECISION, MEDIUM_PRECISION, LARGE_PRECISION)
         # huge_precision: generate_keys(huge_precision),
     }
 
@@ -89,6 +195,663 @@ def test_multiadd(values, keys):
     assert binary_decrypt(S, z[:bitcount]) == sum(values)
 
 
+# Cross-check the packed backend against the list-of-ints reference
+def test_packed(precision):
+    print("Testing packed ciphertexts at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision)
+    packed_tk = TransitKey(
+        pairs=[
+            [
+                TransitKeyComponent(digits=[pack_ciphertext(d) for d in c.digits])
+                for c in row
+            ]
+            for row in tk.pairs
+        ]
+    )
+    cts = [encrypt(s, i % 2, precision) for i in range(6)]
+    packed = [pack_ciphertext(c) for c in cts]
+    for c, p in zip(cts, packed):
+        assert isinstance(p.values, PackedVector)
+        assert p == c and unpack_ciphertext(p) == c
+        assert list(p.values) == c.values and p.values[1:] == c.values[1:]
+        assert prod(p.values, s, precision) == prod(c.values, s, precision)
+        assert decrypt(s, p) == decrypt(s, c)
+        assert p.flip() == c.flip() and decrypt(s, p.flip()) == 1 - decrypt(s, c)
+    assert packed[0] + packed[1] == cts[0] + cts[1]
+    assert packed[0] + cts[1] == cts[0] + packed[1] == cts[0] + cts[1]
+    assert sum_ciphertexts(packed) == sum_ciphertexts(cts)
+    assert decrypt(s, sum_ciphertexts(packed)) == 1
+    for a, b in [(0, 1), (1, 3), (3, 5)]:
+        product = multiply_ciphertexts(packed[a], packed[b], packed_tk)
+        assert isinstance(product.values, PackedVector)
+        assert product == multiply_ciphertexts(cts[a], cts[b], tk)
+        assert decrypt(s, product) == (a % 2) * (b % 2)
+    fresh = encrypt(s, 1, precision, packed=True)
+    assert isinstance(fresh.values, PackedVector) and decrypt(s, fresh) == 1
+    short = adjust_ciphertext_precision(fresh, SHORT_PRECISION)
+    assert isinstance(short.values, PackedVector) and decrypt(s, short) == 1
+
+
+# Window tables must give exactly the same combinations as bit-by-bit sums,
+# including when the memory budget forces components to be evicted
+def test_window_tables(precision):
+    print("Testing window tables at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    component = tk.pairs[3][1]
+    for window in (1, 3, 4, 8):
+        cache = WindowTableCache(window)
+        for index in [0, 1, 2**precision - 1] + [
+            random.randrange(2**precision) for _ in range(10)
+        ]:
+            assert component.get_combination_for(
+                index, cache
+            ) == component.get_combination_for(index)
+    cts = [encrypt(s, i % 2, precision, packed=True) for i in range(4)]
+    expected = [multiply_ciphertexts(a, b, tk) for a in cts for b in cts]
+    enable_window_tables(tk, window=4)
+    assert [multiply_ciphertexts(a, b, tk) for a in cts for b in cts] == expected
+    assert tk.window_cache.hits > 0
+    # Budget for only a few components at a time
+    budget = 3 * max(nbytes for _, _, nbytes in tk.window_cache.tables.values())
+    enable_window_tables(tk, window=4, max_bytes=budget)
+    assert [multiply_ciphertexts(a, b, tk) for a in cts for b in cts] == expected
+    assert 0 < tk.window_cache.nbytes <= budget
+    enable_window_tables(tk, window=4, max_bytes=0)
+    assert multiply_ciphertexts(cts[1], cts[3], tk) == expected[7]
+    assert not tk.window_cache.tables
+
+
+# A contiguous transit key holds the same digits as the one made of ciphertexts,
+# so every way of multiplying gives identical results
+def test_contiguous_transit_key(precision):
+    print("Testing contiguous transit keys at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True, seed=4)
+    contiguous = mk_transit_key(s, s, precision, seed=4, contiguous=True)
+    assert isinstance(contiguous.pairs, PackedPairs)
+    assert contiguous == mk_transit_key(
+        s, s, precision, seed=4, contiguous=True, processes=2
+    )
+    assert pack_transit_key(tk) == contiguous
+    for i in (0, 7, len(tk.pairs) - 1):
+        for j in (0, i // 2, i):
+            assert list(contiguous.pairs[i][j].digits) == tk.pairs[i][j].digits
+    assert contiguous.pairs[3][2] is contiguous.pairs[3][2]
+    component = contiguous.pairs[9][4]
+    for index in (0, 1, 2**precision - 1, random.randrange(2**precision)):
+        expected = tk.pairs[9][4].get_combination_for(index)
+        assert component.get_combination_for(index) == expected
+        assert component.get_combination_for(index, WindowTableCache(3)) == expected
+    cts = encrypt_many(s, [1, 0, 1], precision, packed=True)
+    for a, b in itertools.product(cts, repeat=2):
+        product = fused_multiply_ciphertexts(a, b, contiguous)
+        assert product == fused_multiply_ciphertexts(a, b, tk)
+        assert product.noise == fused_multiply_ciphertexts(a, b, tk).noise
+    assert decrypt(s, multiply_ciphertexts(cts[0], cts[2], contiguous)) == 1
+    assert unstack(multiply_batches(stack(cts), stack(cts), contiguous)) == unstack(
+        multiply_batches(stack(cts), stack(cts), tk)
+    )
+    assert pickle.loads(pickle.dumps(contiguous)) == contiguous
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tk")
+        save_transit_key(contiguous, path)
+        assert load_transit_key(path).pairs == contiguous.pairs
+        save_transit_key(tk, path)
+        assert load_transit_key(path).pairs == contiguous.pairs
+
+
+def test_fused_multiply(precision):
+    print("Testing fused multiplication at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision)
+    packed_tk = mk_transit_key(s, s, precision, packed=True)
+    for a in range(2):
+        for b in range(2):
+            c1, c2 = encrypt(s, a, precision), encrypt(s, b, precision)
+            reference = multiply_ciphertexts(c1, c2, tk)
+            fused = fused_multiply_ciphertexts(c1, c2, tk)
+            assert decrypt(s, fused) == decrypt(s, reference) == a * b
+            assert error_bits(s, fused) <= error_bits(s, reference) + 1
+            fused = fused_multiply_ciphertexts(c1, c2, packed_tk)
+            assert isinstance(fused.values, PackedVector)
+            assert decrypt(s, fused) == a * b
+    x = encrypt(s, 1, precision)
+    for i in range(5):
+        x = fused_multiply_ciphertexts(x, x, packed_tk)
+    assert decrypt(s, x) == 1
+
+
+def test_encrypt_many(precision):
+    print("Testing batch encryption at {} bit precision".format(precision))
+    s = generate_key(17, precision)
+    bits = [random.randrange(2) for _ in range(300)]
+    for packed in (False, True):
+        cts = encrypt_many(s, bits, precision, packed, random.Random(42))
+        assert [decrypt(s, c) for c in cts] == bits
+        assert max(error_bits(s, c) for c in cts) <= ERROR_BITS + 1
+        assert cts == encrypt_many(s, bits, precision, not packed, random.Random(42))
+        assert cts != encrypt_many(s, bits, precision, packed, random.Random(43))
+    messages = [random.randrange(2**precision) for _ in range(10)]
+    for ct, m in zip(partial_encrypt_many(s, messages, precision), messages):
+        error = (partial_decrypt(s, ct) - m) % 2**precision
+        assert min(error, 2**precision - error) <= 2**ERROR_BITS
+    pk = mk_public_key(s, precision, rng=random.Random(1))
+    assert len(pk.samples) == 100 and all(decrypt(s, c) == 0 for c in pk.samples)
+    tk = mk_transit_key(s[:4], s[:4], precision, rng=random.Random(7))
+    assert tk == mk_transit_key(s[:4], s[:4], precision, rng=random.Random(7))
+    c1, c2 = encrypt(s[:4], 1, precision), encrypt(s[:4], 1, precision)
+    assert decrypt(s[:4], multiply_ciphertexts(c1, c2, tk)) == 1
+
+
+# Keygen on a pool gives exactly the same keys as keygen in one process
+def test_parallel_keygen(precision):
+    print("Testing parallel key generation at {} bit precision".format(precision))
+    s = generate_key(4, precision)
+    reports = []
+    tk = mk_transit_key(
+        s, s, precision, seed=5, processes=2, progress=lambda *r: reports.append(r)
+    )
+    assert tk == mk_transit_key(s, s, precision, seed=5)
+    assert tk != mk_transit_key(s, s, precision, seed=6)
+    assert reports[-1][0] == reports[-1][1] and reports[-1][2] == 0
+    assert [d for d, _, _ in reports] == sorted(d for d, _, _ in reports)
+    bk = mk_bootstrapping_key(s, s, precision, SHORT_PRECISION, seed=9, processes=2)
+    assert bk == mk_bootstrapping_key(s, s, precision, SHORT_PRECISION, seed=9)
+    assert [[decrypt(s, b) for b in bits] for bits in bk.values] == [
+        [(x >> j) % 2 for j in range(ERROR_BITS + 1)] for x in s
+    ]
+    assert decrypt(s, bk.zero) == 0 and decrypt(s, bk.one) == 1
+    keys = generate_keys(SHORT_PRECISION, seed=3)
+    assert keys == generate_keys(SHORT_PRECISION, processes=2, seed=3)
+    assert keys[0] != generate_keys(SHORT_PRECISION, seed=4)[0]
+
+
+def test_serialization(precision):
+    print("Testing key serialization at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision)
+    bk = mk_bootstrapping_key(s, s, precision, SHORT_PRECISION, packed=True)
+    pk = mk_public_key(s, precision)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, name) for name in ("tk", "bk", "pk")]
+        save_transit_key(tk, paths[0])
+        save_bootstrapping_key(bk, paths[1])
+        save_public_key(pk, paths[2])
+        for packed in (True, False):
+            loaded = load_transit_key(paths[0], packed)
+            assert len(loaded.pairs) == len(tk.pairs)
+            for i in (0, 7, len(tk.pairs) - 1):
+                for j in (0, i // 2, i):
+                    assert list(loaded.pairs[i][j].digits) == tk.pairs[i][j].digits
+            assert loaded.pairs[3][2] is loaded.pairs[3][2]
+            c1, c2 = encrypt(s, 1, precision), encrypt(s, 1, precision)
+            product = fused_multiply_ciphertexts(c1, c2, loaded)
+            assert product == fused_multiply_ciphertexts(c1, c2, tk)
+            assert decrypt(s, product) == 1
+            unpickled = pickle.loads(pickle.dumps(loaded))
+            assert unpickled.pairs[9][4].digits[5] == tk.pairs[9][4].digits[5]
+        assert load_bootstrapping_key(paths[1]) == bk
+        assert load_public_key(paths[2], packed=False) == pk
+        try:
+            load_public_key(paths[1])
+            assert False, "loaded a bootstrapping key as a public key"
+        except ValueError:
+            pass
+    cts = [encrypt(s, i % 2, precision) for i in range(5)]
+    assert ciphertexts_from_bytes(ciphertexts_to_bytes(cts), packed=False) == cts
+
+
+# Seed-compressed ciphertexts decrypt and multiply like ordinary ones, and are
+# stored and sent compressed
+def test_seeded(precision):
+    print("Testing seed-compressed ciphertexts at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    bits = [random.randrange(2) for _ in range(20)]
+    cts = encrypt_many(s, bits, precision, rng=random.Random(3), compressed=True)
+    assert all(isinstance(c.values, SeededVector) for c in cts)
+    assert [decrypt(s, c) for c in cts] == bits
+    assert max(error_bits(s, c) for c in cts) <= ERROR_BITS + 1
+    assert expand_ciphertexts(cts) == cts
+    assert pickle.loads(pickle.dumps(cts)) == cts
+    assert len(pickle.dumps(cts[0])) < len(pickle.dumps(expand_ciphertexts(cts)[0]))
+    data = ciphertexts_to_bytes(cts)
+    assert len(data) < len(ciphertexts_to_bytes(expand_ciphertexts(cts)))
+    assert ciphertexts_from_bytes(data) == cts
+    tk = mk_transit_key(s, s, precision, seed=2, compressed=True)
+    assert tk == mk_transit_key(s, s, precision, seed=2, processes=2, compressed=True)
+    bk = mk_bootstrapping_key(s, s, precision, SHORT_PRECISION, seed=4, compressed=True)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, name) for name in ("tk", "bk")]
+        save_transit_key(tk, paths[0])
+        save_bootstrapping_key(bk, paths[1])
+        loaded = load_transit_key(paths[0])
+        assert os.path.getsize(paths[0]) < sum(
+            len(ciphertext_to_bytes(d))
+            for row in tk.pairs
+            for c in row
+            for d in c.digits
+        )
+        assert load_bootstrapping_key(paths[1]) == bk
+    for a in range(2):
+        for b in range(2):
+            c1, c2 = cts[a], cts[2 + b]
+            product = fused_multiply_ciphertexts(c1, c2, loaded)
+            assert product == fused_multiply_ciphertexts(c1, c2, tk)
+            assert decrypt(s, product) == bits[a] * bits[2 + b]
+
+
+# Gates with constant inputs are folded without using the transit key
+def test_constants(precision):
+    print("Testing constant folding at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision)
+    for m in range(2):
+        c = encrypt(s, m, precision)
+        assert PLAIN_ZERO + c is c and c + PLAIN_ZERO is c
+        assert PLAIN_ONE + c == c.flip() == c + PLAIN_ONE
+        assert _and(PLAIN_ZERO, c, tk) is PLAIN_ZERO and _and(c, PLAIN_ONE, tk) is c
+        assert _or(c, PLAIN_ONE, tk) is PLAIN_ONE and _or(PLAIN_ZERO, c, tk) is c
+        for packed in (False, True):
+            like = encrypt(s, 0, precision, packed)
+            assert decrypt(s, materialize(PLAIN_ONE, like) + c) == 1 - m
+            trivial = materialize(Constant(m), like)
+            assert partial_decrypt(s, trivial) == m << (precision - 1)
+    assert PLAIN_ONE + PLAIN_ONE == PLAIN_ZERO == PLAIN_ONE.flip()
+    x, y = random.randrange(8), random.randrange(8)
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+    encx = binary_encode(x, 3, zero, one)
+    assert binary_decrypt(s, encoded_add(encx, constant_encode(y, 3), tk)) == x + y
+    # Adding a constant needs fewer AND gates than adding a ciphertext
+    circuit = Circuit()
+    a, b = circuit.inputs([encx, constant_encode(y, 3)])
+    folded = circuit.levels(encoded_add(a, b, circuit))
+    b = circuit.inputs(binary_encode(y, 3, zero, one))
+    full = circuit.levels(encoded_add(a, b, circuit))
+    assert sum(map(len, folded)) < sum(map(len, full))
+
+
+# The noise estimates stay above the actual error through every operation
+def test_noise(precision):
+    print("Testing noise estimates at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+    for c in [zero, one] + encrypt_many(s, [0, 1], precision, compressed=True):
+        assert c.noise is not None and error_bits(s, c) <= noise_bits(c)
+    x, y = one, zero
+    for i in range(5):
+        x, y = fused_multiply_ciphertexts(x, x + y, tk), x + y
+        z = multiply_ciphertexts(y, y, tk)
+        for c in (x, y, z, x.flip(), adjust_ciphertext_precision(z, SHORT_PRECISION)):
+            assert error_bits(s, c) <= noise_bits(c)
+    assert noise_exceeded(x, margin=precision - noise_bits(x))
+    assert not noise_exceeded(one) and not noise_exceeded(PLAIN_ONE)
+    out = encoded_add(
+        binary_encode(11, 4, zero, one), binary_encode(6, 4, zero, one), tk
+    )
+    assert all(error_bits(s, o) <= noise_bits(o) for o in out)
+    assert noise_bits(out[-1]) < precision - 2
+
+
+# Repeated squaring under AutoBootstrap only bootstraps when the noise estimate
+# gets close to the limit
+def test_auto_bootstrap(precision):
+    print("Testing automatic bootstrapping at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    bk = mk_bootstrapping_key(s, s, precision, SHORT_PRECISION, packed=True)
+    auto = AutoBootstrap(tk, bk, key=s)
+    x = encrypt(s, 1, precision)
+    while auto.bootstraps == 0:
+        x = _and(x, x, auto)
+    assert auto.multiplications > 5
+    x = _and(x, x, auto)
+    assert decrypt(s, x) == 1 and auto.bootstraps == 1
+
+
+# Evaluating an adder on a modulus ladder gives the same sum at lower precision
+def test_modulus_ladder(precision):
+    print("Testing modulus switching at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    low = precision // 2
+    c1, c2 = encrypt(s, 1, low, packed=True), encrypt(s, 1, low)
+    assert decrypt(s, _and(c1, c2, truncate_transit_key(tk, low))) == 1
+    ladder = ModulusLadder(tk, range(low, precision, 8))
+    c3 = encrypt(s, 1, precision)
+    a, b = match_precision(c3, c2)
+    assert a.precision == b.precision == low and decrypt(s, a) == 1
+    assert decrypt(s, _and(c3, c2, ladder)) == 1
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+    x, y = random.randrange(32), random.randrange(32)
+    a, b = binary_encode(x, 5, zero, one), binary_encode(y, 5, zero, one)
+    out = parallel_encoded_add(a, b, ladder)
+    assert binary_decrypt(s, out) == x + y
+    assert out[-1].precision < precision
+    assert all(error_bits(s, o) <= noise_bits(o) for o in out)
+    # With a pool, every key is built before the workers get the ladder
+    ladder = ModulusLadder(tk, range(low, precision, 8))
+    out = parallel_encoded_add(a, b, ladder, processes=2)
+    assert binary_decrypt(s, out) == x + y
+    assert set(ladder.keys) == set(ladder.precisions)
+
+
+# Counters and spans are recorded only while a recorder is active
+def test_instrumentation(precision):
+    print("Testing instrumentation at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+    values = [binary_encode(v, 2, zero, one) for v in (1, 2, 3)]
+    events = []
+    with instrumentation.recording(
+        instrumentation.Recorder(events.append), quiet=True
+    ) as rec:
+        total = multi_add(values, PLAIN_ZERO, tk, bits=3)
+        product = multiply_ciphertexts(one, one, tk)
+    assert binary_decrypt(s, total) == 6 and decrypt(s, product) == 1
+    counters = rec.counters
+    assert counters["multiplications"] == rec.timers["multiply"][0]
+    assert counters["digit_sums"] > counters["multiplications"]
+    assert counters["ciphertexts"] > 0 and counters["additions"] > 0
+    [span] = rec.spans
+    assert span["name"] == "multi_add"
+    assert [s["name"] for s in span["spans"]] == ["three_to_two", "final_add"]
+    assert span["counters"]["multiplications"] == counters["multiplications"] - 1
+    assert rec.messages == ["Multi adding 3 values"]
+    assert events[0]["event"] == "log" and events[-1]["name"] == "multi_add"
+    data = json.loads(rec.to_json())
+    assert data["counters"] == counters and data["spans"][0]["name"] == "multi_add"
+    assert instrumentation.active is None
+    multiply_ciphertexts(one, one, tk)
+    assert rec.counters["multiplications"] == counters["multiplications"]
+
+
+# Streams are read lazily, and give the same ciphertexts with or without a pool
+def test_streaming(precision):
+    print("Testing streaming encryption at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    values = [random.randrange(256) for _ in range(100)]
+    encodings = list(encrypt_stream(s, iter(values), 8, precision, seed=1))
+    assert len(encodings) == 100 and len(encodings[0]) == 8
+    assert encodings == list(
+        encrypt_stream(s, values, 8, precision, seed=1, processes=2, prefetch=1)
+    )
+    assert list(decrypt_stream(s, iter(encodings), chunk_size=7, processes=2)) == values
+    stream = encrypt_stream(s, itertools.count(), 4, precision, chunk_size=4)
+    assert [binary_decrypt(s, next(stream)) for _ in range(6)] == list(range(6))
+    stream.close()
+    with tempfile.TemporaryFile() as f:
+        stream = encrypt_stream(s, values, 8, precision, packed=True, compressed=True)
+        assert write_encodings(f, stream) == 100
+        f.seek(0)
+        assert list(decrypt_stream(s, read_encodings(f))) == values
+
+
+# Anyone with the public key can encrypt, and the results work like ordinary
+# encryptions
+def test_public_key(precision):
+    print("Testing public key encryption at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    pk = mk_public_key(s, precision, packed=True)
+    bits = [random.randrange(2) for _ in range(200)]
+    cts = encrypt_pk_many(pk, bits, packed=True)
+    assert [decrypt(s, c) for c in cts] == bits
+    assert all(error_bits(s, c) <= noise_bits(c) for c in cts)
+    assert encrypt_pk_many(pk, bits, rng=random.Random(2), window=3) == (
+        encrypt_pk_many(pk, bits, rng=random.Random(2))
+    )
+    assert len(set(c.values[0] for c in cts)) > 190
+    c = encrypt_pk(mk_public_key(s, precision), 1)
+    assert isinstance(c.values, list) and decrypt(s, c) == 1
+    tk = mk_transit_key(s, s, precision, packed=True)
+    assert decrypt(s, _and(cts[0], cts[1], tk)) == bits[0] & bits[1]
+    values = [random.randrange(64) for _ in range(10)]
+    stream = encrypt_stream(pk, values, 6, precision, chunk_size=3, processes=2)
+    assert list(decrypt_stream(s, stream)) == values
+    # Too short for the sums of the samples to decrypt, so no public key is made,
+    # and one made at a higher precision can't be used at this one either
+    short = generate_key(5, SHORT_PRECISION)
+    try:
+        mk_public_key(short, SHORT_PRECISION)
+        assert False, "made a public key that can't encrypt"
+    except ValueError:
+        pass
+    samples = [adjust_ciphertext_precision(c, SHORT_PRECISION) for c in pk.samples]
+    try:
+        encrypt_pk_many(PublicKey(samples), [1])
+        assert False, "encrypted with samples that are too noisy"
+    except ValueError:
+        pass
+
+
+# Concurrent requests to the evaluation server are batched, and give the same
+# results as evaluating them locally
+def test_server(precision):
+    print("Testing the evaluation server at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    bits = [random.randrange(2) for _ in range(32)]
+    cts = encrypt_many(s, bits, precision, packed=True)
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+    x, y = random.randrange(64), random.randrange(64)
+
+    async def run():
+        server = EvaluationServer(tk, processes=2, max_pending=4, max_delay=0.05)
+        host, port = await server.start()
+        async with await EvaluationClient.connect(host, port) as client:
+            products = await asyncio.gather(
+                *(client.call(OP_MULTIPLY, [a], [b]) for a, b in zip(cts, cts[16:]))
+            )
+            assert [decrypt(s, r.outputs[0][0]) for r in products] == [
+                a & b for a, b in zip(bits, bits[16:])
+            ]
+            assert max(r.batch_size for r in products) > 1
+            assert all(r.queued <= r.seconds <= r.round_trip for r in products)
+            assert products[0].outputs[0][0] == fused_multiply_ciphertexts(
+                cts[0], cts[16], tk
+            )
+            assert decrypt(s, await client.add(cts[0], cts[1])) == bits[0] ^ bits[1]
+            total = await client.encoded_add(
+                binary_encode(x, 6, zero, one), binary_encode(y, 6, zero, one)
+            )
+            assert binary_decrypt(s, total) == x + y
+            try:
+                await client.bootstrap(cts[0])
+                assert False
+            except RuntimeError as e:
+                assert "bootstrapping key" in str(e)
+            # A request with the wrong precision is turned away on its own
+            short = encrypt(generate_key(5, SHORT_PRECISION), 1, SHORT_PRECISION)
+            results = await asyncio.gather(
+                client.multiply(cts[0], cts[16]),
+                client.multiply(short, short),
+                client.multiply(cts[1], cts[17]),
+                return_exceptions=True,
+            )
+            assert isinstance(results[1], RuntimeError)
+            assert [decrypt(s, r) for r in results[::2]] == [
+                bits[0] & bits[16],
+                bits[1] & bits[17],
+            ]
+        metrics = server.metrics()
+        await server.close()
+        assert metrics["operations"]["multiply"]["requests"] == 18
+        assert metrics["batches"] < 21 and metrics["errors"] == 2
+
+    asyncio.run(run())
+    # Jobs that can't be decoded or evaluated fail without failing their batch
+    record = ciphertexts_to_bytes([cts[0]])
+    empty = pack_header(KIND_CIPHERTEXTS, precision, 5, 0)
+    corrupt = bytes(len(record))
+    _init_worker(tk, None)
+    good, bad, worse = _run_batch(
+        OP_ADD, [[record, record], [empty, empty], [corrupt, record]]
+    )
+    assert isinstance(bad, Exception) and isinstance(worse, ValueError)
+    assert decrypt(s, ciphertexts_from_bytes(good)[0]) == 0
+
+
+# Switching to a short key and back keeps the messages, so additions can be done
+# on the short ciphertexts in between
+def test_key_switching(precision):
+    print("Testing key switching at {} bit precision".format(precision))
+    s, t = generate_key(17, precision), generate_key(4, precision)
+    down = mk_key_switching_key(s, t, precision, packed=True)
+    up = mk_key_switching_key(t, s, precision)
+    bits = [random.randrange(2) for _ in range(20)]
+    cts = encrypt_many(s, bits, precision, packed=True)
+    short = [switch_key(c, down) for c in cts]
+    assert len(short[0].values) == 4 and [decrypt(t, c) for c in short] == bits
+    assert all(error_bits(t, c) <= noise_bits(c) for c in short)
+    back = switch_key(sum_ciphertexts(short), up)
+    assert len(back.values) == 17 and decrypt(s, back) == sum(bits) % 2
+    assert error_bits(s, back) <= noise_bits(back)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    product = fused_multiply_ciphertexts(back, cts[0], tk)
+    assert decrypt(s, product) == sum(bits) % 2 & bits[0]
+    lower = mk_key_switching_key(s, t, SHORT_PRECISION + 8)
+    c = switch_key(cts[1], lower)
+    assert c.precision == SHORT_PRECISION + 8 and decrypt(t, c) == bits[1]
+    assert switch_key(PLAIN_ONE, down) == PLAIN_ONE
+
+
+# Ring ciphertexts go through the same gates and adders, and a ring transit key
+# can switch to another key
+def test_ring(precision):
+    print("Testing ring ciphertexts at {} bit precision".format(precision))
+    n = 128
+    a = [random.randint(-50, 50) for _ in range(n)]
+    b = [random.randint(-50, 50) for _ in range(n)]
+    expected = [0] * n
+    for i, j in itertools.product(range(n), repeat=2):
+        sign = 1 if i + j < n else -1
+        expected[(i + j) % n] += sign * a[i] * b[j]
+    assert ring.poly_multiply(a, b, ring.ring_ntt(n, precision)) == expected
+    s = ring.generate_key(n, precision)
+    tk = ring.mk_transit_key(s, s, precision)
+    zero, one = ring.encrypt_many(s, [0, 1], precision)
+    assert ring.decrypt(s, zero) == 0 and ring.decrypt(s, one.flip()) == 0
+    for x, y in itertools.product(range(2), repeat=2):
+        c1, c2 = (zero, one)[x], (zero, one)[y]
+        product = _and(c1, c2, tk)
+        assert ring.decrypt(s, product) == x & y
+        assert ring.decrypt(s, _or(c1, c2, tk)) == x | y
+        assert ring.error_bits(s, product) <= noise_bits(product)
+    x, y = random.randrange(64), random.randrange(64)
+    a, b = binary_encode(x, 6, zero, one), binary_encode(y, 6, zero, one)
+    total = encoded_add(a, b, tk)
+    assert ring.binary_decrypt(s, total) == x + y
+    assert all(ring.error_bits(s, c) <= noise_bits(c) for c in total)
+    assert ring.binary_decrypt(s, parallel_encoded_add(a, b, tk, processes=2)) == x + y
+    t = ring.generate_key(n, precision)
+    switching = ring.mk_transit_key(s, t, precision)
+    assert ring.decrypt(t, _and(one, one, switching)) == 1
+    assert ring.decrypt(t, _and(one, zero, switching)) == 0
+
+
+# Multiplication and comparison circuits, and their depths
+def test_arithmetic(precision):
+    print("Testing multiplication and comparison at {} bit precision".format(precision))
+    assert circuit_cost(encoded_add, 8, 8)[0] == 4
+    assert circuit_cost(encoded_equal, 8, 8) == (3, 7)
+    assert circuit_cost(encoded_less_than, 8, 8)[0] == 4
+    assert circuit_cost(encoded_select, None, 8, 8) == (1, 8)
+    assert circuit_cost(encoded_multiply, 4, 4)[0] <= 6
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+
+    def enc(x, bits):
+        return binary_encode(x, bits, zero, one)
+
+    x, y = random.randrange(16), random.randrange(8)
+    assert binary_decrypt(s, encoded_multiply(enc(x, 4), enc(y, 3), tk)) == x * y
+    product = encoded_multiply(enc(x, 4), constant_encode(5, 3), tk, bits=5)
+    assert len(product) == 5 and binary_decrypt(s, product) == x * 5 % 32
+    for x, y in [(5, 9), (9, 5), (7, 7), (0, 15), (random.randrange(16), 6)]:
+        assert decrypt(s, encoded_less_than(enc(x, 4), enc(y, 4), tk)) == int(x < y)
+        assert decrypt(s, encoded_equal(enc(x, 4), enc(y, 4), tk)) == int(x == y)
+    assert decrypt(s, encoded_less_than(enc(3, 2), enc(4, 3), tk)) == 1
+    assert decrypt(s, encoded_equal(enc(3, 4), constant_encode(3, 2), tk)) == 1
+    for bit in (zero, one):
+        out = encoded_select(bit, enc(12, 4), enc(3, 4), tk)
+        assert binary_decrypt(s, out) == (12 if decrypt(s, bit) else 3)
+
+
+# Evaluating on batches gives the same results as evaluating every record on
+# its own
+def test_batch(precision):
+    print("Testing batch evaluation at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    bits = [random.randrange(2) for _ in range(12)]
+    cts = encrypt_many(s, bits, precision, packed=True)
+    a, b = stack(cts[:6]), stack(cts[6:])
+    assert unstack(a) == cts[:6] and a.count == 6
+    expected = [
+        fused_multiply_ciphertexts(c1, c2, tk) for c1, c2 in zip(cts[:6], cts[6:])
+    ]
+    assert unstack(multiply_batches(a, b, tk)) == expected
+    assert unstack(multiply_batches(a, b, tk, window=3)) == expected
+    assert [decrypt(s, c) for c in unstack((a + b).flip())] == [
+        1 - (x ^ y) for x, y in zip(bits[:6], bits[6:])
+    ]
+    assert stack_bits([PLAIN_ONE] * 3) == PLAIN_ONE
+    mixed = stack_bits([PLAIN_ONE, cts[0], PLAIN_ZERO])
+    assert [decrypt(s, c) for c in unstack(mixed)] == [1, bits[0], 0]
+    zero, one = encrypt(s, 0, precision), encrypt(s, 1, precision)
+    xs, ys = [random.randrange(16) for _ in range(5)], [
+        random.randrange(16) for _ in range(5)
+    ]
+    a = [binary_encode(x, 4, zero, one) for x in xs]
+    b = [binary_encode(y, 4, zero, one) + [PLAIN_ZERO] for y in ys]
+    out = batch_encoded_add(a, b, tk)
+    assert [binary_decrypt(s, o) for o in out] == [x + y for x, y in zip(xs, ys)]
+    out = parallel_encoded_add(stack_encodings(a), stack_encodings(b), BatchKey(tk))
+    out = unstack_encodings(out, 5)
+    assert [binary_decrypt(s, o) for o in out] == [x + y for x, y in zip(xs, ys)]
+    values = [[random.randrange(4) for _ in range(3)] for _ in range(4)]
+    records = [[binary_encode(v, 2, zero, one) for v in r] for r in values]
+    out = batch_multi_add(records, tk, bits=4)
+    assert [binary_decrypt(s, o) for o in out] == [sum(r) for r in values]
+
+
+def test_batch_bootstrap(precision):
+    print("Testing batch bootstrapping at {} bit precision".format(precision))
+    s = generate_key(5, precision)
+    tk = mk_transit_key(s, s, precision, packed=True)
+    bk = mk_bootstrapping_key(s, s, precision, SHORT_PRECISION, packed=True)
+    bits = [1, 0, 1]
+    cts = encrypt_many(s, bits, precision, packed=True)
+    cts = [fused_multiply_ciphertexts(c, c, tk) for c in cts]
+    out = batch_bootstrap(cts, bk, tk)
+    assert [decrypt(s, o) for o in out] == bits
+    assert all(error_bits(s, o) <= noise_bits(o) for o in out)
+
+
+# Tracing a circuit and running it on a process pool gives the same sums as
+# evaluating it directly
+def test_circuit(keys):
+    print("Testing circuit tracing and parallel evaluation")
+    S, zero, one, tk = keys
+    circuit = Circuit()
+    a, b = circuit.inputs([[zero] * 8, [one] * 8])
+    out = encoded_add(a, b, circuit)
+    assert circuit.depth(out) == 4
+    assert len(circuit.levels(out)[0]) >= 8
+    x, y = random.randrange(128), random.randrange(128)
+    encx, ency = binary_encode(x, 8, zero, one), binary_encode(y, 8, zero, one)
+    assert binary_decrypt(S, parallel_encoded_add(encx, ency, tk)) == x + y
+    assert binary_decrypt(S, parallel_encoded_add(encx, ency, tk, processes=2)) == x + y
+    values = [random.randrange(100) for _ in range(5)]
+    encoded = [binary_encode(v, 9, zero, one) for v in values]
+    total = parallel_multi_add(encoded, zero, tk, bits=9, processes=2)
+    assert binary_decrypt(S, total) == sum(values)
+
+
 def test():
     print("Starting basic tests")
     s = generate_key(5, MEDIUM_PRECISION)
@@ -129,9 +892,28 @@ def test():
     assert decrypt(s, adjust_ciphertext_precision(c1, LARGE_PRECISION)) == 0
     assert decrypt(s, adjust_ciphertext_precision(c3, LARGE_PRECISION)) == 1
     assert decrypt(s, adjust_ciphertext_precision(x, LARGE_PRECISION)) == 0
+    test_packed(MEDIUM_PRECISION)
+    test_packed(LARGE_PRECISION)
+    test_window_tables(MEDIUM_PRECISION)
+    test_contiguous_transit_key(MEDIUM_PRECISION)
+    test_fused_multiply(MEDIUM_PRECISION)
+    test_encrypt_many(MEDIUM_PRECISION)
+    test_parallel_keygen(MEDIUM_PRECISION)
+    test_serialization(MEDIUM_PRECISION)
+    test_seeded(MEDIUM_PRECISION)
+    test_constants(MEDIUM_PRECISION)
+    test_noise(MEDIUM_PRECISION)
+    test_instrumentation(MEDIUM_PRECISION)
+    test_batch(MEDIUM_PRECISION)
+    test_streaming(MEDIUM_PRECISION)
+    test_public_key(MEDIUM_PRECISION)
+    test_server(MEDIUM_PRECISION)
+    test_key_switching(MEDIUM_PRECISION)
+    test_ring(MEDIUM_PRECISION)
+    test_modulus_ladder(LARGE_PRECISION)
     print("Basic tests passed")
     print("Generating more keys")
-    keys = generate_all_keys()
+    keys = generate_all_keys(processes=multiprocessing.cpu_count())
     print("Generated keys")
     test_add(42, 69, keys[LARGE_PRECISION])
     test_add3(13, 37, 42, keys[LARGE_PRECISION])
@@ -142,6 +924,8 @@ def test():
         keys[LARGE_PRECISION],
     )
     test_multiadd([random.randrange(1000) for _ in range(8)], keys[LARGE_PRECISION])
+    test_circuit(keys[LARGE_PRECISION])
+    test_arithmetic(LARGE_PRECISION)
     print("Multiadd tests passed")
     print("Starting bootstrap test")
     s, zero, one, tk = keys[LARGE_PRECISION]
@@ -161,6 +945,8 @@ def test():
     print("Error bits in bootstrap output: {}".format(error_bits(s, o)))
     assert decrypt(s, o) == ENCRYPTING_BIT
     print("Bootstrap successful")
+    test_auto_bootstrap(LARGE_PRECISION)
+    test_batch_bootstrap(LARGE_PRECISION)
 
 
 if __name__ == "__main__":